@@ -9,30 +9,20 @@
 import sys
 import math
 import socket
+import threading
+import struct
+import array
 
 nvars = 11
 nobjs = 2
 k = nvars - nobjs + 1
-serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-serversocket.bind((socket.gethostname(), int(sys.argv[1])))
-serversocket.listen(5)
-(clientsocket, address) = serversocket.accept()
-clientfile = clientsocket.makefile()
+running = True
 
-while True:
-	# Read the next line from standard input
-	line = clientfile.readline().strip()
+# Pass "binary" as the second argument to exchange length-prefixed frames of
+# float64 values instead of lines of text
+binary = len(sys.argv) > 2 and sys.argv[2] == "binary"
 
-	# Stop if the Borg MOEA is finished
-	if line == "":
-		#clientsocket.close()
-		break
-
-	# Parse the decision variables from the input
-	vars = map(float, line.split())
-
-	# Evaluate the DTLZ2 problem
+def evaluate(vars):
 	g = 0
 
 	for i in range(nvars-k, nvars):
@@ -46,10 +36,79 @@ while True:
 		if i != 0:
 			objs[i] = objs[i] * math.sin(0.5 * math.pi * vars[nobjs-i-1])
 
-	# Print objectives to standard output, flush to write immediately
-	clientsocket.sendall(" ".join(["%0.17f" % obj for obj in objs]) + "\n")
+	return objs
+
+def serve_binary(clientsocket):
+	global running
+	clientfile = clientsocket.makefile()
+
+	while True:
+		# Read the next frame, containing a header with the payload length
+		# and type followed by the variables packed as float64 values
+		header = clientfile.read(5)
+
+		if len(header) < 5:
+			break
+
+		(length, type) = struct.unpack(">Ic", header)
+
+		# Stop the server if an empty vector is received
+		if length == 0:
+			running = False
+			break
+
+		vars = array.array("d")
+		vars.fromstring(clientfile.read(length))
+
+		# Evaluate the DTLZ2 problem and send the objectives to the client
+		objs = array.array("d", evaluate(vars)).tostring()
+		clientsocket.sendall(struct.pack(">Ic", len(objs), "d") + objs)
+
+	clientsocket.shutdown(1)
+	clientsocket.close()
+
+def serve(clientsocket):
+	global running
+	clientfile = clientsocket.makefile()
+
+	while True:
+		# Read the next line from the client, stop if the connection closed
+		line = clientfile.readline()
+
+		if line == "":
+			break
+
+		# Stop the server if the Borg MOEA is finished
+		if line.strip() == "":
+			running = False
+			break
+
+		# Parse the decision variables from the input
+		vars = map(float, line.split())
+
+		# Evaluate the DTLZ2 problem and send the objectives to the client
+		objs = evaluate(vars)
+		clientsocket.sendall(" ".join(["%0.17f" % obj for obj in objs]) + "\n")
+
+	clientsocket.shutdown(1)
+	clientsocket.close()
+
+serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+serversocket.bind((socket.gethostname(), int(sys.argv[1])))
+serversocket.listen(5)
+serversocket.settimeout(0.1)
+
+# Each client is served by its own thread, so many connections can be open
+while running:
+	try:
+		(clientsocket, address) = serversocket.accept()
+	except socket.timeout:
+		continue
+
+	clientsocket.settimeout(None)
+	thread = threading.Thread(target=serve_binary if binary else serve, args=(clientsocket,))
+	thread.daemon = True
+	thread.start()
 
-clientsocket.shutdown(1)
-clientsocket.close()
-serversocket.shutdown(1)
-serversocket.close()
\ No newline at end of file
+serversocket.close()
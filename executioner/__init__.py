@@ -1,3 +1,3 @@
 __all__ = ["exceptions", "tasks"]
 
-from executioner import Executioner, ResultList
\ No newline at end of file
+from executioner import Executioner, AsyncExecutioner, ResultList, ResultTable
\ No newline at end of file
@@ -0,0 +1,487 @@
+'''
+Event loop for running many evaluations concurrently on a single thread.
+
+Tasks participate through Task.run_async(env), a generator that yields the
+event it is waiting on (Readable, Writable, Sleep, ProcessExit or a Future)
+and is resumed by the loop once that event occurs.  While one evaluation
+waits on its model, the loop runs the others, so thousands of model calls
+can be in flight without a thread for each.
+'''
+
+import os
+import sys
+import time
+import heapq
+import errno
+import fcntl
+import select
+import socket
+import threading
+import traceback
+from collections import deque
+
+class Readable(object):
+    '''
+    Waits until the file descriptor can be read without blocking.
+    '''
+
+    def __init__(self, fd):
+        super(Readable, self).__init__()
+        self.fd = fd
+
+
+class Writable(object):
+    '''
+    Waits until the file descriptor can be written without blocking.
+    '''
+
+    def __init__(self, fd):
+        super(Writable, self).__init__()
+        self.fd = fd
+
+
+class Sleep(object):
+    '''
+    Waits for the given number of seconds.
+    '''
+
+    def __init__(self, seconds):
+        super(Sleep, self).__init__()
+        self.seconds = seconds
+
+
+class ProcessExit(object):
+    '''
+    Waits until the process tracked by the ProcessStatus exits.
+    '''
+
+    def __init__(self, status):
+        super(ProcessExit, self).__init__()
+        self.status = status
+
+
+class Future(object):
+    '''
+    Waits until another coroutine calls set_result.
+    '''
+
+    def __init__(self):
+        super(Future, self).__init__()
+        self.done = False
+        self.result = None
+        self.callbacks = []
+
+    def set_result(self, result=None):
+        self.done = True
+        self.result = result
+        callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            callback(result)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self.result)
+        else:
+            self.callbacks.append(callback)
+
+
+class Lock(object):
+    '''
+    Mutual exclusion between coroutines running on the same loop.
+    '''
+
+    def __init__(self):
+        super(Lock, self).__init__()
+        self.locked = False
+        self.waiters = deque()
+
+    def acquire(self):
+        while self.locked:
+            future = Future()
+            self.waiters.append(future)
+            yield future
+
+        self.locked = True
+
+    def release(self):
+        self.locked = False
+
+        if self.waiters:
+            self.waiters.popleft().set_result()
+
+
+class Coroutine(object):
+    '''
+    A generator driven by the EventLoop.  The callback is invoked with None
+    when the generator finishes or with the sys.exc_info() of the exception
+    it raised, but not if the coroutine is cancelled.
+    '''
+
+    def __init__(self, generator, callback):
+        super(Coroutine, self).__init__()
+        self.generator = generator
+        self.callback = callback
+        self.cancelled = False
+
+
+class EventLoop(object):
+    '''
+    Runs coroutines, resuming each when the event it yielded occurs.  Uses
+    poll when available, which unlike select is not limited to 1024 file
+    descriptors.  Once closed, wakeups from other threads are ignored.
+    '''
+
+    def __init__(self):
+        super(EventLoop, self).__init__()
+        self.ready = deque()
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.poller = select.poll() if hasattr(select, "poll") else None
+        self.masks = {}
+        self.coroutines = set()
+        self.closed = False
+
+        # other threads (e.g., the process reaper) wake the loop by writing
+        # to this pipe
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        set_nonblocking(self.wakeup_read)
+        set_nonblocking(self.wakeup_write)
+        self._update(self.wakeup_read)
+
+    def close(self):
+        """
+        Cancels the remaining coroutines and closes the wakeup pipe.
+        """
+        self.cancel_all()
+
+        # processes still tracked by the reaper may call
+        # call_soon_threadsafe after this point
+        with self.lock:
+            self.closed = True
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
+
+    def spawn(self, generator, callback):
+        """
+        Schedules the generator to run on the loop.
+
+        Args:
+            generator: The generator, such as the one returned by
+                Task.run_async.
+            callback: Invoked with None once the generator finishes or with
+                the sys.exc_info() if it raises an exception.
+
+        Returns:
+            The Coroutine.
+        """
+        coroutine = Coroutine(generator, callback)
+        self.coroutines.add(coroutine)
+        self.ready.append(coroutine)
+        return coroutine
+
+    def cancel(self, coroutine):
+        """
+        Stops the coroutine by closing its generator, which runs its finally
+        blocks.  Does nothing if the coroutine already finished.
+        """
+        if coroutine not in self.coroutines:
+            return
+
+        self.coroutines.discard(coroutine)
+        coroutine.cancelled = True
+
+        for waiters in (self.readers, self.writers):
+            for fd, queue in waiters.items():
+                if coroutine in queue:
+                    queue.remove(coroutine)
+
+                    if not queue:
+                        del waiters[fd]
+
+                    self._update(fd)
+
+        self.timers = [timer for timer in self.timers if timer[2] is not coroutine]
+        heapq.heapify(self.timers)
+
+        try:
+            coroutine.generator.close()
+        except Exception:
+            traceback.print_exc()
+
+    def cancel_all(self):
+        """
+        Cancels every coroutine that has not finished.
+        """
+        for coroutine in list(self.coroutines):
+            self.cancel(coroutine)
+
+    def call_soon_threadsafe(self, coroutine):
+        """
+        Resumes the coroutine, can be called from any thread.
+        """
+        with self.lock:
+            if self.closed:
+                return
+
+            self.pending.append(coroutine)
+
+            try:
+                os.write(self.wakeup_write, "x")
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def run_once(self):
+        """
+        Waits for the next events, unless coroutines are ready to run, then
+        runs the coroutines resumed by these events.
+        """
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        else:
+            timeout = None
+
+        for fd, event in self._poll(timeout):
+            if fd == self.wakeup_read:
+                self._drain()
+                continue
+
+            if event & select.POLLIN or event & (select.POLLHUP | select.POLLERR):
+                self._dispatch(self.readers, fd)
+
+            if event & select.POLLOUT or event & (select.POLLHUP | select.POLLERR):
+                self._dispatch(self.writers, fd)
+
+            self._update(fd)
+
+        now = time.time()
+
+        while self.timers and self.timers[0][0] <= now:
+            self.ready.append(heapq.heappop(self.timers)[2])
+
+        for i in range(len(self.ready)):
+            self._step(self.ready.popleft())
+
+    def run_until_complete(self, generator):
+        """
+        Runs the generator to completion, re-raising any exception it raises.
+        """
+        result = []
+        self.spawn(generator, result.append)
+
+        while not result:
+            self.run_once()
+
+        if result[0] is not None:
+            raise result[0][0], result[0][1], result[0][2]
+
+    def _step(self, coroutine):
+        # cancelled coroutines may still be resumed by a pending event
+        if coroutine.cancelled:
+            return
+
+        try:
+            event = next(coroutine.generator)
+        except StopIteration:
+            self.coroutines.discard(coroutine)
+            coroutine.callback(None)
+            return
+        except Exception:
+            self.coroutines.discard(coroutine)
+            coroutine.callback(sys.exc_info())
+            return
+
+        if event is None:
+            self.ready.append(coroutine)
+        elif isinstance(event, Readable):
+            self.readers.setdefault(event.fd, deque()).append(coroutine)
+            self._update(event.fd)
+        elif isinstance(event, Writable):
+            self.writers.setdefault(event.fd, deque()).append(coroutine)
+            self._update(event.fd)
+        elif isinstance(event, Sleep):
+            self.counter += 1
+            heapq.heappush(self.timers, (time.time() + event.seconds, self.counter, coroutine))
+        elif isinstance(event, Future):
+            event.add_done_callback(lambda result: self.ready.append(coroutine))
+        elif isinstance(event, ProcessExit):
+            event.status.add_done_callback(lambda status: self.call_soon_threadsafe(coroutine))
+        else:
+            self.coroutines.discard(coroutine)
+            coroutine.callback((TypeError, TypeError("unsupported event " + repr(event)), None))
+
+    def _dispatch(self, waiters, fd):
+        queue = waiters.pop(fd, None)
+
+        if queue:
+            self.ready.extend(queue)
+
+    def _drain(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        with self.lock:
+            self.ready.extend(self.pending)
+            self.pending.clear()
+
+    def _update(self, fd):
+        mask = 0
+
+        if fd in self.readers or fd == self.wakeup_read:
+            mask |= select.POLLIN
+
+        if fd in self.writers:
+            mask |= select.POLLOUT
+
+        previous = self.masks.get(fd, 0)
+
+        if mask == previous:
+            return
+
+        if mask:
+            self.masks[fd] = mask
+        else:
+            del self.masks[fd]
+
+        if self.poller is not None:
+            if not mask:
+                self.poller.unregister(fd)
+            elif previous:
+                self.poller.modify(fd, mask)
+            else:
+                self.poller.register(fd, mask)
+
+    def _poll(self, timeout):
+        if self.ready or self.pending:
+            timeout = 0
+
+        while True:
+            try:
+                if self.poller is not None:
+                    return self.poller.poll(None if timeout is None else timeout*1000)
+
+                read = [fd for fd, mask in self.masks.iteritems() if mask & select.POLLIN]
+                write = [fd for fd, mask in self.masks.iteritems() if mask & select.POLLOUT]
+                read, write, _ = select.select(read, write, [], timeout)
+                return [(fd, select.POLLIN) for fd in read] + [(fd, select.POLLOUT) for fd in write]
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+
+class AsyncStream(object):
+    '''
+    Buffered, non-blocking reads and writes on a pipe or socket.  Coroutines
+    use read_lines and write_all, which yield while the stream is not ready.
+    The file-like methods block, so synchronous tasks can also use the
+    stream.
+    '''
+
+    def __init__(self, file):
+        super(AsyncStream, self).__init__()
+        self.file = file
+        self.fd = file.fileno()
+        self.buffer = ""
+        self.eof = False
+
+        if isinstance(file, socket.socket):
+            file.setblocking(0)
+            self._read = lambda: file.recv(65536)
+            self._write = file.send
+        else:
+            set_nonblocking(self.fd)
+            self._read = lambda: os.read(self.fd, 65536)
+            self._write = lambda data: os.write(self.fd, data)
+
+    def fileno(self):
+        return self.fd
+
+    def read_lines(self, count=1):
+        """
+        Yields until the given number of lines are buffered or the stream is
+        closed.
+        """
+        while not self.eof and self.buffer.count("\n") < count:
+            yield Readable(self.fd)
+            self._fill()
+
+    def write_all(self, data):
+        """
+        Yields until all of the data is written.
+        """
+        while data:
+            try:
+                data = data[self._write(data):]
+            except (IOError, OSError, socket.error) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+                yield Writable(self.fd)
+
+    def readline(self):
+        self._block(self.read_lines(1))
+        index = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:index], self.buffer[index:]
+        return line
+
+    def read(self):
+        while not self.eof:
+            self._block(iter([Readable(self.fd)]))
+            self._fill()
+
+        data, self.buffer = self.buffer, ""
+        return data
+
+    def write(self, data):
+        self._block(self.write_all(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+    def _fill(self):
+        try:
+            data = self._read()
+        except (IOError, OSError, socket.error) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            raise
+
+        if data:
+            self.buffer += data
+        else:
+            self.eof = True
+
+    def _block(self, events):
+        for event in events:
+            if isinstance(event, Readable):
+                select.select([event.fd], [], [])
+            else:
+                select.select([], [event.fd], [])
+
+
+def set_nonblocking(fd):
+    '''
+    Puts the file descriptor in non-blocking mode.
+    '''
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def set_blocking(fd):
+    '''
+    Puts the file descriptor back in blocking mode.
+    '''
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
@@ -0,0 +1,159 @@
+'''
+Memoization of evaluation results.
+'''
+
+import os
+import types
+import functools
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+import utils
+
+class ResultCache(object):
+    '''
+    Stores the results of evaluations keyed by a hash of the input and a
+    fingerprint of the task pipeline.  Results are kept in memory with LRU
+    eviction and, if a path is given, persisted to a sqlite database so
+    repeated inputs are free across runs.  Only results that can be pickled
+    are stored, other fields (e.g., PROCESS) are dropped.
+    '''
+
+    def __init__(self, maxsize=10000, path=None):
+        super(ResultCache, self).__init__()
+        self.memory = utils.LRUCache(maxsize)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fingerprint, input):
+        """
+        Returns the key identifying the input evaluated by the pipeline with
+        the given fingerprint.
+        """
+        data = pickle.dumps(sorted(input.items()), 2)
+        return hashlib.sha1(fingerprint + data).hexdigest()
+
+    def get(self, key):
+        """
+        Returns a copy of the result stored for the key or None.
+        """
+        data = self.memory.get(key)
+
+        if data is None and self.path is not None:
+            with self.lock:
+                row = self._connect().execute("SELECT result FROM results WHERE key=?", (key,)).fetchone()
+
+            if row is not None:
+                data = str(row[0])
+                self.memory.put(key, data)
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return pickle.loads(data)
+
+    def put(self, key, result):
+        """
+        Stores the result for the key.
+        """
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result = dict(result)
+
+            for name in result.keys():
+                try:
+                    pickle.dumps(result[name], pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    del result[name]
+
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+        self.memory.put(key, data)
+
+        if self.path is not None:
+            with self.lock:
+                connection = self._connect()
+                connection.execute("INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)", (key, buffer(data)))
+                connection.commit()
+
+    def clear(self):
+        """
+        Removes all stored results.
+        """
+        self.memory.clear()
+
+        if self.path is not None:
+            with self.lock:
+                connection = self._connect()
+                connection.execute("DELETE FROM results")
+                connection.commit()
+
+    def _connect(self):
+        # sqlite connections can not be shared with forked processes
+        if self.connection is None or self.pid != os.getpid():
+            import sqlite3
+            logging.info("Opening result cache %s", self.path)
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result BLOB)")
+            self.connection.commit()
+            self.pid = os.getpid()
+
+        return self.connection
+
+
+def fingerprint(tasks):
+    '''
+    Returns a string identifying the configuration of the tasks.  Functions
+    are identified by their qualified name, code and closure, so the
+    fingerprint is stable across runs.  Raises TypeError if the tasks hold a
+    value that can not be described, rather than risk two configurations
+    sharing a fingerprint.
+    '''
+    return hashlib.sha1(_describe(tasks, set())).hexdigest()
+
+def _describe(value, seen):
+    if value is None or isinstance(value, (bool, int, long, float, complex, str, unicode)):
+        return repr(value)
+    elif isinstance(value, (list, tuple)):
+        return "[" + ",".join(_describe(v, seen) for v in value) + "]"
+    elif isinstance(value, (set, frozenset)):
+        return "set[" + ",".join(sorted(_describe(v, seen) for v in value)) + "]"
+    elif isinstance(value, dict):
+        return "{" + ",".join(_describe(k, seen) + ":" + _describe(v, seen) for k, v in sorted(value.items())) + "}"
+    elif type(value).__module__ == "numpy" and hasattr(value, "tobytes"):
+        # arrays and numpy scalars
+        return "ndarray(" + value.dtype.str + repr(value.shape) + hashlib.sha1(value.tobytes()).hexdigest() + ")"
+    elif isinstance(value, types.MethodType):
+        return "method(" + _describe(value.__func__, seen) + ")"
+    elif isinstance(value, types.FunctionType):
+        name = "function(" + str(value.__module__) + "." + value.__name__
+
+        # recursive closures refer back to the function
+        if id(value) in seen:
+            return name + ")"
+
+        seen.add(id(value))
+        closure = [cell.cell_contents for cell in value.__closure__ or ()]
+        return name + _describe(value.__code__, seen) + _describe(closure, seen) + ")"
+    elif isinstance(value, types.CodeType):
+        return "code(" + repr(value.co_code) + _describe(value.co_consts, seen) + _describe(value.co_names, seen) + ")"
+    elif isinstance(value, functools.partial):
+        return "partial(" + _describe(value.func, seen) + _describe(value.args, seen) + _describe(value.keywords, seen) + ")"
+    elif isinstance(value, (type, types.ClassType, types.BuiltinFunctionType, types.ModuleType)):
+        return getattr(value, "__module__", "") + "." + getattr(value, "__name__", "")
+    elif id(value) in seen:
+        return type(value).__name__
+    elif hasattr(value, "__dict__"):
+        seen.add(id(value))
+        fields = dict((k, v) for k, v in vars(value).items() if not k.startswith("_"))
+        return type(value).__name__ + _describe(fields, seen)
+    else:
+        raise TypeError("can not fingerprint value of type " + type(value).__name__)
@@ -0,0 +1,570 @@
+'''
+Evaluates inputs across worker daemons running on other computers.
+
+The coordinator, DistributedBackend, listens for workers on a TCP port.  Each
+worker daemon, started with
+
+    python -m executioner.distributed host:port [--slots N]
+
+connects to the coordinator, receives the Executioner's tasks, and streams
+back the results of the inputs it is sent.  Workers send heartbeats, so the
+inputs held by a worker that crashes or stops responding are resubmitted to
+the other workers, and idle workers steal inputs queued on busy workers.
+
+Messages are length-prefixed frames containing pickled objects, so the
+coordinator and workers must only be reachable from trusted networks.
+'''
+
+import time
+import socket
+import select
+import logging
+import argparse
+import threading
+import itertools
+import traceback
+import cPickle as pickle
+from collections import OrderedDict, deque
+import utils
+from exceptions import TaskError, WorkerError
+from parallel import Backend, Worker, _portable, _portable_error
+
+class _RemoteWorker(object):
+    '''
+    The coordinator's view of a connected worker daemon.  Jobs maps the id of
+    each input sent to the worker, in the order they were sent.
+    '''
+
+    def __init__(self, socket, address):
+        super(_RemoteWorker, self).__init__()
+        self.socket = socket
+        self.address = address
+        self.name = str(address)
+        self.slots = 1
+        self.ready = False
+        self.setup = None
+        self.jobs = OrderedDict()
+        self.stealing = False
+        self.buffer = ""
+        self.last_seen = time.time()
+
+    def send(self, message):
+        self.socket.sendall(utils.pack_frame(utils.FRAME_PICKLE, message))
+
+    def receive(self):
+        """
+        Reads the available data, returning the list of complete messages.
+        Raises IOError if the connection was closed or a message can not be
+        read.
+        """
+        data = self.socket.recv(65536)
+
+        if not data:
+            raise IOError("Connection closed by worker")
+
+        self.buffer += data
+        self.last_seen = time.time()
+        messages = []
+        header = utils.FRAME_HEADER.size
+
+        while len(self.buffer) >= header:
+            (length, type) = utils.FRAME_HEADER.unpack_from(self.buffer)
+
+            if len(self.buffer) < header + length:
+                break
+
+            try:
+                messages.append(utils.unpack_frame(type, self.buffer[header:header+length]))
+            except Exception as e:
+                raise IOError("Unable to read message from worker: " + repr(e))
+
+            self.buffer = self.buffer[header+length:]
+
+        return messages
+
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class DistributedBackend(Backend):
+    '''
+    Coordinates worker daemons, possibly running on other computers, that
+    connect to the given address.  Inputs are handed out as workers become
+    idle, with up to prefetch inputs queued per slot on each worker.  Once no
+    inputs are left to hand out, idle workers steal half of the inputs still
+    queued on the busiest worker.
+
+    Workers send a heartbeat every second.  A worker that disconnects or is
+    silent for longer than timeout seconds is dropped, and its inputs are
+    resubmitted to the remaining workers, up to retries times per input.
+    Evaluation waits for workers to connect, see wait.
+
+    Results never contain the worker's base environment, and fields that can
+    not be pickled, such as PROCESS or STDIN, are dropped.
+    '''
+
+    def __init__(self, address=("", 0), prefetch=2, timeout=10.0, retries=3, window=1024):
+        super(DistributedBackend, self).__init__()
+        self.address = address
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.listener = None
+        self.workers = []
+        self.ids = itertools.count()
+        self.setup = None
+        self.pending = deque()
+        self.outstanding = OrderedDict()
+        self.attempts = {}
+
+    def listen(self):
+        """
+        Starts listening for workers.
+
+        Returns:
+            The (host, port) tuple workers connect to.
+        """
+        if self.listener is None:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(self.address)
+            self.listener.listen(128)
+            logging.info("Listening for workers on port %d", self.listener.getsockname()[1])
+
+        (host, port) = self.listener.getsockname()[:2]
+        return (self.address[0] or socket.gethostname(), port)
+
+    def wait(self, count=1, timeout=None):
+        """
+        Waits until at least count workers are connected.  Raises WorkerError
+        if they do not connect before the timeout.
+        """
+        self.listen()
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while len([w for w in self.workers if w.ready]) < count:
+            remaining = deadline - time.time() if deadline is not None else 1.0
+
+            if remaining <= 0:
+                logging.error("Timed out waiting for workers to connect")
+                raise WorkerError("Timed out waiting for workers to connect")
+
+            for message in self._poll(min(remaining, 1.0)):
+                pass
+
+    def close(self):
+        """
+        Stops the connected workers and closes the listener.
+        """
+        for worker in list(self.workers):
+            try:
+                worker.send(("stop",))
+            except (socket.error, IOError):
+                pass
+
+            worker.close()
+
+        self.workers = []
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        self.listen()
+        self.setup = _pickle_tasks((executioner.start_tasks, executioner.tasks,
+                                    executioner.error_tasks, executioner.complete_tasks))
+
+        for worker in self.workers:
+            self._send_setup(worker)
+
+        inputs = iter(inputs)
+        exhausted = False
+        self.pending = deque()
+        self.outstanding = OrderedDict()
+        self.attempts = {}
+        completed = {}
+        waiting = False
+
+        while True:
+            # read inputs up to the capacity of the workers, holding back when
+            # the results would wait too long on an earlier input
+            capacity = sum(w.slots*(1 + self.prefetch) for w in self.workers if w.ready)
+
+            while not exhausted and len(self.pending) <= capacity and \
+                    (not ordered or len(self.outstanding) + len(completed) < self.window):
+                try:
+                    input = next(inputs)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                id = next(self.ids)
+                self.outstanding[id] = input
+                self.attempts[id] = 0
+                self.pending.append(id)
+
+            if not self.outstanding and not completed:
+                break
+
+            if self.workers:
+                waiting = False
+            elif not waiting:
+                logging.info("Waiting for workers to connect")
+                waiting = True
+
+            self._dispatch()
+            self._steal()
+
+            for (worker, message) in self._poll(1.0):
+                if message[0] != "result":
+                    continue
+
+                (id, error, data) = message[1:]
+                worker.jobs.pop(id, None)
+
+                # results from a resubmitted input may arrive twice
+                if id not in self.outstanding:
+                    continue
+
+                del self.outstanding[id]
+                del self.attempts[id]
+
+                if error is not None:
+                    if getattr(error, "remote_traceback", None):
+                        logging.error("Evaluation failed on worker %s:\n%s", worker.name, error.remote_traceback)
+
+                    raise error
+
+                env = pickle.loads(data)
+
+                if ordered:
+                    completed[id] = env
+                else:
+                    yield env
+
+            while completed and (not self.outstanding or next(iter(self.outstanding)) > min(completed)):
+                yield completed.pop(min(completed))
+
+            self._check_heartbeats()
+
+    def _dispatch(self):
+        while self.pending:
+            candidates = [w for w in self.workers if w.ready and len(w.jobs) < w.slots*(1 + self.prefetch)]
+
+            if not candidates:
+                break
+
+            worker = min(candidates, key=lambda w: float(len(w.jobs)) / w.slots)
+            id = self.pending.popleft()
+
+            try:
+                worker.send(("job", id, self.outstanding[id]))
+                worker.jobs[id] = True
+            except (socket.error, IOError) as e:
+                self.pending.appendleft(id)
+                self._drop(worker, str(e))
+
+    def _steal(self):
+        if self.pending or not any(w.ready and len(w.jobs) < w.slots for w in self.workers):
+            return
+
+        victims = [w for w in self.workers if not w.stealing and len(w.jobs) > w.slots]
+
+        if not victims:
+            return
+
+        victim = max(victims, key=lambda w: len(w.jobs) - w.slots)
+        queued = list(victim.jobs)[victim.slots:]
+        ids = queued[len(queued)//2:]
+
+        try:
+            victim.send(("steal", ids))
+            victim.stealing = True
+        except (socket.error, IOError) as e:
+            self._drop(victim, str(e))
+
+    def _poll(self, timeout):
+        """
+        Waits for messages from the workers, accepting new connections and
+        handling the worker's hello, stolen and heartbeat messages.  Returns
+        the list of (worker, message) tuples for the remaining messages.
+        """
+        sockets = [self.listener] + [w.socket for w in self.workers]
+
+        try:
+            (readable, _, _) = select.select(sockets, [], [], timeout)
+        except select.error:
+            return []
+
+        messages = []
+
+        for s in readable:
+            if s is self.listener:
+                (connection, address) = self.listener.accept()
+                connection.settimeout(self.timeout)
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.workers.append(_RemoteWorker(connection, address))
+                continue
+
+            worker = next((w for w in self.workers if w.socket is s), None)
+
+            if worker is None:
+                continue
+
+            try:
+                received = worker.receive()
+            except (socket.error, IOError) as e:
+                self._drop(worker, str(e))
+                continue
+
+            for message in received:
+                if message[0] == "hello":
+                    (worker.name, worker.slots) = message[1:]
+                    worker.ready = True
+                    logging.info("Worker %s connected with %d slots", worker.name, worker.slots)
+
+                    if self.setup is not None:
+                        self._send_setup(worker)
+                elif message[0] == "stolen":
+                    worker.stealing = False
+
+                    for id in reversed(message[1]):
+                        worker.jobs.pop(id, None)
+
+                        if id in self.outstanding:
+                            self.pending.appendleft(id)
+
+                    logging.info("Stole %d inputs from worker %s", len(message[1]), worker.name)
+                elif message[0] != "heartbeat":
+                    messages.append((worker, message))
+
+        return messages
+
+    def _send_setup(self, worker):
+        if not worker.ready or worker.setup is self.setup:
+            return
+
+        try:
+            worker.send(("setup", self.setup))
+            worker.setup = self.setup
+        except (socket.error, IOError) as e:
+            self._drop(worker, str(e))
+
+    def _check_heartbeats(self):
+        now = time.time()
+
+        for worker in list(self.workers):
+            if now - worker.last_seen > self.timeout:
+                self._drop(worker, "no heartbeat for " + str(self.timeout) + " seconds")
+
+    def _drop(self, worker, reason):
+        if worker not in self.workers:
+            return
+
+        logging.warn("Lost worker %s (%s), resubmitting %d inputs", worker.name, reason, len(worker.jobs))
+        self.workers.remove(worker)
+        worker.close()
+
+        for id in reversed(worker.jobs.keys()):
+            if id not in self.outstanding:
+                continue
+
+            self.attempts[id] += 1
+
+            if self.attempts[id] > self.retries:
+                logging.error("Input lost by " + str(self.attempts[id]) + " workers, giving up")
+                raise WorkerError("Input lost by " + str(self.attempts[id]) + " workers, giving up")
+
+            if id not in self.pending:
+                self.pending.appendleft(id)
+
+        worker.jobs.clear()
+
+
+class WorkerDaemon(object):
+    '''
+    Connects to a DistributedBackend and evaluates the inputs it sends using
+    slots parallel Workers, each running its own copy of the start tasks.
+    Sends a heartbeat every heartbeat seconds, and retries connecting for up
+    to timeout seconds.
+    '''
+
+    def __init__(self, address, slots=1, heartbeat=1.0, timeout=30.0):
+        super(WorkerDaemon, self).__init__()
+        self.address = address
+        self.slots = slots
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.threads = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        """
+        Evaluates the coordinator's inputs until it sends stop or closes the
+        connection.
+        """
+        self.socket = self._connect()
+        self.file = self.socket.makefile("rb")
+        self._send(("hello", socket.gethostname() + ":" + str(self.socket.getsockname()[1]), self.slots))
+
+        heartbeat = threading.Thread(target=self._heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        try:
+            while True:
+                try:
+                    (type, message) = utils.read_frame(self.file)
+                except (socket.error, IOError):
+                    logging.info("Coordinator closed the connection")
+                    break
+
+                if message[0] == "setup":
+                    self._stop_slots()
+                    self._start_slots(pickle.loads(message[1]))
+                elif message[0] == "job":
+                    with self.condition:
+                        self.queue.append((message[1], message[2]))
+                        self.condition.notify()
+                elif message[0] == "steal":
+                    with self.condition:
+                        ids = set(message[1])
+                        stolen = [job for job in self.queue if job[0] in ids]
+
+                        for job in stolen:
+                            self.queue.remove(job)
+
+                    self._send(("stolen", [job[0] for job in stolen]))
+                elif message[0] == "stop":
+                    break
+        finally:
+            self.stopped.set()
+            self._stop_slots()
+            self.socket.close()
+
+    def _connect(self):
+        deadline = time.time() + self.timeout
+
+        while True:
+            try:
+                s = socket.create_connection(self.address)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                logging.info("Connected to coordinator %s:%d", self.address[0], self.address[1])
+                return s
+            except socket.error as e:
+                if time.time() > deadline:
+                    logging.error("Unable to connect to coordinator: " + str(e))
+                    raise WorkerError("Unable to connect to coordinator: " + str(e))
+
+                time.sleep(0.5)
+
+    def _send(self, message):
+        with self.send_lock:
+            self.socket.sendall(utils.pack_frame(utils.FRAME_PICKLE, message))
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.heartbeat):
+            try:
+                self._send(("heartbeat",))
+            except (socket.error, IOError):
+                break
+
+    def _start_slots(self, setup):
+        # imported here since the executioner module imports the backends
+        from executioner import Executioner
+        executioner = Executioner()
+        (executioner.start_tasks, executioner.tasks,
+         executioner.error_tasks, executioner.complete_tasks) = setup
+
+        for i in range(self.slots):
+            thread = threading.Thread(target=self._slot, args=(Worker(executioner),))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _stop_slots(self):
+        # the slots stop before starting any queued inputs
+        with self.condition:
+            for thread in self.threads:
+                self.queue.appendleft(None)
+
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def _slot(self, worker):
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue:
+                        self.condition.wait()
+
+                    job = self.queue.popleft()
+
+                if job is None:
+                    break
+
+                (id, input) = job
+
+                try:
+                    env = worker.evaluate(input)
+                    message = ("result", id, None, _portable(env, worker.env))
+                except Exception as ex:
+                    message = ("result", id, _portable_error(ex, traceback.format_exc()), None)
+
+                try:
+                    self._send(message)
+                except (socket.error, IOError):
+                    break
+        finally:
+            if worker.running:
+                worker.shutdown()
+
+
+def _pickle_tasks(tasks):
+    '''
+    Pickles the lists of tasks sent to the workers, raising a TaskError
+    naming the first task that can not be pickled.
+    '''
+    try:
+        return pickle.dumps(tasks, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        for task in itertools.chain(*tasks):
+            try:
+                pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+            except Exception as ex:
+                logging.error("Unable to send %s to the workers: %s", type(task).__name__, ex)
+                raise TaskError("Unable to send " + type(task).__name__ + " to the workers: " + str(ex))
+
+        raise
+
+
+def main(args=None):
+    '''
+    Runs a worker daemon, connecting to the coordinator given on the command
+    line.
+    '''
+    parser = argparse.ArgumentParser(description="Evaluates inputs sent by a DistributedBackend")
+    parser.add_argument("address", help="the coordinator's host:port")
+    parser.add_argument("--slots", type=int, default=1, help="the number of inputs evaluated in parallel")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="seconds between heartbeats")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to retry connecting")
+    options = parser.parse_args(args)
+
+    (host, port) = options.address.rsplit(":", 1)
+    logging.basicConfig(level=logging.INFO)
+    WorkerDaemon((host, int(port)), options.slots, options.heartbeat, options.timeout).run()
+
+if __name__ == "__main__":
+    main()
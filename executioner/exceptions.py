@@ -7,3 +7,13 @@ Created on Jul 30, 2015
 class TaskError(Exception):
     def __init__(self, message):
         super(TaskError, self).__init__(message)
+
+
+class WorkerError(Exception):
+    def __init__(self, message):
+        super(WorkerError, self).__init__(message)
+
+
+class PoolTimeout(RuntimeError):
+    def __init__(self, message):
+        super(PoolTimeout, self).__init__(message)
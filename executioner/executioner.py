@@ -1,7 +1,15 @@
 import os
 import socket
 import traceback
+import logging
 import random
+import numbers
+import parallel
+import cache
+import aio
+import utils
+import profiling
+from collections import OrderedDict, deque
 
 class ResultList(list):
     '''
@@ -62,7 +70,7 @@ class ResultList(list):
             indices,keys = pos
             
             if isinstance(indices, slice):
-                indices = xrange(*indices.indices(len(self)))
+                indices = range(*indices.indices(len(self)))
             elif isinstance(indices, int):
                 indices = [indices]
                 
@@ -85,6 +93,227 @@ class ResultList(list):
         else:
             return super(ResultList, self).__getitem__(pos)
 
+class ResultTable(object):
+    '''
+    Columnar store for the output of evaluateBatch.  Each field is kept in a
+    growable NumPy array, so columns are returned and sliced without copying.
+    Booleans, integers and floats are stored with numeric dtypes, lists of
+    numbers with the same length as 2D float arrays, and everything else as
+    objects.  A column is promoted to a wider type (e.g., int to float, or to
+    objects) if a later value does not fit.  Missing values are stored as NaN
+    in float columns and None in object columns.
+    '''
+    
+    def __init__(self, capacity=1024):
+        super(ResultTable, self).__init__()
+        self.size = 0
+        self.capacity = max(1, capacity)
+        self.columns = OrderedDict()
+        self.kinds = {}
+        
+    @classmethod
+    def _from_columns(cls, columns, kinds, size):
+        table = cls(size)
+        table.size = size
+        table.columns = columns
+        table.kinds = kinds
+        return table
+        
+    def append(self, env):
+        if self.size == self.capacity:
+            self._grow(2*self.capacity)
+            
+        row = self.size
+            
+        for key, value in env.iteritems():
+            kind = _column_kind(value)
+            
+            if key not in self.columns:
+                self._create_column(key, kind, value)
+            elif kind != self.kinds[key] or (kind == "v" and len(value) != self.columns[key].shape[1]):
+                self._promote(key, kind)
+                
+            self.columns[key][row] = value
+            
+        for key in self.columns:
+            if key not in env:
+                self._set_missing(key, row)
+                
+        self.size += 1
+        
+    def extend(self, envs):
+        for env in envs:
+            self.append(env)
+        
+    def keys(self):
+        return list(self.columns.keys())
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        for i in range(self.size):
+            yield self._row(i)
+    
+    def to_list(self, key=None, index=0):
+        if key is None:
+            if len(self.columns) > 1:
+                raise ValueError("Can not convert ResultTable to list that contains more than one key")
+            
+            key = self.keys()[0]
+            
+        return self.to_nparray(key, index).tolist()
+    
+    def to_nparray(self, keys=None, index=0):
+        """
+        Returns the values as a NumPy array.  A single key returns a view of
+        the column, where the index selects the element of 2D columns.  More
+        than one key returns a structured array.
+        """
+        if keys is None:
+            keys = self.keys()
+            
+        if isinstance(keys, str):
+            keys = [keys]
+            
+        keys = list(keys)
+        
+        if len(keys) == 1:
+            column = self[keys[0]]
+            return column[:, index] if column.ndim == 2 else column
+        else:
+            return self.to_structured(keys)
+        
+    def to_structured(self, keys=None):
+        """
+        Returns a structured array containing the given fields, where 2D
+        columns become sub-array fields.
+        """
+        import numpy
+        
+        if keys is None:
+            keys = self.keys()
+            
+        columns = [self[key] for key in keys]
+        dtype = [(str(key), column.dtype, column.shape[1:]) for key, column in zip(keys, columns)]
+        result = numpy.empty(self.size, dtype=dtype)
+        
+        for key, column in zip(keys, columns):
+            result[str(key)] = column
+            
+        return result
+    
+    def __getitem__(self, pos):
+        if isinstance(pos, tuple):
+            (indices, keys) = pos
+            
+            if not isinstance(keys, list) and not isinstance(keys, tuple):
+                keys = [keys]
+                
+            if isinstance(indices, numbers.Integral):
+                indices = [indices]
+                
+            columns = OrderedDict((key, self[key][indices]) for key in keys)
+            size = len(columns[keys[0]]) if keys else len(range(self.size)[indices])
+            return ResultTable._from_columns(columns, dict((key, self.kinds[key]) for key in keys), size)
+        elif isinstance(pos, str):
+            return self.columns[pos][:self.size]
+        elif isinstance(pos, numbers.Integral):
+            if pos < 0:
+                pos += self.size
+                
+            if pos < 0 or pos >= self.size:
+                raise IndexError("ResultTable index out of range")
+            
+            return self._row(pos)
+        else:
+            return self[pos, self.keys()]
+        
+    def __repr__(self):
+        return "ResultTable(" + repr(list(self)) + ")"
+        
+    def _row(self, i):
+        result = {}
+        
+        for key, column in self.columns.iteritems():
+            value = column[i]
+            result[key] = value.tolist() if hasattr(value, "tolist") else value
+            
+        return result
+        
+    def _grow(self, capacity):
+        import numpy
+        
+        for key, column in self.columns.items():
+            grown = numpy.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[key] = grown
+            
+        self.capacity = capacity
+            
+    def _create_column(self, key, kind, value):
+        import numpy
+        
+        if kind == "v":
+            self.columns[key] = numpy.empty((self.capacity, len(value)), dtype=numpy.float64)
+        else:
+            self.columns[key] = numpy.empty(self.capacity, dtype=_COLUMN_DTYPES[kind])
+            
+        self.kinds[key] = kind
+        
+        for row in range(self.size):
+            self._set_missing(key, row)
+    
+    def _set_missing(self, key, row):
+        if self.kinds[key] == "i":
+            self._promote(key, "f")
+        elif self.kinds[key] == "b":
+            self._promote(key, "O")
+            
+        self.columns[key][row] = None if self.kinds[key] == "O" else float("nan")
+        
+    def _promote(self, key, kind):
+        import numpy
+        
+        current = self.kinds[key]
+        column = self.columns[key]
+        
+        if current == "O" or (current, kind) in [("f", "i"), ("f", "b")]:
+            return
+        elif (current, kind) == ("i", "f"):
+            self.columns[key] = column.astype(numpy.float64)
+            self.kinds[key] = "f"
+        else:
+            promoted = numpy.empty(self.capacity, dtype=object)
+            
+            for i in range(self.size):
+                promoted[i] = column[i].tolist()
+                
+            self.columns[key] = promoted
+            self.kinds[key] = "O"
+            
+_COLUMN_DTYPES = { "b" : "bool", "i" : "int64", "f" : "float64", "O" : "object" }
+            
+def _column_kind(value):
+    '''
+    Returns the kind of column needed to store the value: "b" for booleans,
+    "i" for integers, "f" for floats, "v" for lists of numbers and "O" for
+    everything else.
+    '''
+    if isinstance(value, bool) or type(value).__name__ == "bool_":
+        return "b"
+    elif isinstance(value, numbers.Integral):
+        return "i"
+    elif isinstance(value, numbers.Real):
+        return "f"
+    elif isinstance(value, (list, tuple)) and len(value) > 0 and \
+            all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in value):
+        return "v"
+    elif type(value).__name__ == "ndarray" and value.ndim == 1 and len(value) > 0 and value.dtype.kind in "iuf":
+        return "v"
+    else:
+        return "O"
+
 class Executioner(object):
     
     def __init__(self):
@@ -96,6 +325,9 @@ class Executioner(object):
         self.running = False
         self.env = {}
         self.last_error = None
+        self.cache = None
+        self.profiler = None
+        self._fingerprint = None
         
     def __del__(self):
         if self.running:
@@ -111,9 +343,11 @@ class Executioner(object):
         
     def add(self, task):
         self.tasks.append(task)
+        self._fingerprint = None
         
     def onStart(self, task):
         self.start_tasks.append(task)
+        self._fingerprint = None
         
     def onComplete(self, task):
         self.complete_tasks.append(task)
@@ -121,19 +355,61 @@ class Executioner(object):
     def onError(self, task):
         self.error_tasks.append(task)
     
+    def enableCache(self, maxsize=10000, path=None):
+        """
+        Memoizes the results of evaluate, so evaluating the same input again
+        returns the stored result without running the tasks.  Inputs are
+        identified by their values and a fingerprint of the start and
+        per-evaluation tasks.  Failed evaluations are not stored, and the
+        pipelined and batch backends bypass the cache.  Results cached in
+        memory by the process backend's workers are sent back to this cache,
+        so later batches reuse them.
+        
+        Args:
+            maxsize: The number of results kept in memory.
+            path: The path to a sqlite database for persisting results
+                across runs, or None to only keep results in memory.
+                
+        Returns:
+            The ResultCache.
+        """
+        self.cache = cache.ResultCache(maxsize, path)
+        return self.cache
+    
+    def enableProfiling(self):
+        """
+        Records the wall time, CPU time and bytes moved by every start,
+        per-evaluation, error and complete task, including those run by
+        parallel workers.  When disabled (the default), tasks run without any
+        measurements.
+        
+        Returns:
+            The Profiler, which can export the measurements as JSON.
+        """
+        self.profiler = profiling.Profiler()
+        return self.profiler
+    
+    def disableProfiling(self):
+        self.profiler = None
+        
+    def profile(self):
+        """
+        Returns the summary of each task's measurements, see Profiler.report,
+        or an empty list if profiling is not enabled.
+        """
+        return self.profiler.report() if self.profiler is not None else []
+    
     def start(self):
-        self.env["SERVER"] = socket.gethostbyname(socket.getfqdn())
-        self.env["PORT"] = random.randint(1024, 65536)
-        self.env["WORK_DIR"] = os.path.abspath(".")
+        self._initialize(self.env)
         
-        for task in self.start_tasks:
-            task.run(self.env)
+        for index, task in enumerate(self.start_tasks):
+            self._call("start", index, task, self.env)
         
         self.running = True
         
     def shutdown(self):
-        for task in self.complete_tasks:
-            task.run(self.env)
+        for index, task in enumerate(self.complete_tasks):
+            self._call("complete", index, task, self.env)
             
         self.running = False
     
@@ -141,31 +417,414 @@ class Executioner(object):
         if not self.running:
             self.start()
         
+        return self._evaluate(self.env, input)
+    
+    def evaluateBatch(self, inputs=[], workers=1, backend=None, columnar=False):
+        """
+        Evaluates each input, returning a ResultList in the same order as the
+        inputs.
+        
+        Args:
+            inputs: An iterable of input dicts.
+            workers: The number of workers used by parallel backends.
+            backend: The name of the backend ("serial", "process", "thread",
+                "pipelined" or "batch") or a Backend instance.  Defaults to
+                "serial" when workers is 1 and "process" otherwise.
+            columnar: If True, returns a ResultTable storing each field in a
+                NumPy array instead.  Like evaluateStream, the base
+                environment is not included in the results.
+        """
+        backend = self._create_backend(workers, backend)
+        
+        if columnar:
+            results = ResultTable()
+            results.extend(backend.evaluate(self, inputs, True, True))
+        else:
+            results = ResultList()
+            results.extend(backend.evaluate(self, inputs))
+            
+        return results
+    
+    def evaluateStream(self, inputs=[], workers=1, backend=None, ordered=True):
+        """
+        Evaluates each input, yielding the results as they finish.  Unlike
+        evaluateBatch, inputs are read lazily and the results are not kept,
+        so memory stays bounded regardless of the number of inputs.  Each
+        result contains the inputs and the fields set by the tasks, but not
+        the base environment (SERVER, PORT, WORK_DIR and the fields set by
+        the start tasks).
+        
+        Args:
+            inputs: An iterable of input dicts, such as SALibSamples.
+            workers: The number of workers used by parallel backends.
+            backend: The name of the backend or a Backend instance, see
+                evaluateBatch.
+            ordered: If True, results are yielded in the same order as the
+                inputs.  Otherwise, results are yielded as soon as they
+                finish.
+        """
+        return self._create_backend(workers, backend).evaluate(self, inputs, ordered, True)
+    
+    def _create_backend(self, workers, backend):
+        if backend is None:
+            backend = "serial" if workers == 1 else "process"
+            
+        if isinstance(backend, str):
+            backend = parallel.create_backend(backend, workers)
+            
+        return backend
+    
+    def _initialize(self, env):
+        env["SERVER"] = socket.gethostbyname(socket.getfqdn())
+        env["PORT"] = random.randint(1024, 65536)
+        env["WORK_DIR"] = os.path.abspath(".")
+    
+    def _cache_key(self, input):
+        """
+        Returns the cache key of the input, or None if caching is disabled.
+        Caching is turned off if the tasks can not be fingerprinted, since
+        results could otherwise be served for a different configuration.
+        """
+        if self.cache is None:
+            return None
+        
+        if self._fingerprint is None:
+            try:
+                self._fingerprint = cache.fingerprint([self.start_tasks, self.tasks])
+            except TypeError as ex:
+                logging.warn("Unable to fingerprint tasks (%s), disabling cache", ex)
+                self.cache = None
+                return None
+            
+        return self.cache.key(self._fingerprint, input)
+    
+    def _evaluate(self, base_env, input, locks=None):
+        env = dict()
+        env.update(base_env)
+        
+        key = self._cache_key(input)
+        
+        if key is not None:
+            result = self.cache.get(key)
+            
+            if result is not None:
+                env.update(result)
+                return env
+        
+        env.update(input)
+        
         try:
-            env = dict()
-            env.update(self.env)
-            env.update(input)
+            ok = self._run(env, self.tasks, locks)
+        finally:
+            self._cleanup(env, base_env)
+        
+        if ok and key is not None:
+            self.cache.put(key, parallel.strip_env(env, base_env))
             
-            for task in self.tasks:
-                task.run(env)
+        return env
+    
+    def _cleanup(self, env, base_env):
+        """
+        Calls the functions in CLEANUP once the evaluation finishes, whether
+        or not it succeeded.  Tasks add these functions to release resources
+        leased for the evaluation, such as the warm process used by Execute.
+        Functions inherited from base_env belong to the start tasks and are
+        not called.
+        """
+        inherited = base_env.get("CLEANUP", [])
+        
+        for cleanup in env.pop("CLEANUP", []):
+            if cleanup not in inherited:
+                cleanup()
+    
+    def _call(self, phase, index, task, env):
+        """
+        Runs the task, recording its measurements if profiling is enabled.
+        """
+        if self.profiler is None:
+            task.run(env)
+        else:
+            self.profiler.call(phase, index, task, env)
+    
+    def _call_batch(self, index, task, envs):
+        """
+        Runs the per-evaluation task on a batch of environments, recording
+        its measurements if profiling is enabled.
+        """
+        if self.profiler is None:
+            task.run_batch(envs)
+        else:
+            self.profiler.call_batch("evaluate", index, task, envs)
+    
+    def _run(self, env, tasks, locks=None, offset=0):
+        """
+        Runs the tasks, invoking the error tasks if any task fails.  Returns
+        True if all tasks completed successfully.  The offset is the position
+        of the first task in self.tasks.
+        """
+        held = None
+        
+        try:
+            for index, task in enumerate(tasks, offset):
+                resource = task.shared if locks else None
+                
+                if resource != held:
+                    if held is not None:
+                        locks[held].release()
+                    
+                    held = None
+                        
+                    if resource is not None:
+                        locks[resource].acquire()
+                        held = resource
+                        
+                self._call("evaluate", index, task, env)
         except Exception as ex:
             self.last_error = ex
             traceback.print_exc()
             
-            for task in self.error_tasks:
-                task.run(env)
+            for index, task in enumerate(self.error_tasks):
+                self._call("error", index, task, env)
             
             # allow assertions to propagate for unit testing
             if isinstance(ex, AssertionError):
                 raise
             
-        return env
+            return False
+        finally:
+            if held is not None:
+                locks[held].release()
+            
+        return True
+        
+        
+class AsyncExecutioner(Executioner):
+    '''
+    An Executioner that runs up to concurrency evaluations at once on a
+    single event loop.  Tasks run through Task.run_async, so Execute,
+    WriteInput, ParseLine, CheckExitCode, Connect, Send, Receive and Pause
+    wait on the loop instead of blocking, while the remaining tasks run
+    synchronously between events.  Tasks sharing a resource (see
+    Task.share) hold a lock on the loop, so a shared model is never used by
+    two evaluations at once.
+    '''
     
-    def evaluateBatch(self, inputs=[]):        
-        results = ResultList()
+    def __init__(self, concurrency=100):
+        super(AsyncExecutioner, self).__init__()
+        self.concurrency = concurrency
+        self.loop = None
+        self.locks = {}
+    
+    def start(self):
+        if self.loop is None:
+            self.loop = aio.EventLoop()
+        
+        self._initialize(self.env)
+        self.loop.run_until_complete(self._run_tasks(self.env, self.start_tasks, "start"))
+        self.running = True
+    
+    def shutdown(self):
+        try:
+            # evaluations left running by a stream the caller stopped reading
+            self.loop.cancel_all()
+            self.loop.run_until_complete(self._run_tasks(self.env, self.complete_tasks, "complete"))
+        finally:
+            self.loop.close()
+            self.loop = None
+            self.running = False
+    
+    def evaluate(self, input={}):
+        result = ResultList()
+        result.extend(self._evaluate_all([input], True, False))
+        return result[0]
+    
+    def evaluateBatch(self, inputs=[], workers=None, backend=None, columnar=False):
+        """
+        Evaluates each input, returning a ResultList in the same order as the
+        inputs.
+        
+        Args:
+            inputs: An iterable of input dicts.
+            workers: The number of concurrent evaluations, defaults to the
+                concurrency given to the constructor.
+            backend: Not supported, the evaluations always run on the event
+                loop.
+            columnar: If True, returns a ResultTable, see
+                Executioner.evaluateBatch.
+        """
+        self._check_backend(backend)
+        
+        if columnar:
+            results = ResultTable()
+            results.extend(self._evaluate_all(inputs, True, True, workers))
+        else:
+            results = ResultList()
+            results.extend(self._evaluate_all(inputs, True, False, workers))
         
-        for input in inputs:
-            results.append(self.evaluate(input))
-            
         return results
-    
\ No newline at end of file
+    
+    def evaluateStream(self, inputs=[], workers=None, backend=None, ordered=True):
+        """
+        Evaluates each input, yielding the results as they finish, see
+        Executioner.evaluateStream.
+        
+        Args:
+            inputs: An iterable of input dicts.
+            workers: The number of concurrent evaluations, defaults to the
+                concurrency given to the constructor.
+            backend: Not supported, the evaluations always run on the event
+                loop.
+            ordered: If True, results are yielded in the same order as the
+                inputs.
+        """
+        self._check_backend(backend)
+        return self._evaluate_all(inputs, ordered, True, workers)
+    
+    def _check_backend(self, backend):
+        if backend is not None:
+            raise ValueError("AsyncExecutioner does not support backends")
+    
+    def _evaluate_all(self, inputs, ordered, strip, workers=None):
+        if not self.running:
+            self.start()
+        
+        concurrency = workers or self.concurrency
+        loop = self.loop
+        inputs = iter(inputs)
+        finished = deque()
+        buffer = {}
+        running = {}
+        next_index = 0
+        submitted = 0
+        exhausted = False
+        
+        try:
+            while True:
+                while not exhausted and len(running) < concurrency:
+                    try:
+                        input = next(inputs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    
+                    env = {}
+                    running[submitted] = loop.spawn(self._evaluate_async(self.env, input, env),
+                                                    lambda error, index=submitted, env=env: finished.append((index, env, error)))
+                    submitted += 1
+                
+                if not running:
+                    break
+                
+                while not finished:
+                    loop.run_once()
+                
+                while finished:
+                    index, env, error = finished.popleft()
+                    del running[index]
+                    
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    
+                    result = parallel.strip_env(env, self.env) if strip else env
+                    
+                    if ordered:
+                        buffer[index] = result
+                    else:
+                        yield result
+                
+                while next_index in buffer:
+                    yield buffer.pop(next_index)
+                    next_index += 1
+        finally:
+            # stopped early by an error or by the caller, the evaluations
+            # still running would otherwise stay parked on the loop
+            for coroutine in running.values():
+                loop.cancel(coroutine)
+    
+    def _evaluate_async(self, base_env, input, env):
+        env.update(base_env)
+        
+        key = self._cache_key(input)
+        
+        if key is not None:
+            result = self.cache.get(key)
+            
+            if result is not None:
+                env.update(result)
+                return
+        
+        env.update(input)
+        success = []
+        events = self._run_tasks(env, self.tasks, "evaluate", success)
+        
+        try:
+            for event in events:
+                yield event
+        except GeneratorExit:
+            # cancelled by the loop, kill the model this evaluation started
+            status = env.get("PROCESS_STATUS")
+            
+            if isinstance(status, utils.ProcessStatus):
+                status.cancel()
+                
+            raise
+        finally:
+            events.close()
+            self._cleanup(env, base_env)
+        
+        if success and key is not None:
+            self.cache.put(key, parallel.strip_env(env, base_env))
+    
+    def _run_tasks(self, env, tasks, phase, success=None):
+        """
+        Like Executioner._run, but runs each task on the loop.  Appends True
+        to success if all tasks completed successfully.
+        """
+        held = None
+        
+        try:
+            for index, task in enumerate(tasks):
+                if task.shared != held:
+                    if held is not None:
+                        self.locks[held].release()
+                    
+                    held = None
+                    
+                    if task.shared is not None:
+                        lock = self.locks.setdefault(task.shared, aio.Lock())
+                        
+                        for event in lock.acquire():
+                            yield event
+                        
+                        held = task.shared
+                
+                if self.profiler is None:
+                    events = task.run_async(env)
+                else:
+                    events = self.profiler.call_async(phase, index, task, env)
+                
+                for event in events:
+                    yield event
+        except Exception as ex:
+            self.last_error = ex
+            
+            # only the per-evaluation tasks recover from errors
+            if success is None:
+                raise
+            
+            traceback.print_exc()
+            
+            for index, task in enumerate(self.error_tasks):
+                self._call("error", index, task, env)
+            
+            # allow assertions to propagate for unit testing
+            if isinstance(ex, AssertionError):
+                raise
+            
+            return
+        finally:
+            if held is not None:
+                self.locks[held].release()
+        
+        if success is not None:
+            success.append(True)
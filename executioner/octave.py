@@ -4,10 +4,12 @@ Created on Jul 30, 2015
 @author: dhadka
 '''
  
+import copy
 import logging
+import functools
 import utils
 from tasks import Task
-from exceptions import TaskError
+from exceptions import TaskError, PoolTimeout
 from oct2py import Oct2Py
 
 # Note: When testing on Windows with GNU Octave-4.0.0, had to rename
@@ -23,9 +25,10 @@ class StartOctaveEngine(Task):
         self.kwargs = kwargs
          
     def run(self, env):
-        logging.info("Starting Octave")
+        self.log("Starting Octave")
         env["OCTAVE_ENGINE"] = Oct2Py(**self.kwargs)
-        logging.info("Successfully started Octave")
+        env["OCTAVE_PUSHED"] = {}
+        self.log("Successfully started Octave")
         
 
 class StopOctaveEngine(Task):
@@ -43,7 +46,8 @@ class StopOctaveEngine(Task):
         
         env["OCTAVE_ENGINE"].exit()
         del env["OCTAVE_ENGINE"]
-        logging.info("Exited Octave")
+        env.pop("OCTAVE_PUSHED", None)
+        self.log("Exited Octave")
         
 
 class AddOctavePath(Task):
@@ -59,13 +63,14 @@ class AddOctavePath(Task):
             logging.error("OCTAVE_ENGINE not defined")
             raise TaskError("OCTAVE_ENGINE not defined")
         
-        logging.info("Adding " + str(self.path) + " to Octave's search path")
+        self.log("Adding %s to Octave's search path", self.path)
         env["OCTAVE_ENGINE"].addpath(self.path) 
         
         
 class SetOctaveVar(Task):
     '''
-    Sets the value of a variable in Octave.
+    Sets the value of a variable in Octave.  The key and value may also be
+    lists, in which case all variables are pushed in a single transfer.
     '''
     
     def __init__(self, key, value):
@@ -78,27 +83,23 @@ class SetOctaveVar(Task):
             logging.error("OCTAVE_ENGINE not defined")
             raise TaskError("OCTAVE_ENGINE not defined")
          
-        engine = env["OCTAVE_ENGINE"]
-        env_key = utils.get_substitution_key(self.value, env)
-        
-        if env_key:
-            engine.push(self.key, env[env_key])
-            logging.info("Pushing variable " + self.key + " to Octave with value " + str(env[env_key]))
-        elif isinstance(self.value, str) and self.value in env:
-            engine.push(self.key, env[self.value])
-            logging.info("Pushing variable " + self.key + " to Octave with value " + str(env[self.value]))
-        elif isinstance(self.value, str):
-            value = utils.substitute(self.value, env)
-            engine.push(self.key, value)
-            logging.info("Pushing variable " + self.key + " to Octave with value " + str(value))
+        if isinstance(self.key, list):
+            keys = self.key
+            values = [_resolve(value, env) for value in self.value]
         else:
-            engine.push(self.key, self.value)
-            logging.info("Pushing variable " + self.key + " to Octave with value " + str(self.value))
+            keys = [self.key]
+            values = [_resolve(self.value, env)]
+            
+        for key, value in zip(keys, values):
+            self.log("Pushing variable %s to Octave with value %s", key, value)
+            
+        push(env, keys, values)
         
         
 class GetOctaveVar(Task):
     '''
-    Gets the value of a variable in Octave.
+    Gets the value of a variable in Octave.  The key and rename may also be
+    lists, in which case all variables are pulled in a single transfer.
     '''
     
     def __init__(self, key, rename=None):
@@ -111,48 +112,141 @@ class GetOctaveVar(Task):
             logging.error("OCTAVE_ENGINE not defined")
             raise TaskError("OCTAVE_ENGINE not defined")
         
-        engine = env["OCTAVE_ENGINE"]
-        name = self.key if self.rename is None else self.rename
-        env[name] = engine.pull(self.key)
-        logging.info("Pulled variable " + self.key + " from Octave with value " + str(env[name]))
+        keys = self.key if isinstance(self.key, list) else [self.key]
+        
+        if self.rename is None:
+            names = keys
+        else:
+            names = self.rename if isinstance(self.rename, list) else [self.rename]
+        
+        for key, name, value in zip(keys, names, pull(env, keys)):
+            env[name] = value
+            self.log("Pulled variable %s from Octave with value %s", key, value)
      
      
 class EvaluateOctaveFunction(Task):
     '''
-    Evaluates an Octave function.
+    Evaluates an Octave function.  All input variables are pushed in a
+    single transfer and all outputs are pulled in a single transfer.
+    
+    If vectorized is True, the batch backend evaluates the function once per
+    chunk of inputs.  Each input variable is passed as a matrix with one row
+    per input (a column vector for scalar inputs), and each output must have
+    one row per input, which is split back into the results.  Arguments
+    that are not variables must be the same for every input.
     '''
      
-    def __init__(self, name, input=[], output=[]):
+    def __init__(self, name, input=[], output=[], vectorized=False):
         super(EvaluateOctaveFunction, self).__init__()
         self.name = name
         self.input = input
         self.output = output
+        self.vectorized = vectorized
          
     def run(self, env):
         if "OCTAVE_ENGINE" not in env:
             logging.error("OCTAVE_ENGINE not defined")
             raise TaskError("OCTAVE_ENGINE not defined")
          
-        engine = env["OCTAVE_ENGINE"]
         input_strs = []
+        push_keys = []
+        push_values = []
         
         # If input argument is a variable, push into Octave's memory.
         # Otherwise, pass the input argument directly in the command.
         for arg in self.input:
-            key = utils.get_substitution_key(arg, env)
+            key = self._input_key(arg, env)
+                
             if key:
-                engine.push(key, env[key])
+                self.log("Pushing variable %s to Octave with value %s", key, env[key])
+                push_keys.append(key)
+                push_values.append(env[key])
                 input_strs.append(key)
-                logging.info("Pushing variable " + key + " to Octave with value " + str(env[key]))
-            elif isinstance(arg, str) and arg in env:
-                logging.info("Pushing variable " + arg + " to Octave with value " + str(env[arg]))
-                engine.push(arg, env[arg])
-                input_strs.append(arg)
             elif isinstance(arg, str):
                 input_strs.append(utils.substitute(arg, env))
             else:
                 input_strs.append(str(arg))
                 
+        push(env, push_keys, push_values)
+        
+        for arg, value in zip(self.output, self._evaluate(env, input_strs)):
+            env[arg] = value
+            self.log("Pulled variable %s from Octave with value %s", arg, value)
+            
+    def supports_batch(self):
+        return self.vectorized
+    
+    def run_batch(self, envs):
+        if not self.vectorized:
+            super(EvaluateOctaveFunction, self).run_batch(envs)
+            return
+        
+        import numpy
+        env = envs[0]
+        
+        if "OCTAVE_ENGINE" not in env:
+            logging.error("OCTAVE_ENGINE not defined")
+            raise TaskError("OCTAVE_ENGINE not defined")
+        
+        input_strs = []
+        push_keys = []
+        push_values = []
+        
+        # Stack each input variable into a matrix with one row per input
+        for arg in self.input:
+            key = self._input_key(arg, env)
+            
+            if key:
+                matrix = numpy.array([e[key] for e in envs], dtype=float)
+                
+                if matrix.ndim == 1:
+                    matrix = matrix.reshape(-1, 1)
+                    
+                push_keys.append(key)
+                push_values.append(matrix)
+                input_strs.append(key)
+            elif isinstance(arg, str):
+                values = set(utils.substitute(arg, e) for e in envs)
+                
+                if len(values) > 1:
+                    logging.error("Argument " + arg + " differs between inputs, unable to vectorize")
+                    raise TaskError("Argument " + arg + " differs between inputs, unable to vectorize")
+                
+                input_strs.append(values.pop())
+            else:
+                input_strs.append(str(arg))
+                
+        self.log("Pushing %s to Octave for %s inputs", push_keys, len(envs))
+        push(env, push_keys, push_values)
+        
+        outputs = []
+        
+        for arg, value in zip(self.output, self._evaluate(env, input_strs)):
+            value = numpy.asarray(value)
+            
+            if value.ndim < 2 or value.shape[0] != len(envs):
+                logging.error("Output " + arg + " of " + self.name + " has shape " + str(value.shape) + ", expected " + str(len(envs)) + " rows")
+                raise TaskError("Output " + arg + " of " + self.name + " has shape " + str(value.shape) + ", expected " + str(len(envs)) + " rows")
+            
+            outputs.append((arg, value))
+            
+        # Split the rows of each output back into the results
+        for i, e in enumerate(envs):
+            for arg, value in outputs:
+                if value.shape[1] == 1:
+                    e[arg] = value[i, 0].item()
+                else:
+                    e[arg] = value[i]
+                    
+    def _input_key(self, arg, env):
+        key = utils.get_substitution_key(arg, env)
+        
+        if not key and isinstance(arg, str) and arg in env:
+            key = arg
+            
+        return key
+    
+    def _evaluate(self, env, input_strs):
         # Build the command
         command = ""
         
@@ -166,9 +260,227 @@ class EvaluateOctaveFunction(Task):
         command += ",".join(input_strs)
         command += ");"
         
-        logging.info("Evaluating within Octave: " + command)
-        engine.eval(command)
-         
-        for arg in self.output:
-            env[arg] = engine.pull(arg)
-            logging.info("Pulled variable " + arg + " from Octave with value " + str(env[arg]))
+        self.log("Evaluating within Octave: %s", command)
+        
+        # the outputs overwrite any previously pushed values
+        forget(env, self.output)
+        env["OCTAVE_ENGINE"].eval(command)
+        
+        return pull(env, self.output)
+            
+            
+class OctaveSession(object):
+    '''
+    An Octave session owned by an OctaveEnginePool, along with the record of
+    the variables pushed to it.
+    '''
+    
+    def __init__(self, pool):
+        super(OctaveSession, self).__init__()
+        self.pool = pool
+        self.engine = Oct2Py(**pool.kwargs)
+        self.pushed = {}
+        
+        # run the setup tasks, such as AddOctavePath, on the new session
+        env = { "OCTAVE_ENGINE" : self.engine, "OCTAVE_PUSHED" : self.pushed }
+        
+        for task in pool.setup:
+            task.run(env)
+            
+    def alive(self):
+        """
+        Returns True if the session still responds.
+        """
+        try:
+            self.engine.eval("1;")
+            return True
+        except Exception:
+            return False
+        
+    def close(self):
+        try:
+            self.engine.exit()
+        except Exception:
+            pass
+        
+        
+class OctaveEnginePool(utils.ResourcePool):
+    '''
+    Pool of up to size Octave sessions, so evaluations running in parallel
+    each lease their own session.  The setup tasks, such as AddOctavePath,
+    run on every new session, and any keyword arguments are passed to
+    Oct2Py.  Add StartOctavePool with onStart to start all sessions up front.
+    '''
+    
+    def __init__(self, size=1, setup=[], **kwargs):
+        super(OctaveEnginePool, self).__init__(self._create, size, OctaveSession.close)
+        self.setup = setup
+        self.kwargs = kwargs
+        
+    def _create(self):
+        session = OctaveSession(self)
+        logging.info("Started Octave session")
+        return session
+        
+        
+class StartOctavePool(Task):
+    '''
+    Starts all sessions of an OctaveEnginePool in parallel, since each
+    session takes seconds to start.
+    '''
+    
+    def __init__(self, pool):
+        super(StartOctavePool, self).__init__()
+        self.pool = pool
+        
+    def run(self, env):
+        self.log("Starting %s Octave sessions", self.pool.size)
+        self.pool.fill()
+        self.log("Successfully started Octave sessions")
+        
+        
+class LeaseOctaveEngine(Task):
+    '''
+    Leases a session from an OctaveEnginePool, setting OCTAVE_ENGINE so the
+    other Octave tasks use it.  The session is returned with
+    ReleaseOctaveEngine.  A session that is not released by the end of the
+    evaluation, such as when the evaluation fails, is returned like
+    ReleaseOctaveEngine(check=True) added with onError, so crashed sessions
+    are restarted.
+    '''
+    
+    def __init__(self, pool, timeout=None):
+        super(LeaseOctaveEngine, self).__init__()
+        self.pool = pool
+        self.timeout = timeout
+        
+    def run(self, env):
+        if "OCTAVE_ENGINE" in env:
+            logging.error("OCTAVE_ENGINE already defined, release prior session first")
+            raise TaskError("OCTAVE_ENGINE already defined, release prior session first")
+        
+        try:
+            session = self.pool.acquire(self.timeout)
+        except PoolTimeout:
+            logging.error("Timed out waiting for an Octave session")
+            raise TaskError("Timed out waiting for an Octave session")
+        
+        env["OCTAVE_SESSION"] = session
+        env["OCTAVE_ENGINE"] = session.engine
+        env["OCTAVE_PUSHED"] = session.pushed
+        env["CLEANUP"] = env.get("CLEANUP", []) + [functools.partial(self._abandon, env, session)]
+        
+    def _abandon(self, env, session):
+        if env.get("OCTAVE_SESSION") is session:
+            logging.warn("Octave session was not released, returning it")
+            ReleaseOctaveEngine(check=True).run(env)
+        
+        
+class ReleaseOctaveEngine(Task):
+    '''
+    Returns the session leased by LeaseOctaveEngine to its pool.  With
+    check=True, a session that no longer responds is closed and restarted
+    when needed.  With discard=True, the session is always restarted.
+    '''
+    
+    def __init__(self, check=False, discard=False):
+        super(ReleaseOctaveEngine, self).__init__()
+        self.check = check
+        self.discard = discard
+        
+    def run(self, env):
+        if "OCTAVE_SESSION" not in env:
+            return
+        
+        session = env.pop("OCTAVE_SESSION")
+        env.pop("OCTAVE_ENGINE", None)
+        env.pop("OCTAVE_PUSHED", None)
+        discard = self.discard
+        
+        if not discard and self.check and not session.alive():
+            logging.warn("Octave session is not responding, restarting")
+            discard = True
+            
+        session.pool.release(session, discard)
+        
+        
+def push(env, keys, values):
+    '''
+    Pushes the variables to the Octave engine in a single transfer.
+    Variables that still hold the value pushed by a previous call are
+    skipped.  Tasks that modify these variables by other means, such as by
+    evaluating Octave code, must call forget.
+    '''
+    pushed = env.get("OCTAVE_PUSHED")
+    
+    if pushed is not None:
+        changed = [i for i, (key, value) in enumerate(zip(keys, values))
+                   if key not in pushed or not _same(pushed[key], value)]
+        keys = [keys[i] for i in changed]
+        values = [values[i] for i in changed]
+        
+    if not keys:
+        return
+    
+    env["OCTAVE_ENGINE"].push(keys, values)
+    
+    if pushed is not None:
+        for key, value in zip(keys, values):
+            try:
+                pushed[key] = copy.deepcopy(value)
+            except Exception:
+                pushed.pop(key, None)
+    
+def pull(env, keys):
+    '''
+    Pulls the variables from the Octave engine in a single transfer,
+    returning the list of values.
+    '''
+    if not keys:
+        return []
+    elif len(keys) == 1:
+        return [env["OCTAVE_ENGINE"].pull(keys[0])]
+    else:
+        return list(env["OCTAVE_ENGINE"].pull(keys))
+    
+def forget(env, keys):
+    '''
+    Marks the variables as modified, so push transfers them again.
+    '''
+    pushed = env.get("OCTAVE_PUSHED")
+    
+    if pushed is not None:
+        for key in keys:
+            pushed.pop(key, None)
+            
+def _resolve(value, env):
+    '''
+    Returns the value of a SetOctaveVar argument, which is either a
+    ${keyword}, the name of a field, a string with substitutions or a value.
+    '''
+    env_key = utils.get_substitution_key(value, env)
+    
+    if env_key:
+        return env[env_key]
+    elif isinstance(value, str) and value in env:
+        return env[value]
+    elif isinstance(value, str):
+        return utils.substitute(value, env)
+    else:
+        return value
+    
+def _same(old, new):
+    '''
+    Returns True if the two values are equal, comparing arrays elementwise.
+    '''
+    if type(old) != type(new):
+        return False
+    
+    if type(new).__name__ == "ndarray":
+        import numpy
+        return old.dtype == new.dtype and numpy.array_equal(old, new)
+    
+    try:
+        return bool(old == new)
+    except Exception:
+        return False
@@ -0,0 +1,917 @@
+'''
+Backends for evaluating batches of inputs, possibly in parallel.
+'''
+
+import sys
+import time
+import heapq
+import random
+import logging
+import threading
+import traceback
+import multiprocessing
+import cPickle as pickle
+from Queue import Queue, Empty
+from collections import deque
+import utils
+import profiling
+from exceptions import WorkerError
+from tasks import WriteInput
+
+class Worker(object):
+    '''
+    An isolated copy of the Executioner's start and complete tasks.  Each
+    worker has its own base environment, so it starts its own processes,
+    opens its own sockets, etc.  When running alongside other workers in the
+    same process, shared_env contains the results of the shared start tasks
+    and locks maps each shared resource to its lock.
+    '''
+
+    def __init__(self, executioner, shared_env=None, locks=None):
+        super(Worker, self).__init__()
+        self.executioner = executioner
+        self.shared_env = shared_env
+        self.locks = locks
+        self.env = {}
+        self.running = False
+
+    def start(self):
+        self.executioner._initialize(self.env)
+
+        if self.shared_env is not None:
+            self.env.update(self.shared_env)
+
+        for index, task in enumerate(self.executioner.start_tasks):
+            if self.locks is None or task.shared is None:
+                self.executioner._call("start", index, task, self.env)
+
+        self.running = True
+
+    def shutdown(self):
+        for index, task in enumerate(self.executioner.complete_tasks):
+            if self.locks is None or task.shared is None:
+                self.executioner._call("complete", index, task, self.env)
+
+        self.running = False
+
+    def evaluate(self, input):
+        if not self.running:
+            self.start()
+
+        return self.executioner._evaluate(self.env, input, self.locks)
+
+
+class Backend(object):
+    '''
+    Strategy for evaluating a batch of inputs, subclasses must override
+    evaluate(executioner, inputs).
+    '''
+
+    def __init__(self):
+        super(Backend, self).__init__()
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        """
+        Evaluates the inputs.  Inputs are read from the iterable lazily, so
+        only a bounded number of inputs and results are held in memory.
+
+        Args:
+            executioner: The Executioner defining the tasks.
+            inputs: An iterable of input dicts.
+            ordered: If True, the results are returned in the same order as
+                the inputs.  Otherwise, results are returned as they finish.
+            strip: If True, the worker's base environment (SERVER, PORT,
+                WORK_DIR and the fields set by the start tasks) is removed
+                from the results.
+
+        Returns:
+            An iterable of the resulting environments.
+        """
+        raise NotImplementedError("Backends must define the evaluate method")
+
+
+class SerialBackend(Backend):
+    '''
+    Evaluates the inputs one at a time using the Executioner's environment.
+    The number of workers is ignored.
+    '''
+
+    def __init__(self, workers=1):
+        super(SerialBackend, self).__init__()
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        for input in inputs:
+            env = executioner.evaluate(input)
+            yield strip_env(env, executioner.env) if strip else env
+
+
+class CostModel(object):
+    '''
+    Predicts how long an input takes to evaluate from the evaluation times of
+    past inputs.  The prediction is the mean time of the k past inputs
+    nearest to the input, comparing the numeric fields scaled by their range.
+    Only the most recent history inputs are kept.  Before any times are
+    recorded, all inputs are predicted to cost the same.
+    '''
+
+    def __init__(self, k=5, history=1000):
+        super(CostModel, self).__init__()
+        self.k = k
+        self.history = history
+        self.keys = None
+        self.points = deque(maxlen=history)
+        self.times = deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def add(self, input, seconds):
+        """
+        Records the evaluation time of an input.
+        """
+        with self.lock:
+            if self.keys is None:
+                self.keys = sorted(k for k, v in input.iteritems() if _is_number(v))
+
+            self.points.append(self._features(input))
+            self.times.append(seconds)
+
+    def predict(self, inputs):
+        """
+        Returns the list of predicted evaluation times of the inputs.
+        """
+        with self.lock:
+            if not self.times:
+                return [0.0]*len(inputs)
+
+            points = list(self.points)
+            times = list(self.times)
+            features = [self._features(input) for input in inputs]
+
+        k = min(self.k, len(times))
+
+        try:
+            import numpy
+        except ImportError:
+            return [self._predict(points, times, k, f) for f in features]
+
+        points = numpy.array(points, dtype=float).reshape(len(times), -1)
+        features = numpy.array(features, dtype=float).reshape(len(inputs), -1)
+        times = numpy.array(times)
+        scale = points.max(axis=0) - points.min(axis=0)
+        scale[scale == 0] = 1.0
+        points /= scale
+        features /= scale
+        result = []
+
+        # limit the size of the distance matrix
+        for start in range(0, len(features), 256):
+            chunk = features[start:start+256]
+            distances = ((chunk[:, numpy.newaxis, :] - points[numpy.newaxis, :, :])**2).sum(axis=2)
+            nearest = numpy.argpartition(distances, k-1, axis=1)[:, :k]
+            result.extend(times[nearest].mean(axis=1).tolist())
+
+        return result
+
+    def _features(self, input):
+        return [float(input.get(key, 0)) if _is_number(input.get(key)) else 0.0 for key in self.keys]
+
+    def _predict(self, points, times, k, feature):
+        scale = [max(column) - min(column) or 1.0 for column in zip(*points)]
+        distances = sorted((sum(((a - b) / s)**2 for a, b, s in zip(point, feature, scale)), t)
+                           for point, t in zip(points, times))
+        return sum(t for (d, t) in distances[:k]) / k
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+class PoolBackend(Backend):
+    '''
+    Base class for backends that hand inputs out to a pool of workers as they
+    become idle.  Each worker holds at most prefetch inputs.  When returning
+    results in order, at most window inputs are in flight or waiting on an
+    earlier, slower input, bounding memory.  Subclasses must override
+    start_workers, get_result, check_workers and stop_workers.
+
+    With adaptive=True, inputs are scheduled longest first.  The backend
+    reads ahead up to lookahead inputs, predicts their evaluation times with
+    the cost model, which learns from the times of all inputs evaluated by
+    this backend, and hands out the most expensive inputs first.  Once all
+    inputs are read and few remain, inputs are only handed to idle workers,
+    so the last inputs do not wait in the queue of a busy worker.
+
+    With speculate set, an evaluation running longer than speculate times the
+    95th percentile of the completed evaluation times is duplicated on an
+    idle worker.  The first copy to finish is returned and the processes
+    started by the other copy with Execute are killed.  Speculation starts
+    after min_samples evaluations complete, and each worker only holds the
+    input it is running, so idle workers are available.  Results never wait
+    on the other copy, but a copy stuck in a task other than a process
+    started by Execute, such as reading from a socket or from a process
+    started by the start tasks, can not be killed.  Its worker is then busy
+    until the copy finishes, and stopping the ThreadBackend waits for it.
+    '''
+
+    min_samples = 10
+
+    def __init__(self, workers=None, prefetch=2, window=None, adaptive=False, lookahead=None, cost_model=None,
+                 speculate=None):
+        super(PoolBackend, self).__init__()
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.prefetch = prefetch
+        self.window = window if window else 8*self.workers*self.prefetch
+        self.adaptive = adaptive
+        self.lookahead = min(lookahead if lookahead else self.window, self.window) if adaptive else 1
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.speculate = speculate
+        self.times = profiling.Histogram()
+
+    def start_workers(self, executioner, strip):
+        """
+        Starts the workers, returning a list containing each worker's job
+        queue.  Jobs are (index, input) tuples or None to stop the worker.
+        If strip is True, workers remove their base environment from the
+        results.
+        """
+        raise NotImplementedError("PoolBackends must define the start_workers method")
+
+    def get_result(self, timeout):
+        """
+        Returns the next (worker, index, error, env, seconds) tuple, where
+        error is None or the (type, value, traceback) of the failure and
+        seconds is the evaluation time, raising Queue.Empty if no result
+        arrives before the timeout.
+        """
+        raise NotImplementedError("PoolBackends must define the get_result method")
+
+    def check_workers(self):
+        """
+        Raises WorkerError if any worker terminated unexpectedly.
+        """
+        raise NotImplementedError("PoolBackends must define the check_workers method")
+
+    def cancel(self, id, index):
+        """
+        Kills the processes started by the worker's evaluation of the input.
+        Subclasses must override this method to support speculate.
+        """
+        raise NotImplementedError("PoolBackends must define the cancel method to speculate")
+
+    def stop_workers(self):
+        """
+        Stops the workers and waits for them to finish their complete tasks.
+        """
+        raise NotImplementedError("PoolBackends must define the stop_workers method")
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        queues = self.start_workers(executioner, strip)
+
+        try:
+            inputs = enumerate(inputs)
+            exhausted = False
+            completed = {}
+            ready = []
+            running = {}
+            started = {}
+            load = [0]*len(queues)
+            outstanding = 0
+            read = 0
+            next_index = 0
+
+            while True:
+                # hand out inputs to idle workers, holding back when the
+                # results would wait too long on an earlier input
+                while True:
+                    if not ready and not exhausted:
+                        jobs = []
+
+                        while len(jobs) < self.lookahead and (not ordered or read - next_index < self.window):
+                            job = next(inputs, None)
+
+                            if job is None:
+                                exhausted = True
+                                break
+
+                            jobs.append(job)
+                            read += 1
+
+                        if self.adaptive:
+                            costs = self.cost_model.predict([input for (index, input) in jobs])
+                        else:
+                            costs = [0.0]*len(jobs)
+
+                        for ((index, input), cost) in zip(jobs, costs):
+                            heapq.heappush(ready, (-cost, index, input))
+
+                    if not ready:
+                        break
+
+                    if self.speculate or (self.adaptive and exhausted and len(ready) < len(queues)*self.prefetch):
+                        limit = 1
+                    else:
+                        limit = self.prefetch
+
+                    id = min(range(len(queues)), key=load.__getitem__)
+
+                    if load[id] >= limit:
+                        break
+
+                    (cost, index, input) = heapq.heappop(ready)
+                    queues[id].put((index, input))
+                    load[id] += 1
+                    outstanding += 1
+
+                    if self.adaptive or self.speculate:
+                        running[index] = input
+
+                    if self.speculate:
+                        started[index] = (time.time(), [id])
+
+                if outstanding == 0:
+                    break
+
+                if self.speculate and not ready:
+                    self._speculate(queues, load, running, started)
+
+                try:
+                    (id, index, error, env, seconds) = self.get_result(0.1 if self.speculate else 1)
+                except Empty:
+                    self.check_workers()
+                    continue
+
+                load[id] -= 1
+
+                if self.speculate:
+                    # the slower copy of a duplicated evaluation is discarded
+                    if index not in started:
+                        continue
+
+                    for other in started.pop(index)[1]:
+                        if other != id:
+                            logging.info("Cancelling duplicate evaluation of input %d on worker %d", index, other)
+                            self.cancel(other, index)
+
+                    self.times.add(seconds)
+
+                outstanding -= 1
+
+                if error is not None:
+                    if getattr(error[1], "remote_traceback", None):
+                        logging.error("Evaluation failed on worker %d:\n%s", id, error[1].remote_traceback)
+
+                    raise error[0], error[1], error[2]
+
+                if self.adaptive:
+                    self.cost_model.add(running[index], seconds)
+
+                running.pop(index, None)
+
+                if ordered:
+                    completed[index] = env
+
+                    while next_index in completed:
+                        yield completed.pop(next_index)
+                        next_index += 1
+                else:
+                    yield env
+        finally:
+            self.stop_workers()
+
+
+    def _speculate(self, queues, load, running, started):
+        if self.times.count < self.min_samples:
+            return
+
+        threshold = self.speculate*self.times.percentile(95)
+        now = time.time()
+        idle = [id for id in range(len(queues)) if load[id] == 0]
+
+        for index, (start, ids) in sorted(started.iteritems(), key=lambda item: item[1][0]):
+            if not idle:
+                break
+
+            if len(ids) == 1 and now - start > threshold:
+                id = idle.pop()
+                logging.info("Input %d running for %.1f seconds, duplicating on worker %d", index, now - start, id)
+                queues[id].put((index, running[index]))
+                load[id] += 1
+                ids.append(id)
+
+
+class ProcessBackend(PoolBackend):
+    '''
+    Evaluates the inputs across a pool of worker processes.  Each process runs
+    its own copy of the start and complete tasks, so every worker has its own
+    Execute child, Connect socket, etc.
+
+    Results never contain the worker's base environment, and fields that can
+    not be pickled, such as PROCESS or STDIN, are dropped.
+    '''
+
+    def __init__(self, workers=None, prefetch=2, window=None, adaptive=False, lookahead=None, cost_model=None,
+                 speculate=None):
+        super(ProcessBackend, self).__init__(workers, prefetch, window, adaptive, lookahead, cost_model, speculate)
+
+    def start_workers(self, executioner, strip):
+        self.executioner = executioner
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        self.cancels = []
+        queues = []
+
+        for id in range(self.workers):
+            queue = multiprocessing.Queue()
+            cancels = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_process_worker,
+                                              args=(executioner, id, queue, self.results, cancels))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.cancels.append(cancels)
+            queues.append(queue)
+
+        self.queues = queues
+        logging.info("Started %d worker processes", self.workers)
+        return queues
+
+    def get_result(self, timeout):
+        (id, index, error, data, seconds, key) = self.results.get(timeout=timeout)
+        env = None if data is None else pickle.loads(data)
+
+        # results cached in memory by a worker are lost when it exits
+        if key is not None and key not in self.executioner.cache.memory:
+            self.executioner.cache.put(key, env)
+
+        # the worker's traceback is kept as text in remote_traceback
+        if error is not None:
+            error = (type(error), error, None)
+
+        return (id, index, error, env, seconds)
+
+    def check_workers(self):
+        for process in self.processes:
+            if not process.is_alive():
+                logging.error("Worker process terminated unexpectedly")
+                raise WorkerError("Worker process terminated unexpectedly")
+
+    def cancel(self, id, index):
+        self.cancels[id].put(index)
+
+    def stop_workers(self):
+        stopping = 0
+
+        for process, queue, cancels in zip(self.processes, self.queues, self.cancels):
+            if process.is_alive():
+                queue.put(None)
+                cancels.put(None)
+                stopping += 1
+
+        # each worker sends its measurements after running the complete tasks
+        if self.executioner.profiler is not None:
+            while stopping > 0:
+                try:
+                    (id, index, error, data, seconds, key) = self.results.get(timeout=5)
+                except Empty:
+                    break
+
+                if index is None:
+                    self.executioner.profiler.merge(pickle.loads(data))
+                    stopping -= 1
+
+        for process in self.processes:
+            process.join(5)
+
+            if process.is_alive():
+                process.terminate()
+
+
+class ThreadBackend(PoolBackend):
+    '''
+    Evaluates the inputs across a pool of threads, which is well suited for
+    tasks that spend most of their time waiting on processes or sockets.  Each
+    thread runs its own copy of the start and complete tasks, except for tasks
+    declared with Task.share(), which run once and whose results are visible to
+    all threads.
+    '''
+
+    def __init__(self, workers=None, prefetch=2, window=None, adaptive=False, lookahead=None, cost_model=None,
+                 speculate=None):
+        super(ThreadBackend, self).__init__(workers, prefetch, window, adaptive, lookahead, cost_model, speculate)
+
+    def start_workers(self, executioner, strip):
+        self.executioner = executioner
+        self.locks = {}
+
+        for task in executioner.start_tasks + executioner.tasks + executioner.complete_tasks + executioner.error_tasks:
+            if task.shared is not None and task.shared not in self.locks:
+                self.locks[task.shared] = threading.Lock()
+
+        # run the shared start tasks once, keeping only the fields they set
+        self.base_env = {}
+        executioner._initialize(self.base_env)
+        initial_env = dict(self.base_env)
+
+        for index, task in enumerate(executioner.start_tasks):
+            if task.shared is not None:
+                executioner._call("start", index, task, self.base_env)
+
+        shared_env = dict((k, v) for k, v in self.base_env.iteritems()
+                          if k not in initial_env or initial_env[k] is not v)
+
+        self.results = Queue()
+        self.threads = []
+        queues = []
+
+        for id in range(self.workers):
+            queue = Queue()
+            worker = Worker(executioner, shared_env, self.locks)
+            thread = threading.Thread(target=_thread_worker, args=(worker, id, queue, self.results, strip))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            queues.append(queue)
+
+        self.queues = queues
+        logging.info("Started %d worker threads", self.workers)
+        return queues
+
+    def get_result(self, timeout):
+        return self.results.get(timeout=timeout)
+
+    def check_workers(self):
+        for thread in self.threads:
+            if not thread.is_alive():
+                logging.error("Worker thread terminated unexpectedly")
+                raise WorkerError("Worker thread terminated unexpectedly")
+
+    def cancel(self, id, index):
+        utils.get_reaper().cancel((id, index))
+
+    def stop_workers(self):
+        for queue in self.queues:
+            queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        for index, task in enumerate(self.executioner.complete_tasks):
+            if task.shared is not None:
+                self.executioner._call("complete", index, task, self.base_env)
+
+
+class PipelinedBackend(Backend):
+    '''
+    Streams the inputs through the single process started by the start tasks,
+    writing up to window inputs to its STDIN before reading back the results.
+    The tasks are split after the last WriteInput.  A writer thread runs the
+    tasks up to and including the WriteInput for each input, while the
+    remaining tasks, such as ParseLine, read the output and are matched back
+    to their inputs in order.  Inputs are handed from the writer to the reader
+    in groups of batch inputs, and STDIN is flushed once per group.  The
+    writer waits once window inputs are outstanding, and since the output is
+    read concurrently, neither pipe can fill up and deadlock.
+
+    The model must produce its output for each input in the order the inputs
+    were written, so results are always returned in order.  The number of
+    workers is ignored.
+    '''
+
+    def __init__(self, workers=1, window=256, batch=32):
+        super(PipelinedBackend, self).__init__()
+        self.window = window
+        self.batch = min(batch, window)
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        split = 0
+
+        for i, task in enumerate(executioner.tasks):
+            if isinstance(task, WriteInput):
+                split = i + 1
+
+        if split == 0:
+            raise ValueError("The pipelined backend requires a WriteInput task")
+
+        if not executioner.running:
+            executioner.start()
+
+        read_tasks = executioner.tasks[split:]
+        pending = Queue()
+        slots = threading.Semaphore(max(1, self.window // self.batch))
+        stop = threading.Event()
+
+        writer = threading.Thread(target=_pipeline_writer,
+                                  args=(executioner, executioner.tasks[:split], inputs,
+                                        self.batch, pending, slots, stop))
+        writer.daemon = True
+        writer.start()
+
+        try:
+            while True:
+                (group, error) = pending.get()
+
+                for (env, ok) in group:
+                    try:
+                        if ok:
+                            executioner._run(env, read_tasks, offset=split)
+                    finally:
+                        executioner._cleanup(env, executioner.env)
+
+                    yield strip_env(env, executioner.env) if strip else env
+
+                if error is not None:
+                    raise error
+
+                if len(group) < self.batch:
+                    break
+
+                slots.release()
+        finally:
+            stop.set()
+            slots.release()
+
+
+class BatchBackend(Backend):
+    '''
+    Evaluates the inputs in chunks of batch inputs.  Each task runs once per
+    chunk through Task.run_batch, so tasks supporting batches, such as
+    EvaluateOctaveFunction(vectorized=True), can evaluate the whole chunk
+    with a single call.  Other tasks run separately for each input.  If a
+    batch fails, the fields it set are discarded and the task is run again
+    separately for each input, so that only the failing inputs invoke the
+    error tasks.
+
+    Results are always returned in order, and the number of workers is
+    ignored.
+    '''
+
+    def __init__(self, workers=1, batch=256):
+        super(BatchBackend, self).__init__()
+        self.batch = batch
+
+    def evaluate(self, executioner, inputs, ordered=True, strip=False):
+        if not executioner.running:
+            executioner.start()
+
+        chunk = []
+
+        for input in inputs:
+            chunk.append(input)
+
+            if len(chunk) == self.batch:
+                for env in self._evaluate_chunk(executioner, chunk):
+                    yield strip_env(env, executioner.env) if strip else env
+
+                chunk = []
+
+        for env in self._evaluate_chunk(executioner, chunk):
+            yield strip_env(env, executioner.env) if strip else env
+
+    def _evaluate_chunk(self, executioner, inputs):
+        envs = []
+
+        for input in inputs:
+            env = dict()
+            env.update(executioner.env)
+            env.update(input)
+            envs.append(env)
+
+        ok = [True]*len(envs)
+
+        try:
+            for index, task in enumerate(executioner.tasks):
+                active = [env for (env, good) in zip(envs, ok) if good]
+
+                if not active:
+                    break
+
+                if len(active) > 1 and task.supports_batch():
+                    saved = [dict(env) for env in active]
+
+                    try:
+                        executioner._call_batch(index, task, active)
+                        continue
+                    except Exception as ex:
+                        logging.warning("Batch of %d inputs failed in %s (%s), evaluating separately",
+                                        len(active), type(task).__name__, ex)
+
+                    # undo the failed batch, returning anything it leased
+                    for env, copy in zip(active, saved):
+                        executioner._cleanup(env, copy)
+                        env.clear()
+                        env.update(copy)
+
+                for i, env in enumerate(envs):
+                    if ok[i]:
+                        ok[i] = executioner._run(env, [task], offset=index)
+        finally:
+            for env in envs:
+                executioner._cleanup(env, executioner.env)
+
+        return envs
+
+
+class _DeferredFlush(object):
+    '''
+    Wraps STDIN so WriteInput's flush is deferred until the pipelined backend
+    hands a group of inputs to the reader, avoiding one write call per input.
+    '''
+
+    def __init__(self, stream):
+        super(_DeferredFlush, self).__init__()
+        self.stream = stream
+        self.write = stream.write
+
+    def flush(self):
+        pass
+
+def _pipeline_writer(executioner, tasks, inputs, batch, pending, slots, stop):
+    stdin = executioner.env.get("STDIN")
+    deferred = _DeferredFlush(stdin) if stdin is not None else None
+    group = []
+
+    try:
+        slots.acquire()
+
+        for input in inputs:
+            if stop.is_set():
+                return
+
+            env = dict()
+            env.update(executioner.env)
+            env.update(input)
+
+            if deferred is not None:
+                env["STDIN"] = deferred
+
+            ok = executioner._run(env, tasks)
+
+            if env.get("STDIN") is deferred:
+                env["STDIN"] = stdin
+
+            group.append((env, ok))
+
+            if len(group) == batch:
+                _flush(stdin)
+                pending.put((group, None))
+                group = []
+                slots.acquire()
+
+        _flush(stdin)
+        pending.put((group, None))
+    except Exception as ex:
+        pending.put((group, ex))
+
+def _flush(stream):
+    if stream is not None:
+        stream.flush()
+
+def strip_env(env, base_env):
+    '''
+    Returns a copy of env without the entries inherited unchanged from
+    base_env.
+    '''
+    return dict((k, v) for k, v in env.iteritems() if k not in base_env or base_env[k] is not v)
+
+def _portable(env, base_env):
+    '''
+    Removes the worker's base environment and any values that can not be
+    pickled, returning the pickled result.
+    '''
+    result = strip_env(env, base_env)
+
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        for key in result.keys():
+            try:
+                pickle.dumps(result[key], pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                del result[key]
+
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+def _portable_error(ex, trace=None):
+    '''
+    Returns the exception if it can be pickled and unpickled, otherwise a
+    WorkerError describing it, so the parent can always raise it.  The
+    worker's formatted traceback, if given, is stored in remote_traceback.
+    '''
+    try:
+        pickle.loads(pickle.dumps(ex, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        ex = WorkerError(repr(ex))
+
+    if trace is not None:
+        try:
+            ex.remote_traceback = trace
+        except AttributeError:
+            pass
+
+    return ex
+
+def _process_worker(executioner, id, queue, results, cancels):
+    # forked workers inherit the parent's random state, reseed so each worker
+    # picks a different PORT
+    random.seed()
+    worker = Worker(executioner)
+
+    canceller = threading.Thread(target=_process_canceller, args=(id, cancels))
+    canceller.daemon = True
+    canceller.start()
+
+    # discard the measurements copied from the parent
+    if executioner.profiler is not None:
+        executioner.profiler.reset()
+
+    try:
+        while True:
+            job = queue.get()
+
+            if job is None:
+                break
+
+            (index, input) = job
+            start = time.time()
+
+            try:
+                # processes started by the start tasks belong to the worker,
+                # not to the evaluation that happens to start the worker
+                if not worker.running:
+                    worker.start()
+
+                utils.set_owner((id, index))
+                env = worker.evaluate(input)
+                key = None
+
+                # send back the key of results cached in memory, so the parent
+                # stores them too, results persisted to sqlite are shared
+                if executioner.cache is not None and executioner.cache.path is None:
+                    key = executioner.cache.key(executioner._fingerprint, input)
+
+                    if key not in executioner.cache.memory:
+                        key = None
+
+                results.put((id, index, None, _portable(env, worker.env), time.time() - start, key))
+            except Exception as ex:
+                # unpicklable errors would be dropped by the queue, leaving
+                # the parent waiting forever
+                results.put((id, index, _portable_error(ex, traceback.format_exc()), None, time.time() - start, None))
+            finally:
+                utils.set_owner(None)
+    finally:
+        if worker.running:
+            worker.shutdown()
+
+        if executioner.profiler is not None:
+            results.put((id, None, None, pickle.dumps(executioner.profiler, pickle.HIGHEST_PROTOCOL), 0.0, None))
+
+def _process_canceller(id, cancels):
+    while True:
+        index = cancels.get()
+
+        if index is None:
+            break
+
+        utils.get_reaper().cancel((id, index))
+
+def _thread_worker(worker, id, queue, results, strip):
+    try:
+        while True:
+            job = queue.get()
+
+            if job is None:
+                break
+
+            (index, input) = job
+            start = time.time()
+
+            try:
+                # processes started by the start tasks belong to the worker,
+                # not to the evaluation that happens to start the worker
+                if not worker.running:
+                    worker.start()
+
+                utils.set_owner((id, index))
+                env = worker.evaluate(input)
+                results.put((id, index, None, strip_env(env, worker.env) if strip else env, time.time() - start))
+            except Exception:
+                results.put((id, index, sys.exc_info(), None, time.time() - start))
+            finally:
+                utils.set_owner(None)
+    finally:
+        if worker.running:
+            worker.shutdown()
+
+BACKENDS = { "serial" : SerialBackend,
+             "process" : ProcessBackend,
+             "thread" : ThreadBackend,
+             "pipelined" : PipelinedBackend,
+             "batch" : BatchBackend }
+
+def create_backend(name, workers=1):
+    '''
+    Creates the backend with the given name.
+    '''
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend " + str(name) + ", expected one of " + str(sorted(BACKENDS.keys())))
+
+    return BACKENDS[name](workers)
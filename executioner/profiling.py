@@ -0,0 +1,325 @@
+'''
+Per-task timing and profiling.
+'''
+
+import sys
+import math
+import time
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import resource
+
+    # RUSAGE_THREAD is only exposed by Python 3, but is supported by Linux
+    if hasattr(resource, "RUSAGE_THREAD"):
+        _RUSAGE_THREAD = resource.RUSAGE_THREAD
+    elif sys.platform.startswith("linux"):
+        _RUSAGE_THREAD = 1
+    else:
+        _RUSAGE_THREAD = None
+except ImportError:
+    _RUSAGE_THREAD = None
+
+# the record of the task running on the current thread, see add_bytes
+_current = threading.local()
+
+def cpu_time():
+    '''
+    Returns the CPU time used by the current thread, or by the process on
+    platforms that can not measure threads.
+    '''
+    if _RUSAGE_THREAD is not None:
+        usage = resource.getrusage(_RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    else:
+        return time.clock()
+
+def add_bytes(count):
+    '''
+    Records that the running task moved the given number of bytes, such as
+    the input written to a process or the data received from a socket.  Does
+    nothing unless profiling is enabled.
+    '''
+    record = getattr(_current, "record", None)
+
+    if record is not None:
+        record.bytes += count
+
+
+class Histogram(object):
+    '''
+    Distribution of non-negative values.  Values are counted in logarithmic
+    buckets, each 2% wider than the last, so percentiles are accurate to
+    within 2% using constant memory regardless of the number of values.
+    '''
+
+    RATIO = 1.02
+
+    LOG_RATIO = math.log(RATIO)
+
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.zeros = 0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = int(math.floor(math.log(value) / Histogram.LOG_RATIO))
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        """
+        Adds the values counted by another histogram.
+        """
+        if other.count == 0:
+            return
+
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.zeros += other.zeros
+
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def percentile(self, q):
+        """
+        Returns the approximate q-th percentile, where 0 <= q <= 100, or None
+        if no values were added.
+        """
+        if self.count == 0:
+            return None
+
+        rank = max(1, int(math.ceil(q / 100.0 * self.count)))
+        seen = self.zeros
+
+        if seen >= rank:
+            return 0.0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+
+            if seen >= rank:
+                value = Histogram.RATIO**(index + 0.5)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def summary(self):
+        """
+        Returns a dict with the count, total, mean, min, max and the 50th, 95th
+        and 99th percentiles.
+        """
+        return OrderedDict([("count", self.count),
+                            ("total", self.total),
+                            ("mean", self.total / self.count if self.count else None),
+                            ("min", self.min),
+                            ("max", self.max),
+                            ("p50", self.percentile(50)),
+                            ("p95", self.percentile(95)),
+                            ("p99", self.percentile(99))])
+
+
+class TaskProfile(object):
+    '''
+    The wall time, CPU time and bytes moved by one task across evaluations.
+    '''
+
+    def __init__(self, phase, index, name):
+        super(TaskProfile, self).__init__()
+        self.phase = phase
+        self.index = index
+        self.name = name
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.bytes = Histogram()
+
+    def merge(self, other):
+        self.wall.merge(other.wall)
+        self.cpu.merge(other.cpu)
+        self.bytes.merge(other.bytes)
+
+    def summary(self):
+        return OrderedDict([("phase", self.phase),
+                            ("index", self.index),
+                            ("task", self.name),
+                            ("wall", self.wall.summary()),
+                            ("cpu", self.cpu.summary()),
+                            ("bytes", self.bytes.summary())])
+
+
+class _Record(object):
+
+    def __init__(self):
+        super(_Record, self).__init__()
+        self.bytes = 0
+
+
+class Profiler(object):
+    '''
+    Records the wall time, CPU time and bytes moved by each task every time
+    it runs.  Tasks are identified by their phase ("start", "evaluate",
+    "complete" or "error") and position, so the profiles recorded by worker
+    processes can be merged with the Executioner's.  CPU time is measured
+    for the calling thread only and excludes any processes started by the
+    task.
+    '''
+
+    PHASES = ["start", "evaluate", "error", "complete"]
+
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def call(self, phase, index, task, env):
+        """
+        Runs the task, recording its measurements.
+        """
+        self._measure(phase, index, task, task.run, env)
+
+    def call_batch(self, phase, index, task, envs):
+        """
+        Runs the task on a batch of environments (see Task.run_batch),
+        recording the measurements of the whole batch as one run.
+        """
+        self._measure(phase, index, task, task.run_batch, envs)
+
+    def _measure(self, phase, index, task, function, argument):
+        record = _Record()
+        previous = getattr(_current, "record", None)
+        _current.record = record
+        start_wall = time.time()
+        start_cpu = cpu_time()
+
+        try:
+            function(argument)
+        finally:
+            cpu = cpu_time() - start_cpu
+            wall = time.time() - start_wall
+            _current.record = previous
+            self.add(phase, index, task, wall, cpu, record.bytes)
+
+    def call_async(self, phase, index, task, env):
+        """
+        Runs the task on the AsyncExecutioner's event loop, recording its
+        measurements.  The CPU time only includes the steps of this task, not
+        the other evaluations run while it waits.
+        """
+        record = _Record()
+        start_wall = time.time()
+        cpu = 0.0
+
+        try:
+            events = None
+
+            while True:
+                previous = getattr(_current, "record", None)
+                _current.record = record
+                start_cpu = cpu_time()
+
+                try:
+                    if events is None:
+                        events = iter(task.run_async(env))
+
+                    event = next(events)
+                except StopIteration:
+                    break
+                finally:
+                    cpu += cpu_time() - start_cpu
+                    _current.record = previous
+
+                yield event
+        finally:
+            self.add(phase, index, task, time.time() - start_wall, cpu, record.bytes)
+
+    def add(self, phase, index, task, wall, cpu, bytes):
+        """
+        Records one run of the task.
+        """
+        with self.lock:
+            profile = self.profiles.get((phase, index))
+
+            if profile is None:
+                profile = TaskProfile(phase, index, type(task).__name__)
+                self.profiles[(phase, index)] = profile
+
+            profile.wall.add(wall)
+            profile.cpu.add(cpu)
+            profile.bytes.add(bytes)
+
+    def merge(self, other):
+        """
+        Adds the measurements recorded by another profiler, such as one from a
+        worker process.
+        """
+        with self.lock:
+            for key, other_profile in other.profiles.iteritems():
+                profile = self.profiles.get(key)
+
+                if profile is None:
+                    profile = TaskProfile(other_profile.phase, other_profile.index, other_profile.name)
+                    self.profiles[key] = profile
+
+                profile.merge(other_profile)
+
+    def reset(self):
+        """
+        Discards all measurements.
+        """
+        with self.lock:
+            self.profiles = {}
+
+    def report(self):
+        """
+        Returns a list containing the summary of each task, ordered by phase
+        and position.  Each summary is a dict with the phase, index, task
+        name and the wall, cpu and bytes histogram summaries.
+        """
+        with self.lock:
+            keys = sorted(self.profiles, key=lambda k: (Profiler.PHASES.index(k[0]), k[1]))
+            return [self.profiles[key].summary() for key in keys]
+
+    def to_json(self, file=None, indent=2):
+        """
+        Exports the report as JSON.
+
+        Args:
+            file: The path of the file to write, or None to return the JSON
+                string.
+            indent: The indentation of the JSON output.
+        """
+        content = json.dumps(self.report(), indent=indent)
+
+        if file is None:
+            return content
+
+        with open(file, "w") as f:
+            f.write(content)
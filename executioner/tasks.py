@@ -4,25 +4,90 @@ Created on Jul 30, 2015
 @author: dhadka
 '''
 import os
+import re
+import ast
 import logging
 import subprocess
 import shlex
 import utils
+import aio
+import profiling
 import tempfile
 import socket
 import time
-from exceptions import TaskError
-from threading import Thread
+import errno
+import threading
+import select
+import shutil
+import functools
+from exceptions import TaskError, PoolTimeout
 from StringIO import StringIO
 
+_logger = logging.getLogger()
+
 class Task(object):
     '''
     Generic tasks, subclasses must override run(env).
     '''
     
+    # Name of the state shared by all workers that this task uses, see share()
+    shared = None
+    
+    # Set to False by quiet() to disable this task's log messages
+    _verbose = True
+    
     def __init__(self):
         super(Task, self).__init__()
         
+    def share(self, resource="shared"):
+        """
+        Declares that this task uses state shared by all workers.
+        
+        By default, each worker in the threaded backend runs its own copy of
+        the start tasks.  A shared start task instead runs once and its
+        results are visible to all workers, and per-evaluation tasks sharing
+        the same resource never run concurrently.  Consecutive tasks sharing
+        the same resource run as a single unit, so a WriteInput followed by a
+        ParseLine is never interleaved with another worker's.  Other backends
+        ignore this setting.
+        
+        Args:
+            resource: The name of the shared resource.
+            
+        Returns:
+            This task.
+        """
+        self.shared = resource
+        return self
+    
+    def quiet(self):
+        """
+        Disables the INFO messages logged by this task, which is useful for
+        tasks that run for every evaluation.  Errors are still logged.
+        
+        Returns:
+            This task.
+        """
+        self._verbose = False
+        return self
+    
+    def log(self, message, *args):
+        """
+        Logs an INFO message.
+        
+        The message is only formatted if INFO messages are enabled and the
+        task is not quiet, in which case each %s in the message is replaced
+        by the corresponding argument, abbreviated by utils.abbreviate.
+        Arguments should therefore be passed as is rather than converted to
+        strings beforehand.
+        
+        Args:
+            message: The message, in %-format.
+            args: The values substituted into the message.
+        """
+        if self._verbose and _logger.isEnabledFor(logging.INFO):
+            _logger.info(message, *[utils.Abbreviated(arg) for arg in args])
+        
     def run(self, env):
         """
         Runs the task.
@@ -36,6 +101,45 @@ class Task(object):
         """
         raise NotImplementedError("Tasks must define the run method")
     
+    def run_async(self, env):
+        """
+        Runs the task on the AsyncExecutioner's event loop.
+        
+        Returns an iterable of the events (see aio) the task waits on.  The
+        loop resumes the task once each event occurs, running other
+        evaluations in the meantime.  By default, calls run and returns
+        without waiting, which is appropriate for tasks that do not block.
+        
+        Args:
+            env: A dict storing the current Executioner environment.
+        """
+        self.run(env)
+        return ()
+    
+    def run_batch(self, envs):
+        """
+        Runs the task on a batch of environments, used by the batch backend.
+        
+        Tasks that can process many inputs at once, such as a vectorized
+        model, override this method and supports_batch.  By default, calls
+        run for each environment.  If this method fails, the batch backend
+        discards the fields it set and runs the task again separately for
+        each environment.
+        
+        Args:
+            envs: The list of environments, one per input.
+        """
+        for env in envs:
+            self.run(env)
+            
+    def supports_batch(self):
+        """
+        Returns True if run_batch processes the inputs together, so the batch
+        backend calls run_batch instead of running each input separately.
+        By default, returns True if the task overrides run_batch.
+        """
+        return type(self).run_batch.__func__ is not Task.run_batch.__func__
+    
     
 class CreateTempDir(Task):
     '''
@@ -47,10 +151,10 @@ class CreateTempDir(Task):
         super(CreateTempDir, self).__init__()
         
     def run(self, env):
-        logging.info("Creating temporary directory")
+        self.log("Creating temporary directory")
         dir = tempfile.mkdtemp()
         env["WORK_DIR"] = dir
-        logging.info("Successfully created temporary directory: " + dir)
+        self.log("Successfully created temporary directory: %s", dir)
         
         
 class DeleteTempDir(Task):
@@ -67,9 +171,9 @@ class DeleteTempDir(Task):
             raise TaskError("WORK_DIR not defined")
         
         dir = env["WORK_DIR"]
-        logging.info("Deleting temporary directory: " + dir)
+        self.log("Deleting temporary directory: %s", dir)
         utils.remove(dir)
-        logging.info("Successfully deleted temporary directory")
+        self.log("Successfully deleted temporary directory")
         
         
 class SetWorkDir(Task):
@@ -82,9 +186,9 @@ class SetWorkDir(Task):
         self.dir = dir
         
     def run(self, env):
-        logging.info("Setting work directory")
+        self.log("Setting work directory")
         env["WORK_DIR"] = self.dir
-        logging.info("Successfully set work directory: " + self.dir)   
+        self.log("Successfully set work directory: %s", self.dir)
         
         
 class Delete(Task):
@@ -97,7 +201,7 @@ class Delete(Task):
         self.path = path
         
     def run(self, env):
-        logging.info("Deleting " + str(self.path))
+        self.log("Deleting %s", self.path)
         
         if isinstance(self.path, list) or isinstance(self.path, tuple):
             for p in self.path:
@@ -109,12 +213,34 @@ class Delete(Task):
 class Copy(Task):
     '''
     Copies the contents of the given folder to WORK_DIR.
+    
+    With snapshot=True, the folder is scanned once, when first copied, and
+    files containing ${keyword} fields are kept in memory.  Each copy then
+    only links the remaining static files (see utils.link for the available
+    methods) and leaves the templates to the following Substitute task, which
+    writes them once with the keywords replaced.  Since hard links share the
+    original file, the model must not modify the static files in place.
     '''
     
-    def __init__(self, fromDir, toDir=None):
+    def __init__(self, fromDir, toDir=None, snapshot=False, method="hardlink"):
         super(Copy, self).__init__()
         self.fromDir = fromDir
         self.toDir = toDir
+        self.snapshot = snapshot
+        self.method = method
+        self._lock = threading.Lock()
+        self._snapshot = None
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_snapshot"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._snapshot = None
         
     def run(self, env):
         toDir = self.toDir
@@ -125,14 +251,26 @@ class Copy(Task):
                 raise TaskError("WORK_DIR not defined")
             toDir = env["WORK_DIR"]
         
-        logging.info("Copying " + self.fromDir + " to " + toDir)
-        utils.copytree(self.fromDir, toDir)
-        logging.info("Successfully copied folder contents")
+        self.log("Copying %s to %s", self.fromDir, toDir)
+        
+        if self.snapshot:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = utils.TemplateSnapshot(self.fromDir)
+                    
+            toDir = os.path.abspath(toDir)
+            self._snapshot.copy(toDir, self.method)
+            env["PENDING_TEMPLATES"] = env.get("PENDING_TEMPLATES", []) + [(toDir, self._snapshot)]
+        else:
+            utils.copytree(self.fromDir, toDir)
+            
+        self.log("Successfully copied folder contents")
         
 
 class Substitute(Task):
     '''
     Substitutes ${keyword} fields in all files with their assigned values.
+    Templates left by Copy(snapshot=True) are written from memory.
     '''
     
     def __init__(self, folder=None, include="*", exclude=None):
@@ -150,28 +288,76 @@ class Substitute(Task):
                 raise TaskError("WORK_DIR not defined")
             folder = env["WORK_DIR"]
             
-        logging.info("Substituting keywords in " + folder)
-        utils.substitutetree(folder, env, self.include, self.exclude)
-        logging.info("Successfully substituted keywords")
+        self.log("Substituting keywords in %s", folder)
+        folder = os.path.abspath(folder)
+        skip = None
+        pending = []
+        
+        for (toDir, snapshot) in env.get("PENDING_TEMPLATES", []):
+            contains = toDir == folder or toDir.startswith(os.path.join(folder, ""))
+            inside = folder.startswith(os.path.join(toDir, ""))
+            
+            if contains or inside:
+                snapshot.render(toDir, env, self.include, self.exclude, folder)
+                skip = snapshot.paths(toDir) if skip is None else skip | snapshot.paths(toDir)
+                
+            # templates outside of the folder are left for a later Substitute
+            if not contains:
+                pending.append((toDir, snapshot))
+                
+        if pending:
+            env["PENDING_TEMPLATES"] = pending
+        else:
+            env.pop("PENDING_TEMPLATES", None)
+            
+        utils.substitutetree(folder, env, self.include, self.exclude, skip)
+        self.log("Successfully substituted keywords")
         
         
 class Execute(Task):
     '''
     Executes a program.
+    
+    If warm is a WarmPool, the evaluation is instead sent to one of the
+    pool's running model processes, so the same tasks run the model either
+    once per evaluation or as a warm process.  STDERR is not available in
+    warm mode.
+    
+    The exit code is collected by the process reaper and must be read from
+    PROCESS_STATUS (see CheckExitCode).  Do not call env["PROCESS"].wait()
+    or poll(), which race with the reaper and may report an exit code of 0.
     '''
     
-    def __init__(self, command, timeout=None, ignore_stdout=False, ignore_stderr=False):
+    def __init__(self, command, timeout=None, ignore_stdout=False, ignore_stderr=False, warm=None):
         super(Execute, self).__init__()
         self.command = command
         self.timeout = timeout
         self.ignore_stdout = ignore_stdout
         self.ignore_stderr = ignore_stderr
+        self.warm = warm
         
     def run(self, env):
         command = utils.substitute(self.command, env)
         
-        logging.info("Executing command " + command)
-        process = subprocess.Popen(shlex.split(command),
+        if self.warm is not None:
+            self.log("Sending evaluation to warm process %s", command)
+            
+            try:
+                process = self.warm.acquire(self.timeout, (command,))
+            except PoolTimeout:
+                logging.error("Timed out waiting for a warm process")
+                raise TaskError("Timed out waiting for a warm process")
+            
+            exchange = _WarmExchange(self.warm, process, self.timeout)
+            env["PROCESS"] = exchange
+            env["STDIN"] = exchange
+            env["STDOUT"] = exchange
+            env["PROCESS_STATUS"] = exchange
+            env["CLEANUP"] = env.get("CLEANUP", []) + [exchange.abandon]
+            return
+        
+        self.log("Executing command %s", command)
+        process = subprocess.Popen(shlex.split(command), bufsize=-1,
                                    stdin=subprocess.PIPE,
                                    stdout=None if self.ignore_stdout else subprocess.PIPE,
                                    stderr=None if self.ignore_stderr else subprocess.PIPE)
@@ -185,9 +371,22 @@ class Execute(Task):
         if not self.ignore_stderr:
             env["STDERR"] = process.stderr
         
-        Thread(target=utils.process_monitor, args=(process,), kwargs={ "timeout":self.timeout }).start()
+        env["PROCESS_STATUS"] = utils.get_reaper().track(process, self.timeout)
 
-        logging.info("Successfully executed command")
+        self.log("Successfully executed command")
+        
+    def run_async(self, env):
+        self.run(env)
+        
+        # warm exchanges block
+        if self.warm is not None:
+            return ()
+        
+        for name in ["STDIN", "STDOUT", "STDERR"]:
+            if name in env and env[name] is getattr(env["PROCESS"], name.lower()):
+                env[name] = aio.AsyncStream(env[name])
+                
+        return ()
         
 
 class CheckExitCode(Task):
@@ -204,17 +403,32 @@ class CheckExitCode(Task):
             self.ok = ok
         
     def run(self, env):
-        if "PROCESS" not in env:
+        if "PROCESS_STATUS" not in env:
             logging.error("PROCESS not set, call Execute before CheckExitCode")
             raise TaskError("PROCESS not set, call Execute before CheckExitCode")
         
-        env["EXIT_CODE"] = env["PROCESS"].wait()
+        status = env["PROCESS_STATUS"]
+        env["EXIT_CODE"] = status.wait()
+        
+        if status.timed_out:
+            logging.error("Execute failed, process exceeded timeout limit and was killed")
+            raise TaskError("Execute failed, process exceeded timeout limit and was killed")
+        
+        if status.cancelled:
+            logging.error("Execute failed, process was cancelled")
+            raise TaskError("Execute failed, process was cancelled")
         
         if env["EXIT_CODE"] not in self.ok:
             logging.error("Execute failed, expected exit code " + str(self.ok) + ", received " + str(env["EXIT_CODE"]))
             raise TaskError("Execute failed, expected exit code " + str(self.ok) + ", received " + str(env["EXIT_CODE"]))
         
-        logging.info("Exit code ok")
+        self.log("Exit code ok")
+        
+    def run_async(self, env):
+        if isinstance(env.get("PROCESS_STATUS"), utils.ProcessStatus):
+            yield aio.ProcessExit(env["PROCESS_STATUS"])
+            
+        self.run(env)
         
         
 class WriteInput(Task):
@@ -233,10 +447,27 @@ class WriteInput(Task):
         
         formatted_input = utils.substitute(self.input, env)
         
-        logging.info("Sending input to stdin: " + formatted_input)
+        self.log("Sending input to stdin: %s", formatted_input)
         stdin = env["STDIN"]
         stdin.write(formatted_input)
         stdin.flush()
+        profiling.add_bytes(len(formatted_input))
+        
+    def run_async(self, env):
+        stdin = env.get("STDIN")
+        
+        if not isinstance(stdin, aio.AsyncStream):
+            self.run(env)
+            return
+        
+        formatted_input = utils.substitute(self.input, env)
+        
+        self.log("Sending input to stdin: %s", formatted_input)
+        
+        for event in stdin.write_all(formatted_input):
+            yield event
+            
+        profiling.add_bytes(len(formatted_input))
         
     
         
@@ -266,12 +497,16 @@ class WriteFile(Task):
         folder = env["WORK_DIR"]
         absfile = os.path.join(folder, self.file)
         
-        logging.info("Creating file " + str(absfile))
+        self.log("Creating file %s", absfile)
+        
+        content = utils.substitute(self.content, env)
         
         with open(absfile, 'w') as file:
-            file.write(utils.substitute(self.content, env))
+            file.write(content)
+            
+        profiling.add_bytes(len(content))
         
-        logging.info("Successfully created file")
+        self.log("Successfully created file")
         
         
 class WriteJSON(Task):
@@ -337,8 +572,9 @@ class ParseLine(Task):
     def run(self, env):
         stdout = env["STDOUT"]
         line = stdout.readline()
+        profiling.add_bytes(len(line))
         
-        logging.info("Parsing line " + line)
+        self.log("Parsing line %s", line)
         values = map(self.type, line.split(self.delimiters))
         
         if isinstance(self.name, list):
@@ -350,6 +586,15 @@ class ParseLine(Task):
                 env.update({ name : values[i] })
         else: 
             env.update({ self.name : values })
+            
+    def run_async(self, env):
+        stdout = env.get("STDOUT")
+        
+        if isinstance(stdout, aio.AsyncStream):
+            for event in stdout.read_lines(1):
+                yield event
+                
+        self.run(env)
         
         
         
@@ -373,7 +618,7 @@ class Format(Task):
         if new_name is None:
             new_name = self.name
         
-        logging.info("Formatting " + self.name)
+        self.log("Formatting %s", self.name)
         old_val = env[self.name]
         
         if callable(self.format):
@@ -381,7 +626,7 @@ class Format(Task):
         else:
             env[new_name] = self.format.format(old_val)
             
-        logging.info("Saved " + new_name + " as " + str(env[new_name]))
+        self.log("Saved %s as %s", new_name, env[new_name])
         
 
 class Return(Task):
@@ -403,78 +648,368 @@ class Return(Task):
 class ParseXML(Task):
     '''
     Parses an XML file and reads values.
+    
+    Each XPath expression is compiled once by get().  If lxml is not
+    installed, ElementTree is used instead, which supports the subset of
+    XPath implemented by findall, along with a trailing /text() or /@name.
+    
+    With stream=True, the file is read incrementally with iterparse, so
+    large files are parsed in bounded memory.  Each expression must then
+    start with //tag (or .//tag) and is evaluated on each tag element once
+    it is parsed, after which the element is discarded.  The remainder of the
+    expression may only refer to the element and its descendants, for
+    example:
+    
+        //value[@name='y1']/text()
     '''
     
-    def __init__(self, file):
+    def __init__(self, file, stream=False):
         super(ParseXML, self).__init__()
         self.file = file
+        self.stream = stream
         self.fields = []
+        self._queries = []
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_queries"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._queries = [_XPathQuery(xpath, self.stream) for (xpath, key, conversion) in self.fields]
         
     def get(self, xpath, key, conversion=str):
         self.fields.append((xpath, key, conversion))
+        self._queries.append(_XPathQuery(xpath, self.stream))
         return self
         
     def run(self, env):
+        self.log("Parsing XML file %s", self.file)
+        
+        if self.stream:
+            matches = self._iterparse()
+        else:
+            tree = _xml_engine().parse(self.file)
+            matches = [query.evaluate(tree) for query in self._queries]
+        
+        for ((xpath, key, conversion), values) in zip(self.fields, matches):
+            self.log("Found %s matches for %s", len(values), xpath)
+            
+            if len(values) == 1:
+                env[key] = conversion(values[0])
+            else:
+                env[key] = map(conversion, values)
+                
+            self.log("Setting %s to %s", key, env[key])
+            
+    def _iterparse(self):
+        etree = _xml_engine()
+        queries = self._queries
+        matches = [[] for query in queries]
+        tags = set(query.tag for query in queries)
+        
+        # keep only the open ancestors and the requested elements, removing
+        # every other element from the tree once it is parsed
+        parents = []
+        depth = 0
+        
+        for (event, element) in etree.iterparse(self.file, events=("start", "end")):
+            selected = element.tag in tags or "*" in tags
+            
+            if event == "start":
+                parents.append(element)
+                depth += selected
+                continue
+            
+            parents.pop()
+            
+            if selected:
+                for (query, values) in zip(queries, matches):
+                    if query.tag == "*" or query.tag == element.tag:
+                        values.extend(query.evaluate(element))
+                        
+                depth -= 1
+                
+            if depth == 0:
+                element.clear()
+                
+                if parents:
+                    parents[-1].remove(element)
+        
+        return matches
+    
+    
+_xml_etree = None
+
+def _xml_engine():
+    '''
+    Returns lxml.etree, or the ElementTree module if lxml is not installed.
+    '''
+    global _xml_etree
+    
+    if _xml_etree is None:
         try:
             from lxml import etree
         except ImportError:
             logging.warn("Unable to import lxml, using ElementTree instead.  Some XPath functionality may be limited")
-            import ElementTree as etree
+            import xml.etree.cElementTree as etree
             
-        logging.info("Parsing XML file " + str(self.file))
-        
-        tree = etree.parse(self.file)
+        _xml_etree = etree
         
-        for (xpath,key,conversion) in self.fields:
-            values = tree.xpath(xpath)
-            logging.info("Found " + str(len(values)) + " matches for " + str(xpath))
+    return _xml_etree
+
+
+class _XPathQuery(object):
+    '''
+    A compiled ParseXML expression.  With stream=True, the expression is
+    split into the tag of the elements it selects and an expression evaluated
+    relative to each such element.
+    '''
+    
+    def __init__(self, xpath, stream=False, etree=None):
+        super(_XPathQuery, self).__init__()
+        self.etree = etree if etree is not None else _xml_engine()
+        self.tag = None
+        self.text = False
+        self.attribute = None
+        path = xpath
+        
+        if stream:
+            (self.tag, step, rest) = _split_xpath(xpath)
+            path = ("self::" if self._lxml() else "") + step + rest
             
-            if len(values) == 1:
-                env[key] = conversion(values[0] if isinstance(values[0], str) else values[0].text)
-            else:
-                env[key] = map(conversion, [value if isinstance(value, str) else value.text for value in values])
+        if self._lxml():
+            self.xpath = self.etree.XPath(path)
+        else:
+            # emulate the parts of XPath that ElementTree does not support
+            if path.endswith("/text()"):
+                path = path[:-len("/text()")]
+                self.text = True
+            elif "/@" in path and "/" not in path[path.rfind("/@")+2:]:
+                (path, self.attribute) = path.rsplit("/@", 1)
                 
-            logging.info("Setting " + key + " to " + str(env[key]))
+            if path.startswith("//"):
+                path = "." + path
                 
+            self.path = path
+            
+    def _lxml(self):
+        return hasattr(self.etree, "XPath")
+    
+    def evaluate(self, node):
+        """
+        Returns the list of values selected from the tree or element, where
+        selected elements are replaced by their text.
+        """
+        if self._lxml():
+            values = self.xpath(node)
+            
+            if not isinstance(values, list):
+                values = [values]
+        else:
+            path = self.path
+            
+            if self.tag is not None or path.startswith("/"):
+                # the path starts with the element itself, so search from a
+                # temporary parent
+                parent = self.etree.Element("parent")
+                parent.append(node.getroot() if hasattr(node, "getroot") else node)
+                node = parent
+                path = path.lstrip("/")
                 
+            values = node.findall(path)
+            
+            if self.attribute is not None:
+                return [value.get(self.attribute) for value in values if value.get(self.attribute) is not None]
+            
+        return [value.text if hasattr(value, "text") else value for value in values]
+    
+    
+def _split_xpath(xpath):
+    '''
+    Splits an expression of the form //tag[predicates]/rest into its tag,
+    the first step (tag[predicates]) and the rest.
+    '''
+    if xpath.startswith(".//"):
+        xpath = xpath[1:]
+        
+    if not xpath.startswith("//"):
+        logging.error("Streaming XPath expressions must start with //, received " + xpath)
+        raise TaskError("Streaming XPath expressions must start with //, received " + xpath)
+    
+    end = 2
+    
+    while end < len(xpath) and xpath[end] not in "/[":
+        end += 1
+        
+    tag = xpath[2:end]
+    depth = 0
+    
+    while end < len(xpath) and (depth > 0 or xpath[end] == "["):
+        if xpath[end] == "[":
+            depth += 1
+        elif xpath[end] == "]":
+            depth -= 1
+            
+        end += 1
+        
+    return (tag, xpath[2:end], xpath[end:])
+        
+        
 class ParseJSON(Task):
     '''
     Parses a JSON file and reads values.
+    
+    Each JSONPath expression is parsed once by get() and cached, as building
+    the parser is expensive.  With stream=True, the file is read
+    incrementally with ijson and only the values at the requested paths are
+    built, so large files are parsed in bounded memory.  Streaming supports
+    paths made of fields, indices and wildcards, such as root.y1[0] or
+    root.*.y2[*].
     '''
     
-    def __init__(self, file):
+    def __init__(self, file, stream=False):
         super(ParseJSON, self).__init__()
         self.file = file
+        self.stream = stream
         self.fields = []
+        self._paths = []
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_paths"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._paths = [self._compile(xpath) for (xpath, key, conversion) in self.fields]
         
     def get(self, xpath, key, conversion=str):
         self.fields.append((xpath, key, conversion))
+        self._paths.append(self._compile(xpath))
         return self
+    
+    def _compile(self, xpath):
+        expr = _compile_jsonpath(xpath)
+        return _jsonpath_steps(xpath, expr) if self.stream else expr
         
     def run(self, env):
-        import json
-        from jsonpath_rw import parse
-        logging.info("Parsing JSON file " + str(self.file))
+        self.log("Parsing JSON file %s", self.file)
         
         with open(self.file) as f:
-            content = json.load(f)
+            if self.stream:
+                matches = _stream_json(f, self._paths)
+            else:
+                import json
+                content = json.load(f)
+                matches = [[value.value for value in expr.find(content)] for expr in self._paths]
             
-            for (xpath,key,conversion) in self.fields:
-                expr = parse(xpath)
-                values = expr.find(content)
-                logging.info("Found " + str(len(values)) + " matches for " + str(xpath))
-                
-                if len(values) == 1:
-                    if isinstance(values[0].value, list):
-                        env[key] = map(conversion, values[0].value)
-                    else:
-                        env[key] = conversion(values[0].value)
+        for ((xpath, key, conversion), values) in zip(self.fields, matches):
+            self.log("Found %s matches for %s", len(values), xpath)
+            
+            if len(values) == 1:
+                if isinstance(values[0], list):
+                    env[key] = map(conversion, values[0])
                 else:
-                    env[key] = map(conversion, [value.value for value in values])
-                    
-                logging.info("Setting " + key + " to " + str(env[key]))
+                    env[key] = conversion(values[0])
+            else:
+                env[key] = map(conversion, values)
+                
+            self.log("Setting %s to %s", key, env[key])
+            
+            
+_jsonpath_cache = utils.LRUCache(1024)
+
+def _compile_jsonpath(xpath):
+    '''
+    Returns the parsed JSONPath expression, reusing previously parsed
+    expressions.
+    '''
+    expr = _jsonpath_cache.get(xpath)
+    
+    if expr is None:
+        from jsonpath_rw import parse
+        expr = parse(xpath)
+        _jsonpath_cache.put(xpath, expr)
+        
+    return expr
+
+def _jsonpath_steps(xpath, expr):
+    '''
+    Converts a parsed JSONPath expression to the list of steps matched by
+    _stream_json, where each step is a field name, an array index or "*".
+    '''
+    import jsonpath_rw
+    
+    if isinstance(expr, jsonpath_rw.Child):
+        return _jsonpath_steps(xpath, expr.left) + _jsonpath_steps(xpath, expr.right)
+    elif isinstance(expr, (jsonpath_rw.Root, jsonpath_rw.This)):
+        return []
+    elif isinstance(expr, jsonpath_rw.Fields) and len(expr.fields) == 1:
+        return [expr.fields[0]]
+    elif isinstance(expr, jsonpath_rw.Index):
+        return [expr.index]
+    elif isinstance(expr, jsonpath_rw.Slice) and expr.start is None and expr.end is None and expr.step is None:
+        return ["*"]
+    else:
+        logging.error("JSONPath expression " + xpath + " is not supported when streaming")
+        raise TaskError("JSONPath expression " + xpath + " is not supported when streaming")
+    
+def _stream_json(file, paths):
+    '''
+    Reads the JSON file incrementally, returning the list of values found at
+    each path.  Reading stops early once every path without wildcards has
+    been found.
+    '''
+    import ijson
+    from ijson.common import ObjectBuilder
+    from decimal import Decimal
+    
+    matches = [[] for path in paths]
+    remaining = set(i for i, path in enumerate(paths) if "*" not in path)
+    unbounded = len(remaining) < len(paths)
+    location = []
+    builders = []
+    
+    for (prefix, event, value) in ijson.parse(file):
+        if event == "map_key":
+            location[-1] = value
+        elif event == "end_map" or event == "end_array":
+            location.pop()
+        else:
+            # a value starts at the current location
+            if location and isinstance(location[-1], int):
+                location[-1] += 1
+                
+            for i, path in enumerate(paths):
+                if len(path) == len(location) and all(step == "*" or step == part for (step, part) in zip(path, location)):
+                    builders.append((i, len(location), ObjectBuilder()))
                     
+            if event == "start_map":
+                location.append(None)
+            elif event == "start_array":
+                location.append(-1)
+            elif isinstance(value, Decimal):
+                value = float(value)
+                
+        if builders:
+            for (i, depth, builder) in builders:
+                builder.event(event, value)
+                
+            if event != "map_key" and builders[-1][1] == len(location):
+                # the most recently started values are now complete
+                while builders and builders[-1][1] == len(location):
+                    (i, depth, builder) = builders.pop()
+                    matches[i].append(builder.value)
+                    remaining.discard(i)
                     
+                if not remaining and not unbounded:
+                    break
+                
+    return matches
+            
+
 class ParseCSV(Task):
     '''
     Parses a CSV file and extracts values.  A simple query syntax is used:
@@ -497,6 +1032,17 @@ class ParseCSV(Task):
     
         row["key1"]
         
+    Columns can also be selected with a path, where row[n] is the n-th row
+    (starting at 1) and row selects every row:
+    
+        row[1]/@key1
+        row/@key1
+        
+    Each query is compiled once by get().  Queries that select a column and
+    only compare columns to strings with == (combined with and) are answered
+    directly from the parsed cells, other queries are evaluated with the row
+    dict.  If first is True, the query resolves to the first matching value
+    and the file is only read until all such queries are resolved.
     '''
     
     def __init__(self, file, **kwargs):
@@ -504,45 +1050,422 @@ class ParseCSV(Task):
         self.file = file
         self.kwargs = kwargs
         self.fields = []
+        self._queries = []
         
-    def get(self, expr, key, conversion=str):
-        self.fields.append((expr, key, conversion))
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_queries"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._queries = [_CSVQuery(*field) for field in self.fields]
+        
+    def get(self, expr, key, conversion=str, first=False):
+        self.fields.append((expr, key, conversion, first))
+        self._queries.append(_CSVQuery(expr, key, conversion, first))
         return self
     
     def run(self, env):
         import csv
         
+        kwargs = dict(self.kwargs)
+        header = kwargs.pop("fieldnames", None)
+        restkey = kwargs.pop("restkey", None)
+        restval = kwargs.pop("restval", None)
+        
         with open(self.file) as f:
-            reader = csv.DictReader(f, **self.kwargs)
+            reader = csv.reader(f, **kwargs)
+            
+            if header is None:
+                header = next(reader, [])
+                
+            header = [name.strip() for name in header]
+            columns = dict((name, i) for i, name in enumerate(header))
+            
+            queries = self._queries
+            plans = [query.plan(columns) for query in queries]
+            active = range(len(queries))
             results = {}
-
-            for row in reader:
-                cleanup_row = {}
+            namespace = {}
+            number = 0
+            
+            for cells in reader:
+                # like csv.DictReader, skip blank lines
+                if not cells:
+                    continue
                 
-                for key,value in row.iteritems():
-                    cleanup_row[key.strip()] = value.strip() if isinstance(value, str) else value
+                # only build the row dict if a query needs it
+                number += 1
+                row = None
                 
-                for (expr,key,conversion) in self.fields:
-                    if not expr.endswith(" else None"):
-                        expr += " else None"
-                        
-                    result = eval(expr, { "row" : cleanup_row })
+                for i in active:
+                    (number_filter, filters, column) = plans[i]
+                    query = queries[i]
                     
-                    if result is not None:
-                        if key not in results:
-                            results[key] = [result]
+                    if number_filter is not None and number_filter != number:
+                        continue
+                    
+                    if filters is not None:
+                        if not all(index < len(cells) and cells[index].strip() == value for (index, value) in filters):
+                            continue
+                        
+                        if column is not None:
+                            result = cells[column].strip() if column < len(cells) else restval
                         else:
-                            results[key].append(result)
+                            if row is None:
+                                row = _csv_row(header, cells, restkey, restval)
+                            
+                            namespace["row"] = row
+                            result = eval(query.value, namespace)
+                    else:
+                        if row is None:
+                            row = _csv_row(header, cells, restkey, restval)
+                            
+                        namespace["row"] = row
+                        result = eval(query.code, namespace)
+                        
+                    if result is not None:
+                        results.setdefault(i, []).append(result)
+                        
+                # stop reading once all remaining queries are resolved
+                if any(queries[i].first or plans[i][0] is not None for i in active):
+                    active = [i for i in active if not ((queries[i].first and i in results) or
+                                                        (plans[i][0] is not None and plans[i][0] <= number))]
+                    
+                    if not active:
+                        break
                             
-            for key,values in results.iteritems():
-                logging.info("Found " + str(len(values)) + " matches for " + key)
+            for i, values in sorted(results.iteritems()):
+                query = queries[i]
+                key = query.key
+                self.log("Found %s matches for %s", len(values), key)
                 
-                if len(values) == 1:
-                    env[key] = conversion(values[0] if isinstance(values[0], str) else values[0].text)
+                if len(values) == 1 or query.first:
+                    env[key] = query.conversion(values[0])
                 else:
-                    env[key] = map(conversion, [value if isinstance(value, str) else value.text for value in values])
+                    env[key] = map(query.conversion, values)
+                    
+                self.log("Setting %s to %s", key, env[key])
+
+
+def _csv_row(header, cells, restkey, restval):
+    '''
+    Converts the cells of a CSV row to the dict exposed to ParseCSV queries,
+    stripping surrounding whitespace like csv.DictReader.
+    '''
+    row = dict(zip(header, [cell.strip() for cell in cells]))
+    
+    if len(cells) > len(header):
+        row[restkey] = cells[len(header):]
+    elif len(cells) < len(header):
+        for name in header[len(cells):]:
+            row.setdefault(name, restval)
+            
+    return row
+
+
+class _CSVQuery(object):
+    '''
+    A ParseCSV query compiled to a code object and, when possible, a plan that
+    selects a column from the rows whose cells equal the given strings.
+    '''
+    
+    PATH = re.compile(r"^\s*row(?:\[\s*(\d+)\s*\])?\s*/\s*@(.+?)\s*$")
+    
+    def __init__(self, expr, key, conversion=str, first=False):
+        super(_CSVQuery, self).__init__()
+        self.key = key
+        self.conversion = conversion
+        self.first = first
+        self.number = None
+        self.filters = None
+        self.column = None
+        self.value = None
+        self.code = None
+        
+        match = _CSVQuery.PATH.match(expr)
+        
+        if match:
+            self.number = int(match.group(1)) if match.group(1) else None
+            self.filters = []
+            self.column = match.group(2)
+            return
+        
+        if " if " in expr and not expr.endswith(" else None"):
+            expr += " else None"
+        
+        self.code = compile(expr, "<ParseCSV " + key + ">", "eval")
+        tree = ast.parse(expr, mode="eval").body
+        
+        if isinstance(tree, ast.IfExp):
+            if not (isinstance(tree.orelse, ast.Name) and tree.orelse.id == "None"):
+                return
+            
+            filters = _equality_filters(tree.test)
+            value = tree.body
+        else:
+            filters = []
+            value = tree
+            
+        if filters is not None:
+            self.filters = filters
+            self.column = _row_column(value)
+            
+            if self.column is None:
+                self.value = compile(ast.Expression(value), "<ParseCSV " + key + ">", "eval")
+            
+    def plan(self, columns):
+        """
+        Resolves the plan against the columns of a file, returning the tuple
+        (number, filters, column).  Filters and column are None if the query
+        must be evaluated with the row dict.
+        """
+        if self.filters is None:
+            return (self.number, None, None)
+        
+        filters = [(self._index(columns, name), value) for (name, value) in self.filters]
+        column = self._index(columns, self.column) if self.column is not None else None
+        return (self.number, filters, column)
+    
+    def _index(self, columns, name):
+        if name not in columns:
+            logging.error("Column " + name + " not found in CSV file")
+            raise TaskError("Column " + name + " not found in CSV file")
+        
+        return columns[name]
+            
+            
+def _row_column(node):
+    '''
+    Returns the column name if the node is of the form row["name"], or None.
+    '''
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and \
+            node.value.id == "row" and isinstance(node.slice, ast.Index) and \
+            isinstance(node.slice.value, ast.Str):
+        return node.slice.value.s
+    
+    return None
+
+def _equality_filters(node):
+    '''
+    Returns the list of (column, value) pairs if the node only compares
+    columns to strings with == (combined with and), or None otherwise.
+    '''
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        filters = []
+        
+        for value in node.values:
+            filter = _equality_filters(value)
+            
+            if filter is None:
+                return None
+            
+            filters.extend(filter)
+            
+        return filters
+    
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], ast.Eq):
+        (left, right) = (node.left, node.comparators[0])
+        
+        if isinstance(left, ast.Str):
+            (left, right) = (right, left)
+            
+        column = _row_column(left)
+        
+        if column is not None and isinstance(right, ast.Str):
+            return [(column, right.s)]
+        
+    return None
+
+
+class ParseTable(Task):
+    '''
+    Loads the selected columns of a delimited numeric table, such as a CSV or
+    TSV file, directly into NumPy arrays.  The file is memory-mapped and
+    parsed in chunks of about chunksize bytes, each converted to an array by
+    NumPy, so only the selected columns are held in memory.
+    
+    Columns are selected by name, or by position if the file has no header.
+    Rows can be filtered with a vectorized mask, either a function or an
+    expression where row maps each column name to the array of values for the
+    current chunk:
+    
+        ParseTable("output.csv").get("y1", where="(row['t'] > 10) & (row['x'] != 0)")
+        
+    All cells must be numeric and every row must have the same number of
+    columns.  Blank lines are skipped.  Requires NumPy.
+    '''
+    
+    def __init__(self, file, delimiter=",", header=True, chunksize=4*1024*1024):
+        super(ParseTable, self).__init__()
+        self.file = file
+        self.delimiter = delimiter
+        self.header = header
+        self.chunksize = chunksize
+        self.fields = []
+        self._wheres = []
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_wheres"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._wheres = [_compile_where(field[2]) for field in self.fields]
+        
+    def get(self, column, key=None, where=None):
+        """
+        Selects a column.
+        
+        Args:
+            column: The name of the column, or its position (starting at 0)
+                if the file has no header.
+            key: The field storing the array of values, defaults to the
+                column name.
+            where: An expression or a function returning a boolean mask for
+                the rows of the current chunk, or None to select every row.
+                
+        Returns:
+            This task.
+        """
+        self.fields.append((column, key if key is not None else column, where))
+        self._wheres.append(_compile_where(where))
+        return self
+    
+    def run(self, env):
+        import mmap
+        import numpy
+        
+        self.log("Parsing table %s", self.file)
+        whitespace = self.delimiter is None or self.delimiter.isspace()
+        separator = None if whitespace else self.delimiter
+        
+        with open(self.file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else ""
+            
+            try:
+                start = 0
+                names = None
+                
+                lineno = 0
+                
+                if self.header:
+                    start = data.find("\n") + 1 if data.find("\n") >= 0 else size
+                    names = [name.strip() for name in data[:start].strip().split(separator)]
+                    lineno = 1
+                    
+                indices = self._indices(names)
+                chunks = dict((key, []) for (column, key, where) in self.fields)
+                ncolumns = len(names) if names is not None else None
+                
+                while start < size:
+                    end = min(start + self.chunksize, size)
+                    
+                    # extend the chunk to the end of the line
+                    if end < size:
+                        newline = data.find("\n", end - 1)
+                        end = size if newline < 0 else newline + 1
+                        
+                    text = data[start:end]
+                    start = end
+                    rows = []
+                    
+                    for cells in text.splitlines():
+                        lineno += 1
+                        
+                        if not cells.strip():
+                            continue
+                        
+                        cells = cells.split(separator)
+                        
+                        if ncolumns is None:
+                            ncolumns = len(cells)
+                        
+                        if len(cells) != ncolumns:
+                            logging.error("Table " + str(self.file) + " has " + str(len(cells)) + " columns on line " + str(lineno) + ", expected " + str(ncolumns))
+                            raise TaskError("Table " + str(self.file) + " has " + str(len(cells)) + " columns on line " + str(lineno) + ", expected " + str(ncolumns))
+                        
+                        rows.append(cells)
+                    
+                    if not rows:
+                        continue
+                    
+                    try:
+                        values = numpy.array(rows, dtype=numpy.float64)
+                    except ValueError:
+                        logging.error("Table " + str(self.file) + " contains non-numeric values")
+                        raise TaskError("Table " + str(self.file) + " contains non-numeric values")
+                    
+                    row = _TableColumns(values, names)
                     
-                logging.info("Setting " + key + " to " + str(env[key]))
+                    for (index, (column, key, where), compiled) in zip(indices, self.fields, self._wheres):
+                        if compiled is None:
+                            chunks[key].append(values[:, index])
+                        else:
+                            chunks[key].append(values[compiled(row), index])
+            finally:
+                if size > 0:
+                    data.close()
+            
+        for (column, key, where) in self.fields:
+            env[key] = numpy.concatenate(chunks[key]) if chunks[key] else numpy.empty(0)
+            self.log("Setting %s to %s", key, env[key])
+            
+    def _indices(self, names):
+        indices = []
+        
+        for (column, key, where) in self.fields:
+            if names is None:
+                if not isinstance(column, int):
+                    logging.error("Columns must be selected by position when the table has no header")
+                    raise TaskError("Columns must be selected by position when the table has no header")
+                
+                indices.append(column)
+            elif column in names:
+                indices.append(names.index(column))
+            else:
+                logging.error("Column " + str(column) + " not found in " + str(self.file))
+                raise TaskError("Column " + str(column) + " not found in " + str(self.file))
+            
+        return indices
+    
+    
+class _TableColumns(object):
+    '''
+    Maps the column names (or positions) to the columns of a chunk parsed by
+    ParseTable.
+    '''
+    
+    def __init__(self, values, names):
+        super(_TableColumns, self).__init__()
+        self.values = values
+        self.names = names
+        
+    def __getitem__(self, column):
+        if self.names is not None and not isinstance(column, int):
+            if column not in self.names:
+                logging.error("Column " + str(column) + " not found in table")
+                raise TaskError("Column " + str(column) + " not found in table")
+            
+            column = self.names.index(column)
+            
+        return self.values[:, column]
+    
+    
+def _compile_where(where):
+    '''
+    Returns a function computing the mask given by a ParseTable expression or
+    function, or None if there is no filter.
+    '''
+    if where is None or callable(where):
+        return where
+    
+    import numpy
+    code = compile(where, "<ParseTable " + where + ">", "eval")
+    return lambda row: eval(code, { "row" : row, "numpy" : numpy })
 
 
 class Connect(Task):
@@ -575,13 +1498,39 @@ class Connect(Task):
         server = utils.substitute(self.server, env)
         port = utils.substitute(self.port, env) if isinstance(self.port, str) else self.port
         
-        logging.info("Connecting to " + str(server) + ":" + str(port))
+        self.log("Connecting to %s:%s", server, port)
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((server, int(port)))
         env["SOCKET"] = s
         env["SOCKET_FILE"] = s.makefile()
         env["STDOUT"] = StringIO()
-        logging.info("Successfully connected")
+        self.log("Successfully connected")
+        
+    def run_async(self, env):
+        if "SOCKET" in env:
+            logging.error("SOCKET already defined, close prior connection first")
+            raise TaskError("SOCKET already defined, close prior connection first")
+        
+        server = utils.substitute(self.server, env)
+        port = utils.substitute(self.port, env) if isinstance(self.port, str) else self.port
+        
+        self.log("Connecting to %s:%s", server, port)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        error = s.connect_ex((server, int(port)))
+        
+        if error == errno.EINPROGRESS:
+            yield aio.Writable(s.fileno())
+            error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            
+        if error != 0:
+            s.close()
+            raise socket.error(error, os.strerror(error))
+        
+        env["SOCKET"] = s
+        env["SOCKET_FILE"] = aio.AsyncStream(s)
+        env["STDOUT"] = StringIO()
+        self.log("Successfully connected")
 
 class Send(Task):
     '''
@@ -599,9 +1548,26 @@ class Send(Task):
         
         s = env["SOCKET"]
         formatted_msg = utils.substitute(self.message, env)
-        logging.info("Sending " + formatted_msg)
+        self.log("Sending %s", formatted_msg)
         s.sendall(formatted_msg)
-        logging.info("Successfully sent message")
+        profiling.add_bytes(len(formatted_msg))
+        self.log("Successfully sent message")
+        
+    def run_async(self, env):
+        stream = env.get("SOCKET_FILE")
+        
+        if not isinstance(stream, aio.AsyncStream):
+            self.run(env)
+            return
+        
+        formatted_msg = utils.substitute(self.message, env)
+        self.log("Sending %s", formatted_msg)
+        
+        for event in stream.write_all(formatted_msg):
+            yield event
+            
+        profiling.add_bytes(len(formatted_msg))
+        self.log("Successfully sent message")
         
 class Receive(Task):
     '''
@@ -618,20 +1584,149 @@ class Receive(Task):
             logging.error("SOCKET not defined, call Connect first")
             raise TaskError("SOCKET not defined, call Connect first")
         
-        logging.info("Waiting to receive message")
+        self.log("Waiting to receive message")
         stdout = env["STDOUT"]
         s = env["SOCKET_FILE"]
         
         pos = stdout.tell()
         stdout.seek(0, os.SEEK_END)
         
+        # discard the lines that were already parsed, keeping memory flat
+        if stdout.tell() == pos:
+            stdout.seek(0)
+            stdout.truncate()
+            pos = 0
+        
         for i in range(self.numlines):
             line = s.readline()
-            logging.info("Received line " + line)
+            self.log("Received line %s", line)
             stdout.write(line)
+            profiling.add_bytes(len(line))
         
         stdout.seek(pos)
-        logging.info("Successfully received " + str(self.numlines) + " lines")
+        self.log("Successfully received %s lines", self.numlines)
+        
+    def run_async(self, env):
+        stream = env.get("SOCKET_FILE")
+        
+        if isinstance(stream, aio.AsyncStream):
+            for event in stream.read_lines(self.numlines):
+                yield event
+                
+        self.run(env)
+        
+
+class SendVector(Task):
+    '''
+    Sends the values of the given fields as a binary frame containing packed
+    float64 values, avoiding formatting the values as text.  Fields holding
+    lists contribute all of their values.  See utils.write_frame for the
+    format.
+    '''
+    
+    def __init__(self, names):
+        super(SendVector, self).__init__()
+        self.names = names if isinstance(names, (list, tuple)) else [names]
+        
+    def run(self, env):
+        if "SOCKET" not in env:
+            logging.error("SOCKET not defined, call Connect first")
+            raise TaskError("SOCKET not defined, call Connect first")
+        
+        values = []
+        
+        for name in self.names:
+            value = env[name]
+            
+            if hasattr(value, "__iter__"):
+                values.extend(value)
+            else:
+                values.append(value)
+        
+        self.log("Sending vector of %s values", len(values))
+        frame = utils.pack_frame(utils.FRAME_VECTOR, values)
+        env["SOCKET"].sendall(frame)
+        profiling.add_bytes(len(frame))
+        
+        
+class ReceiveVector(Task):
+    '''
+    Receives a binary frame containing packed float64 values.  If name is a
+    list, each value is stored in the corresponding field, otherwise the list
+    of values is stored in the named field.
+    '''
+    
+    def __init__(self, name="output"):
+        super(ReceiveVector, self).__init__()
+        self.name = name
+        
+    def run(self, env):
+        if "SOCKET" not in env:
+            logging.error("SOCKET not defined, call Connect first")
+            raise TaskError("SOCKET not defined, call Connect first")
+        
+        (type, values) = utils.read_frame(env["SOCKET_FILE"])
+        
+        if type != utils.FRAME_VECTOR:
+            logging.error("Expected a vector frame, received frame of type " + repr(type))
+            raise TaskError("Expected a vector frame, received frame of type " + repr(type))
+        
+        self.log("Received vector of %s values", len(values))
+        
+        if isinstance(self.name, list):
+            if len(self.name) != len(values):
+                logging.error("Number of received values (" + str(len(values)) + ") does not match number of names (" + str(len(self.name)) + ")")
+                raise TaskError("Number of received values (" + str(len(values)) + ") does not match number of names (" + str(len(self.name)) + ")")
+            
+            env.update(zip(self.name, values))
+        else:
+            env[self.name] = values
+            
+            
+class SendRecord(Task):
+    '''
+    Sends the given fields as a binary frame containing a record, encoded
+    with msgpack if available and JSON otherwise.
+    '''
+    
+    def __init__(self, names):
+        super(SendRecord, self).__init__()
+        self.names = names if isinstance(names, (list, tuple)) else [names]
+        
+    def run(self, env):
+        if "SOCKET" not in env:
+            logging.error("SOCKET not defined, call Connect first")
+            raise TaskError("SOCKET not defined, call Connect first")
+        
+        record = dict((name, env[name]) for name in self.names)
+        self.log("Sending record with fields %s", self.names)
+        frame = utils.pack_frame(utils.FRAME_RECORD, record)
+        env["SOCKET"].sendall(frame)
+        profiling.add_bytes(len(frame))
+        
+        
+class ReceiveRecord(Task):
+    '''
+    Receives a binary frame containing a record, storing each of its fields
+    in the environment.
+    '''
+    
+    def __init__(self):
+        super(ReceiveRecord, self).__init__()
+        
+    def run(self, env):
+        if "SOCKET" not in env:
+            logging.error("SOCKET not defined, call Connect first")
+            raise TaskError("SOCKET not defined, call Connect first")
+        
+        (type, record) = utils.read_frame(env["SOCKET_FILE"])
+        
+        if not isinstance(record, dict):
+            logging.error("Expected a record frame, received frame of type " + repr(type))
+            raise TaskError("Expected a record frame, received frame of type " + repr(type))
+        
+        self.log("Received record with fields %s", record.keys())
+        env.update(record)
         
 
 class Disconnect(Task):
@@ -646,12 +1741,452 @@ class Disconnect(Task):
         if "SOCKET" not in env:
             return
         
-        logging.info("Closing connection")
+        self.log("Closing connection")
         s = env["SOCKET"]
         s.shutdown(1)
         s.close()
         del env["SOCKET"]
             
+class Connection(object):
+    '''
+    A TCP connection managed by a ConnectionPool.
+    '''
+    
+    def __init__(self, pool, address, socket):
+        super(Connection, self).__init__()
+        self.pool = pool
+        self.address = address
+        self.socket = socket
+        self.file = socket.makefile()
+        
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        
+        self.socket.close()
+    
+    
+class ConnectionPool(utils.ResourcePool):
+    '''
+    Keeps up to size live connections to one or more model servers, given as
+    "server:port" addresses (which may contain ${keyword} fields).  Connections
+    are opened on demand, spread across the addresses in turn, and reused by
+    later evaluations.  Opening a connection is retried with increasing delays,
+    so a server that is still starting up or was restarted is reconnected.
+    '''
+    
+    def __init__(self, addresses, size=1, retries=5, delay=0.5):
+        super(ConnectionPool, self).__init__(self._connect, size, Connection.close)
+        self.addresses = addresses if isinstance(addresses, (list, tuple)) else [addresses]
+        self.retries = retries
+        self.delay = delay
+        self._next = 0
+        
+        for address in self.addresses:
+            if not ":" in address:
+                logging.error("Address missing port number")
+                raise TaskError("Address missing port number")
+        
+    def _connect(self, env):
+        delay = self.delay
+        
+        for attempt in range(self.retries + 1):
+            address = utils.substitute(self.addresses[self._next % len(self.addresses)], env)
+            self._next += 1
+            server, port = address.rsplit(":", 1)
+            
+            try:
+                logging.info("Connecting to %s", address)
+                s = socket.create_connection((server, int(port)))
+                logging.info("Successfully connected")
+                return Connection(self, address, s)
+            except socket.error as e:
+                if attempt == self.retries:
+                    logging.error("Unable to connect to " + address + ": " + str(e))
+                    raise TaskError("Unable to connect to " + address + ": " + str(e))
+                
+                logging.warn("Unable to connect to %s, retrying in %s seconds", address, delay)
+                time.sleep(delay)
+                delay *= 2
+                
+                
+class Checkout(Task):
+    '''
+    Checks out a connection from a ConnectionPool, setting SOCKET, SOCKET_FILE
+    and STDOUT like Connect.  The connection is returned with Release.  A
+    connection that is not released by the end of the evaluation, such as
+    when the evaluation fails, is closed and replaced, like
+    Release(discard=True) added with onError.
+    '''
+    
+    def __init__(self, pool, timeout=None):
+        super(Checkout, self).__init__()
+        self.pool = pool
+        self.timeout = timeout
+        
+    def run(self, env):
+        if "SOCKET" in env:
+            logging.error("SOCKET already defined, close prior connection first")
+            raise TaskError("SOCKET already defined, close prior connection first")
+        
+        try:
+            connection = self.pool.acquire(self.timeout, (env,))
+        except PoolTimeout:
+            logging.error("Timed out waiting for a pooled connection")
+            raise TaskError("Timed out waiting for a pooled connection")
+        
+        env["CONNECTION"] = connection
+        env["SOCKET"] = connection.socket
+        env["SOCKET_FILE"] = connection.file
+        env["STDOUT"] = StringIO()
+        env["CLEANUP"] = env.get("CLEANUP", []) + [functools.partial(self._abandon, env, connection)]
+        
+    def _abandon(self, env, connection):
+        if env.get("CONNECTION") is connection:
+            logging.warn("Connection was not released, closing it")
+            Release(discard=True).run(env)
+        
+        
+class Release(Task):
+    '''
+    Returns the connection checked out by Checkout to its pool.  With
+    discard=True, the connection is closed and replaced by a new connection
+    when needed.
+    '''
+    
+    def __init__(self, discard=False):
+        super(Release, self).__init__()
+        self.discard = discard
+        
+    def run(self, env):
+        if "CONNECTION" not in env:
+            return
+        
+        connection = env.pop("CONNECTION")
+        env.pop("SOCKET", None)
+        env.pop("SOCKET_FILE", None)
+        connection.pool.release(connection, self.discard)
+        
+        
+class ClosePool(Task):
+    '''
+    Closes the idle connections in a ConnectionPool, or the idle resources
+    of another ResourcePool, typically added with onComplete.
+    '''
+    
+    def __init__(self, pool):
+        super(ClosePool, self).__init__()
+        self.pool = pool
+        
+    def run(self, env):
+        self.log("Closing connection pool")
+        self.pool.close()
+        
+            
+class WarmProcess(object):
+    '''
+    A model process started by a WarmPool.  Requests are written to and
+    responses read from the process's STDIN and STDOUT, a socket the process
+    listens on at ${WARM_PORT}, or the FIFOs ${REQUEST_FIFO} and
+    ${RESPONSE_FIFO}, depending on the pool's transport.
+    '''
+    
+    def __init__(self, pool, command):
+        super(WarmProcess, self).__init__()
+        self.pool = pool
+        self.uses = 0
+        self.buffer = ""
+        self.socket = None
+        self.tempdir = None
+        fields = {}
+        
+        if pool.transport == "socket":
+            s = socket.socket()
+            s.bind(("", 0))
+            fields["WARM_PORT"] = s.getsockname()[1]
+            s.close()
+        elif pool.transport == "fifo":
+            self.tempdir = tempfile.mkdtemp()
+            fields["REQUEST_FIFO"] = os.path.join(self.tempdir, "request")
+            fields["RESPONSE_FIFO"] = os.path.join(self.tempdir, "response")
+            os.mkfifo(fields["REQUEST_FIFO"])
+            os.mkfifo(fields["RESPONSE_FIFO"])
+        elif pool.transport != "stdin":
+            logging.error("Unknown transport " + str(pool.transport) + ", expected stdin, socket or fifo")
+            raise TaskError("Unknown transport " + str(pool.transport) + ", expected stdin, socket or fifo")
+        
+        command = utils.substitute(command, fields)
+        logging.info("Starting warm process %s", command)
+        piped = pool.transport == "stdin"
+        self.process = subprocess.Popen(shlex.split(command), bufsize=0,
+                                        stdin=subprocess.PIPE if piped else None,
+                                        stdout=subprocess.PIPE if piped else None)
+        
+        try:
+            if pool.transport == "stdin":
+                self.request_fd = self.process.stdin.fileno()
+                self.response_fd = self.process.stdout.fileno()
+            elif pool.transport == "socket":
+                self.socket = self._connect(fields["WARM_PORT"])
+                self.request_fd = self.response_fd = self.socket.fileno()
+            else:
+                # opening the response FIFO for reading and writing does not
+                # wait for the process to open it
+                self.response_fd = os.open(fields["RESPONSE_FIFO"], os.O_RDWR)
+                self.request_fd = self._open_request(fields["REQUEST_FIFO"])
+        except Exception:
+            self.close()
+            raise
+        
+    def _connect(self, port):
+        deadline = time.time() + self.pool.startup
+        
+        while True:
+            try:
+                return socket.create_connection((self.pool.host, port))
+            except socket.error as e:
+                if self.process.poll() is not None or time.time() > deadline:
+                    logging.error("Unable to connect to warm process: " + str(e))
+                    raise TaskError("Unable to connect to warm process: " + str(e))
+                
+                time.sleep(0.05)
+                
+    def _open_request(self, path):
+        deadline = time.time() + self.pool.startup
+        
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                
+                if self.process.poll() is not None or time.time() > deadline:
+                    logging.error("Warm process did not open " + path)
+                    raise TaskError("Warm process did not open " + path)
+                
+                time.sleep(0.05)
+            else:
+                aio.set_blocking(fd)
+                return fd
+            
+    def exchange(self, request, timeout=None):
+        """
+        Sends the request and returns the response, read according to the
+        pool's protocol.  Raises TaskError if the process exits or does not
+        respond before the timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        
+        while request:
+            request = request[os.write(self.request_fd, request):]
+            
+        lines = []
+        
+        while True:
+            index = self.buffer.find("\n")
+            
+            if index >= 0:
+                line, self.buffer = self.buffer[:index+1], self.buffer[index+1:]
+                
+                if self.pool.response_end is not None and line.rstrip("\r\n") == self.pool.response_end:
+                    break
+                
+                lines.append(line)
+                
+                if self.pool.response_end is None and len(lines) == self.pool.response_lines:
+                    break
+                
+                continue
+            
+            remaining = deadline - time.time() if deadline is not None else 1.0
+            
+            if remaining <= 0:
+                logging.error("Warm process exceeded timeout limit")
+                raise TaskError("Warm process exceeded timeout limit")
+            
+            (readable, _, _) = select.select([self.response_fd], [], [], min(remaining, 1.0))
+            
+            if readable:
+                data = os.read(self.response_fd, 65536)
+                
+                if not data:
+                    logging.error("Warm process closed its output")
+                    raise TaskError("Warm process closed its output")
+                
+                self.buffer += data
+            elif self.process.poll() is not None:
+                logging.error("Warm process exited with code " + str(self.process.returncode))
+                raise TaskError("Warm process exited with code " + str(self.process.returncode))
+            
+        self.uses += 1
+        return "".join(lines)
+    
+    def memory(self):
+        """
+        Returns the resident memory of the process in bytes, or None if it
+        can not be measured on this platform.
+        """
+        try:
+            with open("/proc/" + str(self.process.pid) + "/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (IOError, OSError, ValueError):
+            pass
+        
+        try:
+            import psutil
+            return psutil.Process(self.process.pid).memory_info().rss
+        except Exception:
+            return None
+        
+    def close(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        
+        self.process.wait()
+        
+        if self.socket is not None:
+            self.socket.close()
+        elif self.tempdir is not None:
+            for name in ["request_fd", "response_fd"]:
+                if hasattr(self, name):
+                    os.close(getattr(self, name))
+                    
+            shutil.rmtree(self.tempdir, ignore_errors=True)
+        else:
+            self.process.stdin.close()
+            self.process.stdout.close()
+            
+    
+class WarmPool(utils.ResourcePool):
+    '''
+    Keeps up to size model processes running, so Execute(command, warm=pool)
+    sends each evaluation to a warm process instead of starting the model.
+    The processes are started on demand from the Execute command, which must
+    not depend on the inputs.
+    
+    Each evaluation is one request/response exchange.  The request is the
+    data written to STDIN before the output is first read.  The response is
+    response_lines lines or, if response_end is given, the lines before a
+    line equal to response_end.  The transport is "stdin" (the process's
+    STDIN and STDOUT), "socket" (the process listens on ${WARM_PORT}) or
+    "fifo" (the process reads ${REQUEST_FIFO} and then writes
+    ${RESPONSE_FIFO}).
+    
+    Processes are replaced after uses exchanges, once their resident memory
+    exceeds memory bytes, or if an exchange fails.  A process leased by an
+    evaluation that ends before reading the response, such as when a task
+    fails, is also replaced.
+    '''
+    
+    def __init__(self, size=1, transport="stdin", response_lines=1, response_end=None, uses=None, memory=None,
+                 host=None, startup=30):
+        super(WarmPool, self).__init__(self._start, size, WarmProcess.close)
+        self.transport = transport
+        self.response_lines = response_lines
+        self.response_end = response_end
+        self.uses = uses
+        self.memory = memory
+        self.host = host if host is not None else socket.gethostname()
+        self.startup = startup
+        self._started = 0
+        
+    def _start(self, command):
+        process = WarmProcess(self, command)
+        self._started += 1
+        return process
+    
+    def recycle(self, process):
+        """
+        Returns True if the process should be replaced.
+        """
+        if self.uses is not None and process.uses >= self.uses:
+            logging.info("Recycling warm process after %d uses", process.uses)
+            return True
+        
+        if self.memory is not None:
+            memory = process.memory()
+            
+            if memory is not None and memory > self.memory:
+                logging.info("Recycling warm process using %d bytes", memory)
+                return True
+            
+        return False
+        
+        
+class _WarmExchange(object):
+    '''
+    Stands in for the STDIN, STDOUT and PROCESS_STATUS of Execute in warm
+    mode.  Writes are buffered until the output is first read or the exit
+    code is checked, which sends the request to the leased process, reads
+    the response and returns the process to its pool.  Writes after the
+    response, such as the blank line telling a model to exit, are ignored.
+    '''
+    
+    def __init__(self, pool, process, timeout):
+        super(_WarmExchange, self).__init__()
+        self.pool = pool
+        self.process = process
+        self.timeout = timeout
+        self.request = []
+        self.response = None
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        
+    def write(self, data):
+        if self.response is None:
+            self.request.append(data)
+            
+    def flush(self):
+        pass
+    
+    def readline(self):
+        return self._finish().readline()
+    
+    def read(self, size=-1):
+        return self._finish().read(size)
+    
+    def __iter__(self):
+        return iter(self._finish())
+    
+    def wait(self, timeout=None):
+        self._finish()
+        return self.returncode
+    
+    def close(self):
+        pass
+    
+    def abandon(self):
+        """
+        Returns the process to its pool if the exchange did not complete,
+        replacing the process since its state is unknown.
+        """
+        if self.response is None:
+            self.response = StringIO()
+            self.returncode = -1
+            self.pool.release(self.process, discard=True)
+            
+    def _finish(self):
+        if self.response is None:
+            try:
+                self.response = StringIO(self.process.exchange("".join(self.request), self.timeout))
+                self.returncode = 0
+            except Exception:
+                self.response = StringIO()
+                self.returncode = -1
+                self.pool.release(self.process, discard=True)
+                raise
+            
+            self.pool.release(self.process, self.pool.recycle(self.process))
+            
+        return self.response
+    
+    
 class Pause(Task):
     '''
     Pauses for a given number of seconds.
@@ -663,9 +2198,13 @@ class Pause(Task):
         
     def run(self, env):
         for i in range(self.seconds):
-            logging.info("Pausing for " + str(self.seconds-i) + " seconds")
+            self.log("Pausing for %s seconds", self.seconds-i)
             time.sleep(1)
             
+    def run_async(self, env):
+        self.log("Pausing for %s seconds", self.seconds)
+        return [aio.Sleep(self.seconds)]
+            
         
 class PrintStderr(Task):
     '''
@@ -694,8 +2233,8 @@ class Assert(Task):
         self.message = message
         
     def run(self, env):
-        logging.info("Testing assertion " + str(self.expr))
+        self.log("Testing assertion %s", self.expr)
         
         if not eval(self.expr):
-            logging.info("Assertion failed!")
+            self.log("Assertion failed!")
             raise AssertionError(self.message if self.message else "Assertion failed")
\ No newline at end of file
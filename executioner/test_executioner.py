@@ -7,11 +7,83 @@ import unittest
 import tempfile
 import shutil
 import logging
-from . import Executioner
+import sys
+import socket
+import json
+import subprocess
+import threading
+from StringIO import StringIO
+from . import Executioner, AsyncExecutioner, ResultTable
+import tasks
+import cache
 from tasks import *
+from parallel import *
+from distributed import DistributedBackend
 
 logging.basicConfig(level=logging.INFO)
 
+DTLZ2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dtlz2.py")
+DTLZ2_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dtlz2_socket.py")
+DTLZ2_INPUT = "${x1} ${x2} ${x3} ${x4} ${x5} ${x6} ${x7} ${x8} ${x9} ${x10} ${x11}\n"
+
+def dtlz2_inputs(n):
+    return [dict(("x" + str(j+1), (i + j) % 5 / 4.0) for j in range(11)) for i in range(n)]
+
+class Count(Task):
+    
+    evaluations = 0
+    
+    def run(self, env):
+        Count.evaluations += 1
+        env["y"] = 2*env["x"]
+
+class Double(Task):
+    
+    batches = []
+    
+    def run(self, env):
+        if env["x"] < 0:
+            raise TaskError("negative input")
+        
+        env["y"] = 2*env["x"]
+        
+    def run_batch(self, envs):
+        Double.batches.append(len(envs))
+        
+        for env in envs:
+            self.run(env)
+
+class Node(Task):
+    
+    def run(self, env):
+        if env.get("fail") == "crash" and not os.path.exists(env["marker"]):
+            open(env["marker"], "w").close()
+            os._exit(1)
+            
+        if env.get("fail") == "unpicklable":
+            raise AssertionError(threading.Lock())
+            
+        if env.get("fail") == "hang" and not os.path.exists(env["marker"]):
+            open(env["marker"], "w").close()
+            time.sleep(5)
+            
+        env["started"] = time.time()
+        time.sleep(env.get("delay", 0))
+        env["pid"] = os.getpid()
+        env["y"] = 2*env["x"]
+
+class Remember(Task):
+    
+    statuses = []
+    
+    def run(self, env):
+        Remember.statuses.append(env["PROCESS_STATUS"])
+
+class Fail(Task):
+    
+    def run(self, env):
+        raise AssertionError(threading.Lock())
+
 class Test(unittest.TestCase):
 
 
@@ -43,6 +115,35 @@ class Test(unittest.TestCase):
         
         os.remove(tmp_file)
         
+    def test_xml_stream(self):
+        input = "<root>" + "".join("<other><value2>0</value2></other><key name=\"y%d\"><value1>%d</value1><value2>%d</value2></key>" % (i, i, 2*i) for i in range(1000)) + "</root>"
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write(input)
+        
+        env = {}
+        ParseXML(tmp_file, stream=True) \
+            .get(".//key[@name='y1']/value1", "y1", float) \
+            .get("//key/value2/text()", "y2", int) \
+            .get("//key[@name='y3']/@name", "y3") \
+            .run(env)
+        self.assertEquals(env["y1"], 1)
+        self.assertEquals(env["y2"], [2*i for i in range(1000)])
+        self.assertEquals(env["y3"], "y3")
+        
+        os.remove(tmp_file)
+        
+    def test_xml_elementtree(self):
+        import xml.etree.cElementTree as etree
+        input = "<root><key name=\"y1\"><value>1</value><value>2</value></key><key name=\"y2\"><value>3</value></key></root>"
+        tree = etree.ElementTree(etree.fromstring(input))
+        
+        self.assertEquals(tasks._XPathQuery(".//key[@name='y1']/value", etree=etree).evaluate(tree), ["1", "2"])
+        self.assertEquals(tasks._XPathQuery("/root/key[@name='y2']/value/text()", etree=etree).evaluate(tree), ["3"])
+        self.assertEquals(tasks._XPathQuery("//key/@name", etree=etree).evaluate(tree), ["y1", "y2"])
+        self.assertEquals(tasks._XPathQuery("//key[@name='y1']/value", True, etree).evaluate(tree.getroot()[0]), ["1", "2"])
+        
     def test_json(self):
         input = "{ \"root\": { \"y1\" : [1, 2], \"y2\" : [3, 4] } }"
         tmp_file = tempfile.mktemp()
@@ -71,6 +172,27 @@ class Test(unittest.TestCase):
         
         os.remove(tmp_file)
         
+    def test_json_stream(self):
+        input = "{ \"root\": { \"y1\" : [1, 2], \"y2\" : [3.5, 4], \"z\" : [ { \"w\" : 5 }, { \"w\" : 6 } ] } }"
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write(input)
+        
+        env = {}
+        ParseJSON(tmp_file, stream=True) \
+            .get("root.y1[0]", "y1", float) \
+            .get("root.y2", "y2", float) \
+            .get("root.z[*].w", "w", int) \
+            .get("root.z[1]", "z", dict) \
+            .run(env)
+        self.assertEquals(env["y1"], 1)
+        self.assertEquals(env["y2"], [3.5, 4])
+        self.assertEquals(env["w"], [5, 6])
+        self.assertEquals(env["z"], { "w" : 6 })
+        
+        os.remove(tmp_file)
+        
     def test_csv(self):
         input = "y1,y2\n1,3\n2,4"
         tmp_file = tempfile.mktemp()
@@ -113,6 +235,83 @@ class Test(unittest.TestCase):
         
         os.remove(tmp_file)
         
+    def test_csv_expressions(self):
+        input = "name, value, weight\na, 1, 0.5\nb, 2, 1.5\na, 3, 2.5\n"
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write(input)
+        
+        env = {}
+        ParseCSV(tmp_file) \
+            .get("row['value'] if row['name']=='a'", "a", int) \
+            .get("row['weight'] if 'b'==row['name']", "b", float) \
+            .get("float(row['weight']) if float(row['value'])>1", "heavy") \
+            .get("row['value']", "first", int, first=True) \
+            .run(env)
+        self.assertEquals(env["a"], [1, 3])
+        self.assertEquals(env["b"], 1.5)
+        self.assertEquals(env["heavy"], ["1.5", "2.5"])
+        self.assertEquals(env["first"], 1)
+        
+        os.remove(tmp_file)
+        
+    def test_table(self):
+        input = "t, x, y\n" + "".join("%d, %d, %f\n" % (i, i % 3, i / 2.0) for i in range(100))
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write(input)
+        
+        env = {}
+        ParseTable(tmp_file, chunksize=64) \
+            .get("y") \
+            .get("t", "t1", where="(row['x'] == 1) & (row['t'] < 50)") \
+            .get("y", "y2", where=lambda row: row["x"] == 2) \
+            .run(env)
+        self.assertEquals(env["y"].tolist(), [i / 2.0 for i in range(100)])
+        self.assertEquals(env["t1"].tolist(), [i for i in range(50) if i % 3 == 1])
+        self.assertEquals(env["y2"].tolist(), [i / 2.0 for i in range(100) if i % 3 == 2])
+        
+        os.remove(tmp_file)
+        
+    def test_table_tabs(self):
+        input = "1\t3\r\n2\t4\r\n"
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write(input)
+        
+        env = {}
+        ParseTable(tmp_file, delimiter="\t", header=False).get(1, "y2").run(env)
+        self.assertEquals(env["y2"].tolist(), [3, 4])
+        
+        os.remove(tmp_file)
+    
+    def test_table_rows(self):
+        tmp_file = tempfile.mktemp()
+        
+        with open(tmp_file, "w") as f:
+            f.write("a,b\n1,2\n\n3,4\n\n")
+        
+        env = {}
+        ParseTable(tmp_file).get("b").run(env)
+        self.assertEquals(env["b"].tolist(), [2, 4])
+        
+        # rows with extra or missing columns are rejected, even if the
+        # number of cells in the chunk adds up
+        with open(tmp_file, "w") as f:
+            f.write("a,b\n1,2,3\n4\n")
+        
+        self.assertRaises(TaskError, ParseTable(tmp_file).get("b").run, {})
+        
+        with open(tmp_file, "w") as f:
+            f.write("a,b\n1,2\n3,x\n")
+        
+        self.assertRaises(TaskError, ParseTable(tmp_file).get("b").run, {})
+        
+        os.remove(tmp_file)
+        
     def test_substitute(self):
         tmp_dir = tempfile.mkdtemp()
         print(tmp_dir)
@@ -135,6 +334,784 @@ class Test(unittest.TestCase):
             self.assertEquals(f.read(), "${val}")
             
         shutil.rmtree(tmp_dir)
+        
+    def test_copy_snapshot(self):
+        template_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(template_dir, "sub"))
+        
+        with open(os.path.join(template_dir, "static.txt"), "w") as f:
+            f.write("static")
+            
+        with open(os.path.join(template_dir, "sub", "config.txt"), "w") as f:
+            f.write("x=${x}")
+            
+        with open(os.path.join(template_dir, "sub", "data.txt"), "w") as f:
+            f.write("data")
+        
+        copy = Copy(template_dir, snapshot=True)
+        
+        for x in [1, 2]:
+            tmp_dir = tempfile.mkdtemp()
+            env = { "WORK_DIR" : tmp_dir, "x" : x }
+            copy.run(env)
+            Substitute().run(env)
+            
+            with open(os.path.join(tmp_dir, "sub", "config.txt")) as f:
+                self.assertEquals(f.read(), "x=" + str(x))
+                
+            with open(os.path.join(tmp_dir, "static.txt")) as f:
+                self.assertEquals(f.read(), "static")
+                
+            self.assertEquals(os.stat(os.path.join(tmp_dir, "static.txt")).st_ino,
+                              os.stat(os.path.join(template_dir, "static.txt")).st_ino)
+            self.assertNotIn("PENDING_TEMPLATES", env)
+            shutil.rmtree(tmp_dir)
+            
+        # substituting a subfolder renders its templates and skips the links
+        tmp_dir = tempfile.mkdtemp()
+        env = { "WORK_DIR" : tmp_dir, "x" : 3 }
+        copy.run(env)
+        Substitute(os.path.join(tmp_dir, "sub")).run(env)
+        
+        with open(os.path.join(tmp_dir, "sub", "config.txt")) as f:
+            self.assertEquals(f.read(), "x=3")
+            
+        self.assertEquals(os.stat(os.path.join(tmp_dir, "sub", "data.txt")).st_ino,
+                          os.stat(os.path.join(template_dir, "sub", "data.txt")).st_ino)
+        self.assertEquals(len(env["PENDING_TEMPLATES"]), 1)
+        
+        Substitute().run(env)
+        self.assertNotIn("PENDING_TEMPLATES", env)
+        shutil.rmtree(tmp_dir)
+        shutil.rmtree(template_dir)
+        
+    def test_substitute_str(self):
+        env = { "a" : 1.5, "b" : "x" }
+        self.assertEquals(utils.substitute("${a} $b $$ ${c} $", env), "1.5 x $ ${c} $")
+        self.assertEquals(utils.substitute("no placeholders", env), "no placeholders")
+        self.assertIs(utils.compile_template("${a}"), utils.compile_template("${a}"))
+        self.assertEquals(utils.get_substitution_key("${a}", env), "a")
+        self.assertEquals(utils.get_substitution_key("${c}", env), None)
+        self.assertEquals(utils.get_substitution_key(5, env), None)
+        
+    def test_exit_code(self):
+        with Executioner() as executioner:
+            executioner.add(Execute("sh -c 'exit 3'"))
+            executioner.add(CheckExitCode(ok=3))
+            env = executioner.evaluate()
+            
+            self.assertEquals(env["EXIT_CODE"], 3)
+            self.assertIsNotNone(env["PROCESS_STATUS"].rusage)
+            self.assertFalse(env["PROCESS_STATUS"].timed_out)
+            
+    def test_timeout(self):
+        with Executioner() as executioner:
+            executioner.add(Execute("sleep 10", timeout=0.1))
+            executioner.add(CheckExitCode())
+            
+            start = time.time()
+            env = executioner.evaluate()
+            
+            self.assertLess(time.time() - start, 1)
+            self.assertTrue(env["PROCESS_STATUS"].timed_out)
+            self.assertIsInstance(executioner.last_error, TaskError)
+    
+    def test_reaper_without_pidfd(self):
+        pidfd_open = utils.pidfd_open
+        utils.pidfd_open = lambda pid: None
+        reaper = utils.ProcessReaper()
+        
+        try:
+            sleeping = reaper.track(subprocess.Popen(["sleep", "10"]), 0.2)
+            statuses = [reaper.track(subprocess.Popen(["sh", "-c", "exit " + str(i)])) for i in range(3)]
+            
+            # a process reaped by the waiter before it is tracked
+            early = subprocess.Popen(["sh", "-c", "exit 4"])
+            time.sleep(0.1)
+            statuses.append(reaper.track(early))
+            
+            self.assertEquals([status.wait(5) for status in statuses], [0, 1, 2, 4])
+            self.assertEquals([status.poll() for status in statuses], [0, 1, 2, 4])
+            self.assertIsNotNone(sleeping.wait(5))
+            self.assertTrue(sleeping.timed_out)
+        finally:
+            utils.pidfd_open = pidfd_open
+            reaper.stop()
+    
+    def test_cache(self):
+        tmp_file = tempfile.mktemp()
+        Count.evaluations = 0
+        
+        with Executioner() as executioner:
+            executioner.add(Count())
+            executioner.enableCache(maxsize=2, path=tmp_file)
+            results = executioner.evaluateBatch([{"x" : 1}, {"x" : 2}, {"x" : 1}, {"x" : 3}, {"x" : 1}])
+            
+            self.assertEquals(results.to_list("y"), [2, 4, 2, 6, 2])
+            self.assertEquals(Count.evaluations, 3)
+            
+        with Executioner() as executioner:
+            executioner.add(Count())
+            executioner.enableCache(path=tmp_file)
+            self.assertEquals(executioner.evaluate({"x" : 2})["y"], 4)
+            self.assertEquals(Count.evaluations, 3)
+            
+            executioner.add(Format("y"))
+            self.assertEquals(executioner.evaluate({"x" : 2})["y"], "4")
+            self.assertEquals(Count.evaluations, 4)
+            
+        os.remove(tmp_file)
+        
+    def test_cache_process_backend(self):
+        Count.evaluations = 0
+        
+        with Executioner() as executioner:
+            executioner.add(Count())
+            executioner.enableCache()
+            results = executioner.evaluateBatch([{"x" : 1}, {"x" : 2}, {"x" : 3}], workers=2, backend="process")
+            
+            self.assertEquals(results.to_list("y"), [2, 4, 6])
+            self.assertEquals(len(executioner.cache.memory), 3)
+            
+            self.assertEquals(executioner.evaluate({"x" : 2})["y"], 4)
+            self.assertEquals(Count.evaluations, 0)
+
+    def test_fingerprint(self):
+        import math
+        import numpy
+        
+        def scale(k):
+            return lambda x: k * x
+        
+        self.assertNotEquals(cache.fingerprint([lambda x: math.sin(x)]), cache.fingerprint([lambda x: math.cos(x)]))
+        self.assertNotEquals(cache.fingerprint([scale(2)]), cache.fingerprint([scale(3)]))
+        self.assertEquals(cache.fingerprint([scale(2)]), cache.fingerprint([scale(2)]))
+        self.assertNotEquals(cache.fingerprint([numpy.zeros(3)]), cache.fingerprint([numpy.ones(3)]))
+        self.assertNotEquals(cache.fingerprint([numpy.zeros(3)]), cache.fingerprint([numpy.zeros(3, dtype=int)]))
+        self.assertNotEquals(cache.fingerprint([set([1, 2])]), cache.fingerprint([set([1, 3])]))
+        self.assertRaises(TypeError, cache.fingerprint, [threading.Lock()])
+        
+        # tasks that can not be fingerprinted are not cached
+        with Executioner() as executioner:
+            count = Count()
+            count.lock = threading.Lock()
+            executioner.add(count)
+            executioner.enableCache()
+            executioner.evaluate({"x" : 1})
+            self.assertTrue(executioner.cache is None)
+    
+    def test_process_backend(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            
+            inputs = dtlz2_inputs(20)
+            expected = executioner.evaluateBatch(inputs)
+            actual = executioner.evaluateBatch(inputs, workers=4, backend="process")
+            
+            self.assertEquals(len(actual), 20)
+            self.assertEquals(actual.to_list("y1"), expected.to_list("y1"))
+            self.assertEquals(actual.to_list("y2"), expected.to_list("y2"))
+            self.assertNotIn("STDIN", actual[0])
+            
+    def test_worker_errors(self):
+        with Executioner() as executioner:
+            executioner.onStart(Fail())
+            
+            # errors that can not be pickled are sent as a WorkerError
+            with self.assertRaises(WorkerError) as context:
+                executioner.evaluateBatch([{}], workers=2, backend="process")
+                
+            self.assertIn("AssertionError", context.exception.remote_traceback)
+            
+            with self.assertRaises(AssertionError):
+                executioner.evaluateBatch([{}], workers=2, backend="thread")
+            
+    def test_pipelined_backend(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            
+            inputs = dtlz2_inputs(100)
+            expected = executioner.evaluateBatch(inputs)
+            actual = executioner.evaluateBatch(inputs, backend=PipelinedBackend(window=16, batch=4))
+            
+            self.assertEquals(actual.to_list("y1"), expected.to_list("y1"))
+            self.assertEquals(actual.to_list("y2"), expected.to_list("y2"))
+            
+    def test_batch_backend(self):
+        with Executioner() as executioner:
+            executioner.add(Double())
+            executioner.add(Count())
+            
+            Double.batches = []
+            results = executioner.evaluateBatch([{"x":i} for i in range(10)], backend=BatchBackend(batch=4))
+            self.assertEquals(results.to_list("y"), [2*i for i in range(10)])
+            self.assertEquals(Double.batches, [4, 4, 2])
+            self.assertTrue(Double().supports_batch())
+            self.assertFalse(Count().supports_batch())
+            
+            # a failed batch is evaluated again one input at a time
+            Double.batches = []
+            results = executioner.evaluateBatch([{"x":1}, {"x":-1}, {"x":3}], backend="batch")
+            self.assertEquals(Double.batches, [3])
+            self.assertEquals([env.get("y") for env in results], [2, None, 6])
+            
+    def test_adaptive_backend(self):
+        backend = ThreadBackend(workers=2, adaptive=True)
+        inputs = [{"x":i, "delay":0.2 if i % 5 == 4 else 0.01} for i in range(20)]
+        
+        with Executioner() as executioner:
+            executioner.add(Node())
+            executioner.evaluateBatch(inputs, backend=backend)
+            self.assertGreater(backend.cost_model.predict([{"x":4, "delay":0.2}])[0], 0.1)
+            
+            # the expensive inputs start first, but results remain in order
+            results = executioner.evaluateBatch(inputs, backend=backend)
+            self.assertEquals(results.to_list("y"), [2*i for i in range(20)])
+            order = sorted(range(20), key=lambda i: results[i]["started"])
+            self.assertEquals(sorted(order[:4]), [4, 9, 14, 19])
+            
+    def test_speculative_backend(self):
+        tempdir = tempfile.mkdtemp()
+        marker = os.path.join(tempdir, "marker")
+        
+        # the first run of the last input hangs, the duplicate finishes
+        script = "import os, sys, time; time.sleep(0.05 if os.path.exists(sys.argv[1]) or sys.argv[2] != '1' " + \
+            "else open(sys.argv[1], 'w').close() or 60)"
+        
+        try:
+            with Executioner() as executioner:
+                executioner.add(Execute(sys.executable + " -c \"" + script + "\" " + marker + " ${slow}"))
+                executioner.add(CheckExitCode())
+                executioner.add(Node())
+                
+                inputs = [{"x":i, "slow":1 if i == 12 else 0} for i in range(13)]
+                start = time.time()
+                results = executioner.evaluateBatch(inputs, backend=ThreadBackend(workers=3, speculate=2.0))
+                
+                self.assertLess(time.time() - start, 30)
+                self.assertEquals(results.to_list("y"), [2*i for i in range(13)])
+                
+            # cancelling a worker's first evaluation spares the model started
+            # by its start tasks
+            os.remove(marker)
+            
+            with Executioner() as executioner:
+                executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+                executioner.add(WriteInput(DTLZ2_INPUT))
+                executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+                executioner.add(Execute(sys.executable + " -c \"" + script + "\" " + marker + " ${slow}"))
+                executioner.add(CheckExitCode())
+                executioner.onComplete(WriteInput("\n"))
+                
+                inputs = dtlz2_inputs(30)
+                
+                for i, input in enumerate(inputs):
+                    input["slow"] = 1 if i == 0 else 0
+                
+                # a small window duplicates the first input while later inputs
+                # are still waiting to run on the same worker
+                backend = ThreadBackend(workers=3, window=4, speculate=2.0)
+                backend.min_samples = 2
+                results = executioner.evaluateBatch(inputs, backend=backend)
+                self.assertEquals(results.to_list("y1"), self.dtlz2(inputs).to_list("y1"))
+                
+            # results do not wait on a copy that can not be cancelled
+            os.remove(marker)
+            
+            with Executioner() as executioner:
+                executioner.add(Node())
+                
+                inputs = [{"x":i, "delay":0.05} for i in range(13)]
+                inputs[12].update(fail="hang", marker=marker)
+                start = time.time()
+                results = executioner.evaluateStream(inputs, backend=ThreadBackend(workers=3, speculate=2.0))
+                
+                self.assertEquals([next(results)["y"] for i in range(13)], [2*i for i in range(13)])
+                self.assertLess(time.time() - start, 4)
+                results.close()
+        finally:
+            shutil.rmtree(tempdir)
+            
+    def test_stream(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            
+            inputs = dtlz2_inputs(50)
+            expected = executioner.evaluateBatch(inputs).to_list("y1")
+            
+            for backend in ["serial", "thread", "process", "pipelined"]:
+                results = executioner.evaluateStream(iter(inputs), workers=3, backend=backend)
+                self.assertEquals([env["y1"] for env in results], expected)
+                
+            results = list(executioner.evaluateStream(iter(inputs), workers=3, backend="thread", ordered=False))
+            self.assertEquals(sorted(env["y1"] for env in results), sorted(expected))
+            self.assertNotIn("STDIN", results[0])
+            self.assertNotIn("PORT", results[0])
+            self.assertIn("x1", results[0])
+            
+    def test_result_table(self):
+        table = ResultTable(capacity=2)
+        table.append({ "a" : 1, "b" : [1.0, 2.0], "c" : "x" })
+        table.append({ "a" : 2, "b" : [3.0, 4.0], "c" : "y" })
+        table.append({ "a" : 3.5, "b" : [5.0, 6.0] })
+        
+        self.assertEquals(len(table), 3)
+        self.assertEquals(table.to_list("a"), [1.0, 2.0, 3.5])
+        self.assertEquals(table.to_list("b", index=1), [2.0, 4.0, 6.0])
+        self.assertEquals(table.to_list("c"), ["x", "y", None])
+        self.assertEquals(table[1], { "a" : 2.0, "b" : [3.0, 4.0], "c" : "y" })
+        self.assertEquals(table[-1]["a"], 3.5)
+        
+        column = table.to_nparray("a")
+        column[0] = 10
+        self.assertEquals(table["a"][0], 10)
+        
+        subset = table[1:, "a"]
+        self.assertEquals(subset.keys(), ["a"])
+        self.assertEquals(subset.to_list(), [2.0, 3.5])
+        
+        structured = table.to_structured(["a", "b"])
+        self.assertEquals(structured["b"].shape, (3, 2))
+        self.assertEquals(structured[2]["a"], 3.5)
+        
+    def test_columnar_batch(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            
+            inputs = dtlz2_inputs(10)
+            expected = executioner.evaluateBatch(inputs)
+            actual = executioner.evaluateBatch(inputs, columnar=True)
+            
+            self.assertEquals(actual.to_list("y1"), expected.to_list("y1"))
+            self.assertEquals(actual["y2"].dtype.kind, "f")
+            self.assertNotIn("STDIN", actual.keys())
+            
+    def test_connection_pool(self):
+        s = socket.socket()
+        s.bind(("", 0))
+        port = s.getsockname()[1]
+        s.close()
+        
+        pool = ConnectionPool(socket.gethostname() + ":" + str(port), size=3, delay=0.1)
+        
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2_SOCKET + " " + str(port)).share("server"))
+            executioner.add(Checkout(pool))
+            executioner.add(Send(DTLZ2_INPUT))
+            executioner.add(Receive())
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.add(Release())
+            executioner.onError(Release(discard=True))
+            executioner.onComplete(Checkout(pool).share("server"))
+            executioner.onComplete(Send("\n").share("server"))
+            executioner.onComplete(Release(discard=True).share("server"))
+            executioner.onComplete(ClosePool(pool).share("server"))
+            
+            inputs = dtlz2_inputs(30)
+            results = executioner.evaluateBatch(inputs, workers=3, backend="thread")
+            
+            self.assertNotIn("CONNECTION", results[0])
+            self.assertEquals(results.to_list("y1"), self.dtlz2(inputs).to_list("y1"))
+            
+        # times out while every connection is checked out
+        with self.assertRaises(TaskError):
+            Checkout(ConnectionPool("localhost:" + str(port), size=0), timeout=0.1).run({})
+        
+        # connections not released by a failed evaluation are replaced
+        server = socket.socket()
+        server.bind(("localhost", 0))
+        server.listen(5)
+        pool = ConnectionPool("localhost:" + str(server.getsockname()[1]), size=1)
+        
+        with Executioner() as executioner:
+            executioner.add(Checkout(pool, timeout=1))
+            executioner.add(Double())
+            executioner.add(Release())
+            
+            for x in [-1, -2, 3]:
+                env = executioner.evaluate({"x" : x})
+                self.assertNotIn("CONNECTION", env)
+            
+            self.assertEquals(env["y"], 6)
+            self.assertEquals(len(pool._idle), 1)
+        
+        pool.close()
+        server.close()
+            
+    def test_pool_fill(self):
+        def create(name):
+            time.sleep(0.5)
+            return name
+        
+        pool = utils.ResourcePool(create, size=4)
+        start = time.time()
+        pool.fill(("engine",))
+        self.assertLess(time.time() - start, 1.5)
+        
+        leased = [pool.acquire(0) for i in range(4)]
+        self.assertEquals(leased, ["engine"]*4)
+        self.assertRaises(PoolTimeout, pool.acquire, 0)
+        
+        # discarded resources are replaced by the next fill
+        pool.release(leased[0], discard=True)
+        pool.fill(("restarted",))
+        self.assertEquals(pool.acquire(0), "restarted")
+        
+        # errors raised by create are not reported as timeouts
+        def fail(env):
+            raise RuntimeError("create failed")
+        
+        with self.assertRaisesRegexp(RuntimeError, "create failed"):
+            Checkout(utils.ResourcePool(fail)).run({})
+        
+    def test_distributed(self):
+        backend = DistributedBackend(timeout=2.0)
+        (host, port) = backend.listen()
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        nodes = [subprocess.Popen([sys.executable, "-m", "executioner.distributed", host + ":" + str(port),
+                                   "--heartbeat", "0.2"], cwd=root) for i in range(3)]
+        tempdir = tempfile.mkdtemp()
+        
+        try:
+            with Executioner() as executioner:
+                executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+                executioner.add(WriteInput(DTLZ2_INPUT))
+                executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+                executioner.onComplete(WriteInput("\n"))
+                
+                backend.wait(3, timeout=30)
+                inputs = dtlz2_inputs(30)
+                results = executioner.evaluateBatch(inputs, backend=backend)
+                self.assertEquals(results.to_list("y1"), self.dtlz2(inputs).to_list("y1"))
+            
+            # Copy and pooled tasks are sent to the workers
+            template_dir = os.path.join(tempdir, "template")
+            os.mkdir(template_dir)
+            
+            with open(os.path.join(template_dir, "input.txt"), "w") as f:
+                f.write(DTLZ2_INPUT)
+            
+            pool = WarmPool()
+            
+            with Executioner() as executioner:
+                executioner.add(CreateTempDir())
+                executioner.add(Copy(template_dir, snapshot=True))
+                executioner.add(Substitute())
+                executioner.add(Execute(sys.executable + " " + DTLZ2, warm=pool))
+                executioner.add(WriteInput(DTLZ2_INPUT))
+                executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+                executioner.add(DeleteTempDir())
+                executioner.onComplete(ClosePool(pool))
+                
+                inputs = dtlz2_inputs(10)
+                results = executioner.evaluateBatch(inputs, backend=backend)
+                self.assertEquals(results.to_list("y1"), self.dtlz2(inputs).to_list("y1"))
+                
+                # tasks that can not be pickled are reported before sending
+                executioner.add(Execute(sys.executable + " " + DTLZ2, warm=utils.ResourcePool(lambda: None)))
+                
+                with self.assertRaisesRegexp(TaskError, "Execute"):
+                    executioner.evaluateBatch(inputs, backend=backend)
+            
+            with Executioner() as executioner:
+                executioner.add(Node())
+                
+                # idle workers steal the inputs queued behind the slow input
+                inputs = [{"x":i, "delay":2.0 if i == 0 else 0.1} for i in range(12)]
+                results = executioner.evaluateBatch(inputs, backend=backend)
+                self.assertEquals(results.to_list("y"), [2*i for i in range(12)])
+                self.assertNotIn(results[0]["pid"], [results[i]["pid"] for i in range(6, 12)])
+                
+                # inputs lost when a worker crashes are resubmitted to the
+                # remaining workers
+                inputs = [{"x":i} for i in range(10)]
+                inputs[3].update(fail="crash", marker=os.path.join(tempdir, "crash"))
+                results = executioner.evaluateBatch(inputs, backend=backend)
+                self.assertEquals(results.to_list("y"), [2*i for i in range(10)])
+                self.assertEquals(len(backend.workers), 2)
+                
+                # as are inputs sent to a worker that stops sending heartbeats
+                silent = socket.create_connection((host, port))
+                silent.sendall(utils.pack_frame(utils.FRAME_PICKLE, ("hello", "silent", 1)))
+                backend.wait(3, timeout=30)
+                results = executioner.evaluateBatch([{"x":i} for i in range(10)], backend=backend)
+                self.assertEquals(results.to_list("y"), [2*i for i in range(10)])
+                self.assertEquals(len(backend.workers), 2)
+                silent.close()
+                
+                # errors that can not be pickled are sent as a WorkerError
+                with self.assertRaises(WorkerError):
+                    executioner.evaluateBatch([{"x":1, "fail":"unpicklable"}], backend=backend)
+        finally:
+            backend.close()
+            
+            for node in nodes:
+                if node.poll() is None:
+                    node.kill()
+                    
+                node.wait()
+                
+            shutil.rmtree(tempdir)
+            
+    def test_warm_pool(self):
+        def pipeline(executioner, execute):
+            executioner.add(execute)
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.add(WriteInput("\n"))
+            executioner.add(CheckExitCode())
+            
+        inputs = dtlz2_inputs(12)
+        expected = self.dtlz2(inputs).to_list("y1")
+        
+        with Executioner() as executioner:
+            pipeline(executioner, Execute(sys.executable + " " + DTLZ2))
+            self.assertEquals(executioner.evaluateBatch(inputs).to_list("y1"), expected)
+            
+        pools = [WarmPool(uses=5),
+                 WarmPool(transport="socket"),
+                 WarmPool(transport="fifo", memory=1)]
+        commands = [sys.executable + " " + DTLZ2,
+                    sys.executable + " " + DTLZ2_SOCKET + " ${WARM_PORT}",
+                    "sh -c 'exec " + sys.executable + " " + DTLZ2 + " < ${REQUEST_FIFO} > ${RESPONSE_FIFO}'"]
+        
+        for pool, command in zip(pools, commands):
+            execute = Execute(command, warm=pool)
+            fingerprint = cache.fingerprint([execute])
+            
+            with Executioner() as executioner:
+                pipeline(executioner, execute)
+                executioner.onComplete(ClosePool(pool))
+                self.assertEquals(executioner.evaluateBatch(inputs).to_list("y1"), expected)
+                
+            self.assertEquals(cache.fingerprint([execute]), fingerprint)
+                
+        # recycled after 5 uses, kept for all uses, recycled over the
+        # memory limit
+        self.assertEquals([pool._started for pool in pools], [3, 1, 12])
+        
+        # failed exchanges replace the process
+        pool = WarmPool()
+        
+        with Executioner() as executioner:
+            pipeline(executioner, Execute(sys.executable + " -c \"import sys; sys.stdin.readline()\"", warm=pool))
+            executioner.onComplete(ClosePool(pool))
+            self.assertNotIn("y1", executioner.evaluate(inputs[0]))
+            self.assertNotIn("y1", executioner.evaluate(inputs[0]))
+            
+        self.assertEquals(pool._started, 2)
+        
+        # evaluations failing before the response is read return the process
+        pool = WarmPool()
+        
+        with Executioner() as executioner:
+            executioner.add(Execute("cat", warm=pool))
+            executioner.add(Double())
+            executioner.add(WriteInput("${y}\n"))
+            executioner.add(ParseLine(type=int, name=["z"]))
+            executioner.onComplete(ClosePool(pool))
+            self.assertNotIn("z", executioner.evaluate({"x":-1}))
+            self.assertNotIn("z", executioner.evaluate({"x":-1}))
+            self.assertEquals(executioner.evaluate({"x":1})["z"], 2)
+            
+            # or time out while every process is leased
+            process = pool.acquire(args=("cat",))
+            
+            with self.assertRaises(TaskError):
+                Execute("cat", timeout=0.1, warm=pool).run({})
+                
+            pool.release(process)
+        
+    def test_binary_frames(self):
+        s = socket.socket()
+        s.bind(("", 0))
+        port = s.getsockname()[1]
+        s.close()
+        
+        names = ["x" + str(i+1) for i in range(11)]
+        
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2_SOCKET + " " + str(port) + " binary"))
+            executioner.onStart(Checkout(ConnectionPool(socket.gethostname() + ":" + str(port), delay=0.1)))
+            executioner.add(SendVector(names))
+            executioner.add(ReceiveVector(["y1", "y2"]))
+            executioner.onComplete(SendVector([]))
+            executioner.onComplete(Release(discard=True))
+            
+            inputs = dtlz2_inputs(10)
+            results = executioner.evaluateBatch(inputs)
+            
+            expected = self.dtlz2(inputs)
+            
+            for y1, y2 in zip(results.to_list("y1"), expected.to_list("y1")):
+                self.assertAlmostEquals(y1, y2, places=15)
+                
+    def test_frames(self):
+        for (type, value) in [(utils.FRAME_VECTOR, [1.5, -2.0, 1e300]),
+                              (utils.FRAME_RECORD, { "a" : 1, "b" : [1.0, 2.0] })]:
+            frame = StringIO(utils.pack_frame(type, value))
+            self.assertEquals(utils.read_frame(frame)[1], value)
+        
+    def dtlz2(self, inputs):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            return executioner.evaluateBatch(inputs)
+            
+    def test_thread_backend(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            
+            inputs = dtlz2_inputs(20)
+            expected = executioner.evaluateBatch(inputs)
+            actual = executioner.evaluateBatch(inputs, workers=4, backend="thread")
+            
+            self.assertEquals(actual.to_list("y1"), expected.to_list("y1"))
+            self.assertEquals(len(set(env["PROCESS"].pid for env in actual)), 4)
+            
+    def test_thread_backend_shared(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2).share("dtlz2"))
+            executioner.add(WriteInput(DTLZ2_INPUT).share("dtlz2"))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]).share("dtlz2"))
+            executioner.onComplete(WriteInput("\n").share("dtlz2"))
+            
+            inputs = dtlz2_inputs(20)
+            expected = executioner.evaluateBatch(inputs)
+            actual = executioner.evaluateBatch(inputs, workers=4, backend="thread")
+            
+            self.assertEquals(actual.to_list("y1"), expected.to_list("y1"))
+            self.assertEquals(len(set(env["PROCESS"].pid for env in actual)), 1)
+            
+    def test_async(self):
+        with AsyncExecutioner(concurrency=8) as executioner:
+            executioner.add(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.add(WriteInput("\n"))
+            executioner.add(CheckExitCode())
+            
+            inputs = dtlz2_inputs(20)
+            results = executioner.evaluateBatch(inputs)
+            
+            self.assertEquals(results.to_list("y1"), self.dtlz2(inputs).to_list("y1"))
+            self.assertEquals(len(set(env["PROCESS"].pid for env in results)), 20)
+            
+        self.assertIsNone(executioner.loop)
+            
+    def test_async_socket(self):
+        s = socket.socket()
+        s.bind(("", 0))
+        port = s.getsockname()[1]
+        s.close()
+        
+        with AsyncExecutioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2_SOCKET + " " + str(port)))
+            executioner.onStart(Pause(1))
+            executioner.add(Connect(server="localhost", port=port))
+            executioner.add(Send(DTLZ2_INPUT))
+            executioner.add(Receive())
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.add(Disconnect())
+            executioner.onComplete(Connect(server="localhost", port=port))
+            executioner.onComplete(Send("\n"))
+            executioner.onComplete(Disconnect())
+            
+            inputs = dtlz2_inputs(30)
+            results = list(executioner.evaluateStream(inputs, ordered=False))
+            
+            self.assertEquals(sorted(env["y1"] for env in results), sorted(self.dtlz2(inputs).to_list("y1")))
+            
+    def test_async_cancel(self):
+        Remember.statuses = []
+        
+        with AsyncExecutioner() as executioner:
+            executioner.add(Execute(sys.executable + " -c \"import time; time.sleep(${delay})\"", ignore_stdout=True, ignore_stderr=True))
+            executioner.add(Remember())
+            executioner.add(CheckExitCode())
+            
+            start = time.time()
+            stream = executioner.evaluateStream([{"delay" : 0}, {"delay" : 30}, {"delay" : 30}], ordered=False)
+            self.assertEquals(next(stream)["delay"], 0)
+            stream.close()
+            
+            # the evaluations still running are cancelled and their models killed
+            self.assertEquals(len(executioner.loop.coroutines), 0)
+            self.assertTrue(all(status.wait(10) is not None for status in Remember.statuses))
+            self.assertEquals(sum(status.cancelled for status in Remember.statuses), 2)
+            self.assertLess(time.time() - start, 20)
+            
+            # evaluations left running by an unfinished stream are cancelled on shutdown
+            stream = executioner.evaluateStream([{"delay" : 0}, {"delay" : 30}], ordered=False)
+            next(stream)
+            loop = executioner.loop
+            
+        self.assertEquals(len(loop.coroutines), 0)
+        self.assertTrue(loop.closed)
+        self.assertEquals(sum(status.cancelled for status in Remember.statuses), 3)
+        self.assertTrue(Remember.statuses[-1].wait(10) is not None)
+        
+    def test_profiling(self):
+        with Executioner() as executioner:
+            executioner.onStart(Execute(sys.executable + " " + DTLZ2))
+            executioner.add(WriteInput(DTLZ2_INPUT))
+            executioner.add(ParseLine(type=float, name=["y1", "y2"]))
+            executioner.onComplete(WriteInput("\n"))
+            profiler = executioner.enableProfiling()
+            
+            inputs = dtlz2_inputs(20)
+            executioner.evaluateBatch(inputs)
+            executioner.evaluateBatch(inputs, workers=2, backend="process")
+            
+            report = dict(((p["phase"], p["index"]), p) for p in json.loads(profiler.to_json()))
+            self.assertEquals(report[("evaluate", 0)]["task"], "WriteInput")
+            self.assertEquals(report[("evaluate", 0)]["wall"]["count"], 40)
+            self.assertGreater(report[("evaluate", 1)]["bytes"]["min"], 0)
+            self.assertEquals(report[("start", 0)]["wall"]["count"], 3)
+            self.assertEquals(report[("complete", 0)]["wall"]["count"], 2)
+            
+    def test_histogram(self):
+        histogram = profiling.Histogram()
+        
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+            
+        self.assertAlmostEquals(histogram.percentile(50), 0.5, delta=0.01)
+        self.assertAlmostEquals(histogram.percentile(99), 0.99, delta=0.02)
+        self.assertEquals(histogram.percentile(100), 1.0)
+            
+    def test_logging(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logging.getLogger().addHandler(handler)
+        
+        try:
+            env = { "x" : range(1000), "y" : "a"*1000 }
+            Format("x", format=lambda x: x).run(env)
+            Format("y").quiet().run(env)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            
+        self.assertEquals(messages, ["Formatting x", "Saved x as [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, ... 1000 items]"])
+        self.assertEquals(len(utils.abbreviate(env["y"])), 200 + len("... 1000 characters"))
 
 
 if __name__ == "__main__":
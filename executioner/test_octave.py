@@ -7,6 +7,7 @@ import unittest
 from . import Executioner
 from tasks import *
 from octave import *
+from parallel import BatchBackend
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -55,6 +56,69 @@ class TestOctave(unittest.TestCase):
             executioner.onComplete(StopOctaveEngine())
             self.assertEquals(30, executioner.evaluate({"b":30})["x"])
             
+    def test_bulk(self):
+        with Executioner() as executioner:
+            executioner.onStart(StartOctaveEngine())
+            executioner.add(SetOctaveVar(["a", "b"], [25, "${c}"]))
+            executioner.add(EvaluateOctaveFunction("max", input=["a", "b"], output=["x", "i"]))
+            executioner.add(GetOctaveVar(["a", "b"], rename=["aprime", "bprime"]))
+            executioner.add(Return("x", "i", "aprime", "bprime"))
+            executioner.onComplete(StopOctaveEngine())
+            result = executioner.evaluate({"c":30})
+            self.assertEquals(30, result["x"])
+            self.assertEquals(2, result["i"])
+            self.assertEquals(25, result["aprime"])
+            self.assertEquals(30, result["bprime"])
+            
+            # unchanged inputs are not pushed again
+            self.assertEquals({"a":25, "b":30}, executioner.env["OCTAVE_PUSHED"])
+            self.assertEquals(30, executioner.evaluate({"c":30})["x"])
+            self.assertEquals(40, executioner.evaluate({"c":40})["x"])
+            
+    def test_vectorized(self):
+        with Executioner() as executioner:
+            executioner.onStart(StartOctaveEngine())
+            executioner.add(EvaluateOctaveFunction("max", input=["a", "b"], output=["x"], vectorized=True))
+            executioner.add(Return("x"))
+            executioner.onComplete(StopOctaveEngine())
+            inputs = [{"a":i, "b":10-i} for i in range(10)]
+            results = executioner.evaluateBatch(inputs, backend=BatchBackend(batch=4))
+            self.assertEquals([max(i, 10-i) for i in range(10)], [r["x"] for r in results])
+            
+    def test_pool(self):
+        pool = OctaveEnginePool(size=2, setup=[AddOctavePath(".")])
+        
+        with Executioner() as executioner:
+            executioner.onStart(StartOctavePool(pool))
+            executioner.add(LeaseOctaveEngine(pool))
+            executioner.add(EvaluateOctaveFunction("max", input=["a", "b"], output=["x"]))
+            executioner.add(ReleaseOctaveEngine())
+            executioner.onError(ReleaseOctaveEngine(check=True))
+            executioner.onComplete(ClosePool(pool))
+            inputs = [{"a":i, "b":10-i} for i in range(10)]
+            results = executioner.evaluateBatch(inputs, workers=2, backend="thread")
+            self.assertEquals([max(i, 10-i) for i in range(10)], results.to_list("x"))
+            self.assertNotIn("OCTAVE_ENGINE", results[0])
+            
+            # a crashed session is restarted
+            session = pool.acquire()
+            session.engine.exit()
+            pool.release(session)
+            self.assertNotIn("x", executioner.evaluate({"a":8, "b":2}))
+            self.assertEquals(8, executioner.evaluate({"a":8, "b":2})["x"])
+        
+        # sessions not released by a failed evaluation are returned
+        with Executioner() as executioner:
+            executioner.add(LeaseOctaveEngine(pool, timeout=5))
+            executioner.add(EvaluateOctaveFunction("doesnotexist", input=[25, 35], output=["x"]))
+            executioner.add(ReleaseOctaveEngine())
+            executioner.onComplete(ClosePool(pool))
+            
+            for i in range(3):
+                self.assertNotIn("OCTAVE_SESSION", executioner.evaluate())
+            
+            self.assertEquals(1, len(pool._idle))
+    
     def test_error(self):
         with Executioner() as executioner:
             executioner.onStart(StartOctaveEngine())
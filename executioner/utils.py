@@ -6,11 +6,24 @@ Created on Jul 30, 2015
 
 import os
 import re
+import sys
+import math
+import array
+import struct
+import errno
+import select
+import atexit
 import shutil
 import time
 import logging
 import fnmatch
-from string import Template
+import types
+import platform
+import threading
+import profiling
+from aio import set_nonblocking
+from exceptions import TaskError, PoolTimeout
+from collections import OrderedDict
 
 def copytree(src, dst):
     '''
@@ -31,24 +44,20 @@ def copytree(src, dst):
                 shutil.copy2(s, d)
                 
 def get_substitution_key(key, env):
-    if isinstance(key, str):
+    if not isinstance(key, str):
         return None
     
-    substitionEngine = SubstitionEngine(key)
+    name = compile_template(key).substitution_name
     
-    if (substitionEngine.is_substitution_str()):
-        if substitionEngine.get_substitution_name() in env:
-            return substitionEngine.get_substitution_name()
-        else:
-            return None
+    if name is not None and name in env:
+        return name
     else:
         return None
                 
 def substitute(str, env):
-    substitionEngine = SubstitionEngine(str)
-    return substitionEngine.substitute(env)
+    return compile_template(str).substitute(env)
 
-def substitutetree(src, env, include="*", exclude=None):
+def substitutetree(src, env, include="*", exclude=None, skip=None):
     name = os.path.basename(src)
     
     if not matches(name, include) or matches(name, exclude):
@@ -61,13 +70,143 @@ def substitutetree(src, env, include="*", exclude=None):
             continue
         
         if os.path.isdir(s):
-            substitutetree(s, env)
+            substitutetree(s, env, skip=skip)
+        elif skip is not None and s in skip:
+            continue
         else:
             with open(s) as file:
-                substitionEngine = SubstitionEngine(file.read())
+                template = CompiledTemplate(file.read())
+                
+            if not template.has_substitutions:
+                continue
+            
+            # replace hard linked files instead of writing to the shared file
+            stat = os.stat(s)
+            
+            if stat.st_nlink > 1:
+                os.remove(s)
                 
             with open(s, 'w') as file:
-                file.write(substitionEngine.substitute(env))
+                file.write(template.substitute(env))
+                
+            if stat.st_nlink > 1:
+                os.chmod(s, stat.st_mode)
+                
+# ioctl request for cloning a file on Linux filesystems supporting reflinks
+FICLONE = 0x40049409
+
+def link(src, dst, method="hardlink"):
+    '''
+    Creates dst from src using a hard link, a reflink (a copy-on-write clone)
+    or a copy, falling back to a copy if the link can not be created.
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    
+    try:
+        if method == "hardlink":
+            os.link(src, dst)
+            return
+        elif method == "reflink":
+            import fcntl
+            
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                
+            shutil.copystat(src, dst)
+            return
+    except (AttributeError, ImportError, IOError, OSError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        
+    shutil.copy2(src, dst)
+    
+class TemplateSnapshot(object):
+    '''
+    An index of a template folder built once.  Files containing ${keyword}
+    fields are kept in memory as compiled templates, while the remaining
+    static files are linked into the destination folder on each copy.
+    '''
+    
+    def __init__(self, src):
+        super(TemplateSnapshot, self).__init__()
+        self.src = os.path.abspath(src)
+        self.dirs = []
+        self.static = []
+        self.templates = []
+        
+        for root, dirs, files in os.walk(self.src):
+            relroot = os.path.relpath(root, self.src)
+            
+            for dir in dirs:
+                self.dirs.append(os.path.normpath(os.path.join(relroot, dir)))
+                
+            for file in files:
+                path = os.path.normpath(os.path.join(relroot, file))
+                
+                with open(os.path.join(root, file)) as f:
+                    template = CompiledTemplate(f.read())
+                
+                if template.has_substitutions:
+                    mode = os.stat(os.path.join(root, file)).st_mode
+                    self.templates.append((path, template, mode))
+                else:
+                    self.static.append(path)
+                    
+        logging.info("Created snapshot of %s with %d static files and %d templates",
+                     self.src, len(self.static), len(self.templates))
+                    
+    def copy(self, dst, method="hardlink"):
+        """
+        Creates the folders and links the static files into dst.  The
+        templates are written by render.
+        """
+        if not os.path.exists(dst):
+            os.makedirs(dst)
+        
+        for dir in self.dirs:
+            path = os.path.join(dst, dir)
+            
+            if not os.path.exists(path):
+                os.mkdir(path)
+                
+        for file in self.static:
+            link(os.path.join(self.src, file), os.path.join(dst, file), method)
+            
+    def render(self, dst, env, include="*", exclude=None, root=None):
+        """
+        Writes the templates into dst, substituting keywords in the files
+        selected by include and exclude in the same way as substitutetree
+        run on root.  Root defaults to dst and may also be a folder inside
+        dst, in which case only the templates inside root are written, or a
+        folder containing dst.
+        """
+        root = dst if root is None else root
+        name = os.path.basename(root)
+        substitute = matches(name, include) and not matches(name, exclude)
+        
+        for (file, template, mode) in self.templates:
+            path = os.path.join(dst, file)
+            relpath = os.path.relpath(path, root)
+            
+            if relpath.startswith(os.pardir + os.sep):
+                continue
+            
+            item = relpath.split(os.sep, 1)[0]
+            
+            with open(path, 'w') as f:
+                if substitute and matches(item, include) and not matches(item, exclude):
+                    f.write(template.substitute(env))
+                else:
+                    f.write(template.template)
+                    
+            os.chmod(path, mode)
+            
+    def paths(self, dst):
+        """
+        Returns the set of files in dst created from this snapshot.
+        """
+        return set(os.path.join(dst, file) for file in self.static + [t[0] for t in self.templates])
                 
 def matches(filename, patterns=None):
     '''
@@ -91,20 +230,432 @@ def remove(path):
     else:
         os.remove(path)
         
-def process_monitor(process, timeout=None):
-    start = time.time()
+class ProcessStatus(object):
+    '''
+    The exit code and resource usage of a process tracked by the reaper.  The
+    returncode, rusage and elapsed fields are set once the process exits.
+    timed_out is True if the process was killed for exceeding its timeout,
+    and cancelled is True if it was killed by ProcessReaper.cancel.
     
-    while True:
-        if process.poll() is None:
-            if timeout is not None and time.time() - start > timeout:
-                logging.warn("Process exceeded timeout limit, killing process")
-                process.kill()
+    Since the reaper collects the exit code, the process's exit code must be
+    read with wait or poll, never with the Popen's own wait or poll, which
+    race with the reaper and may report an exit code of 0.
+    '''
+    
+    def __init__(self, process, timeout=None, owner=None):
+        super(ProcessStatus, self).__init__()
+        self.process = process
+        self.pid = process.pid
+        self.owner = owner
+        self.start = time.time()
+        self.deadline = self.start + timeout if timeout is not None else None
+        self.timed_out = False
+        self.cancelled = False
+        self.returncode = None
+        self.rusage = None
+        self.elapsed = None
+        self.fd = None
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        
+    def wait(self, timeout=None):
+        """
+        Waits for the process to exit, returning its exit code or None if the
+        timeout expires first.
+        """
+        self.done.wait(timeout)
+        return self.returncode
+    
+    def poll(self):
+        """
+        Returns the exit code, or None if the process is still running.
+        """
+        with self.lock:
+            return self.returncode
+    
+    def cancel(self):
+        """
+        Kills the process if it is still running, marking it as cancelled.
+        Returns True if the process was killed.
+        """
+        if self.done.is_set():
+            return False
+        
+        logging.info("Cancelling process %d", self.pid)
+        self.cancelled = True
+        
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        
+        return True
+    
+    def add_done_callback(self, callback):
+        """
+        Calls callback(status) once the process exits, immediately if it
+        already has.  The callback runs on the reaper's thread.
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
             
-            time.sleep(1)
-        else:
-            break
+        callback(self)
+        
+    def _finish(self, returncode):
+        with self.lock:
+            self.returncode = returncode
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+            
+        for callback in callbacks:
+            callback(self)
+    
+    
+class ProcessReaper(object):
+    '''
+    A single background thread that tracks every process started by Execute,
+    recording exit codes and resource usage and killing processes that exceed
+    their timeout.  On Linux, the reaper waits on a pidfd for each process,
+    so it wakes up as soon as a process exits or at the next timeout.  On
+    other platforms, a second thread blocks in wait4 for any child while
+    processes are tracked.  That thread also reaps children not started by
+    Execute, whose Popen then reports an exit code of 0.
+    '''
+    
+    def __init__(self):
+        super(ProcessReaper, self).__init__()
+        self.pid = os.getpid()
+        self.statuses = []
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.waiter = None
+        
+        # exit statuses reaped by the waiter before the process was tracked
+        self.unclaimed = OrderedDict()
+        
+        # wakes the reaper thread when a process is tracked or it is stopped
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        set_nonblocking(self.wakeup_read)
+        set_nonblocking(self.wakeup_write)
+        
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
         
-    logging.info("Process terminated with exit code " + str(process.returncode))
+    def track(self, process, timeout=None):
+        """
+        Starts tracking the process, returning its ProcessStatus.  The
+        process belongs to the evaluation running on the calling thread, see
+        set_owner.
+        """
+        status = ProcessStatus(process, timeout, getattr(_owner, "value", None))
+        status.fd = pidfd_open(process.pid)
+        unclaimed = None
+        
+        with self.condition:
+            self.statuses.append(status)
+            
+            if status.fd is None and hasattr(os, "wait4"):
+                unclaimed = self.unclaimed.pop(status.pid, None)
+                
+                if unclaimed is None and self.waiter is None:
+                    self.waiter = threading.Thread(target=self._wait_any)
+                    self.waiter.daemon = True
+                    self.waiter.start()
+                    
+        if status.fd is None and not hasattr(os, "wait4"):
+            thread = threading.Thread(target=self._wait, args=(status,))
+            thread.daemon = True
+            thread.start()
+                
+        if unclaimed is not None:
+            self._collect(status, unclaimed[0], unclaimed[1])
+            
+        self._wakeup()
+        return status
+    
+    def cancel(self, owner):
+        """
+        Kills the running processes started by the given evaluation, such as
+        the slower copy of a speculatively duplicated evaluation.  Returns the
+        number of processes killed.
+        """
+        with self.condition:
+            statuses = [status for status in self.statuses if status.owner == owner]
+            
+        return len([status for status in statuses if status.cancel()])
+    
+    def stop(self):
+        """
+        Stops the reaper thread, the remaining processes are no longer tracked.
+        """
+        with self.condition:
+            if self.stopped:
+                return
+            
+            self.stopped = True
+            
+        self._wakeup()
+            
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+            
+    def _wakeup(self):
+        # the pipe is closed under the same lock once the reaper stops
+        with self.condition:
+            if self.wakeup_write is None:
+                return
+            
+            try:
+                os.write(self.wakeup_write, b"\0")
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+    
+    def _run(self):
+        poller = select.poll()
+        registered = set([self.wakeup_read])
+        poller.register(self.wakeup_read, select.POLLIN)
+        
+        while True:
+            with self.condition:
+                if self.stopped:
+                    break
+                
+                statuses = list(self.statuses)
+                
+            fds = {}
+            now = time.time()
+            delay = None
+            
+            for status in statuses:
+                if status.fd is not None:
+                    fds[status.fd] = status
+                    
+                if status.deadline is not None and not status.timed_out:
+                    if now >= status.deadline:
+                        self._kill(status)
+                    else:
+                        delay = min(delay, status.deadline - now) if delay is not None else status.deadline - now
+                        
+            for fd in registered - set(fds) - set([self.wakeup_read]):
+                poller.unregister(fd)
+                registered.remove(fd)
+                
+            for fd in set(fds) - registered:
+                poller.register(fd, select.POLLIN)
+                registered.add(fd)
+                
+            try:
+                events = poller.poll(int(math.ceil(delay*1000)) if delay is not None else None)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                
+                continue
+            
+            for (fd, event) in events:
+                if fd == self.wakeup_read:
+                    try:
+                        while os.read(self.wakeup_read, 4096):
+                            pass
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                else:
+                    poller.unregister(fd)
+                    registered.remove(fd)
+                    self._reap(fds[fd], os.WNOHANG)
+                    
+        with self.condition:
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
+            self.wakeup_write = None
+                
+    def _wait(self, status):
+        # without wait4, each process is waited on by its own thread
+        status.process.wait()
+        self._finish(status, None)
+        
+    def _wait_any(self):
+        while True:
+            with self.condition:
+                if self.stopped or not [s for s in self.statuses if s.fd is None]:
+                    self.waiter = None
+                    return
+                
+            try:
+                (pid, exitstatus, rusage) = os.wait4(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno != errno.ECHILD:
+                    raise
+                
+                # the remaining processes were reaped elsewhere
+                with self.condition:
+                    statuses = [s for s in self.statuses if s.fd is None]
+                    
+                for status in statuses:
+                    self._reap(status, os.WNOHANG)
+                    
+                continue
+            
+            with self.condition:
+                matches = [s for s in self.statuses if s.pid == pid and s.fd is None]
+                
+                if not matches:
+                    self.unclaimed[pid] = (exitstatus, rusage)
+                    
+                    while len(self.unclaimed) > 1024:
+                        self.unclaimed.popitem(last=False)
+                    
+            if matches:
+                self._collect(matches[0], exitstatus, rusage)
+            
+    def _reap(self, status, options):
+        # holding the lock, callers of ProcessStatus.poll never see the
+        # process reaped without its exit code
+        with status.lock:
+            try:
+                (pid, exitstatus, rusage) = os.wait4(status.pid, options)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                
+                # already reaped elsewhere, e.g., by calling Popen.poll()
+                (pid, rusage) = (status.pid, None)
+            else:
+                if pid == status.pid and status.process.returncode is None:
+                    status.process.returncode = exit_code(exitstatus)
+                    
+        if pid == status.pid:
+            self._finish(status, rusage)
+            
+    def _collect(self, status, exitstatus, rusage):
+        with status.lock:
+            if status.process.returncode is None:
+                status.process.returncode = exit_code(exitstatus)
+                
+        self._finish(status, rusage)
+                
+    def _finish(self, status, rusage):
+        with self.condition:
+            self.statuses.remove(status)
+            
+        if status.fd is not None:
+            os.close(status.fd)
+            
+        status.rusage = rusage
+        status.elapsed = time.time() - status.start
+        status._finish(status.process.returncode)
+        logging.info("Process terminated with exit code %s", status.returncode)
+        self._wakeup()
+        
+    def _kill(self, status):
+        logging.warn("Process exceeded timeout limit, killing process")
+        status.timed_out = True
+        
+        try:
+            status.process.kill()
+        except OSError:
+            pass
+    
+# the pidfd_open system call number on the architectures listed below, other
+# architectures number it differently (for example, alpha uses 544 and mips
+# adds its ABI base) and fall back to polling
+_PIDFD_OPEN = 434
+
+_PIDFD_ARCHITECTURES = ("x86_64", "amd64", "i386", "i486", "i586", "i686",
+                        "aarch64", "arm64", "armv6l", "armv7l", "armv8l",
+                        "riscv64", "ppc64", "ppc64le", "s390x", "loongarch64")
+
+_libc = None
+
+def pidfd_open(pid):
+    '''
+    Returns a file descriptor that becomes readable when the process exits,
+    or None if pidfds are not supported (Linux 5.3 and later only).
+    '''
+    global _libc
+    
+    if not sys.platform.startswith("linux"):
+        return None
+    
+    if platform.machine().lower() not in _PIDFD_ARCHITECTURES:
+        return None
+    
+    if _libc is None:
+        try:
+            import ctypes
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except (ImportError, OSError):
+            _libc = False
+            
+    if not _libc:
+        return None
+    
+    fd = _libc.syscall(_PIDFD_OPEN, pid, 0)
+    return fd if fd >= 0 else None
+
+def exit_code(exitstatus):
+    '''
+    Converts the exit status returned by wait into a returncode, which is
+    negative if the process was killed by a signal, like Popen.returncode.
+    '''
+    if os.WIFSIGNALED(exitstatus):
+        return -os.WTERMSIG(exitstatus)
+    elif os.WIFEXITED(exitstatus):
+        return os.WEXITSTATUS(exitstatus)
+    else:
+        return exitstatus
+    
+_reaper = None
+_reaper_lock = threading.Lock()
+
+# the evaluation running on the current thread, see set_owner
+_owner = threading.local()
+
+def set_owner(owner):
+    '''
+    Sets the evaluation running on the current thread.  Processes started by
+    the evaluation are tagged with the owner, so ProcessReaper.cancel can
+    kill them.
+    '''
+    _owner.value = owner
+
+def get_reaper():
+    '''
+    Returns the ProcessReaper shared by all tasks in this process.
+    '''
+    global _reaper
+    
+    with _reaper_lock:
+        # forked processes do not inherit the reaper's thread
+        if _reaper is None or _reaper.pid != os.getpid():
+            _reaper = ProcessReaper()
+            
+        return _reaper
+        
+def process_monitor(process, timeout=None):
+    '''
+    Waits for the process to exit, killing it if the timeout is exceeded.
+    Returns the exit code, or raises TaskError if the process was killed
+    because it exceeded the timeout or was cancelled.
+    '''
+    status = get_reaper().track(process, timeout)
+    returncode = status.wait()
+    
+    if status.timed_out or status.cancelled:
+        reason = "exceeded timeout limit" if status.timed_out else "was cancelled"
+        logging.error("Process " + reason + " and was killed")
+        raise TaskError("Process " + reason + " and was killed")
+    
+    return returncode
                 
 def redirect(stream, env, name):
     while True:
@@ -115,7 +666,132 @@ def redirect(stream, env, name):
 
         env[name].seek(0, os.SEEK_END)
         env[name].write(line)
-        print(env[name].getvalue())
+        logging.info("%s: %s", name, Abbreviated(line.rstrip("\n")))
+        
+# The maximum length of a value in a log message, see abbreviate
+LOG_LIMIT = 200
+
+# The maximum number of items of a list or tuple included in a log message
+LOG_ITEMS = 10
+
+def abbreviate(value, limit=None):
+    '''
+    Returns the string form of the value for a log message, truncated to at
+    most limit characters (LOG_LIMIT by default).  Long lists and tuples are
+    truncated before they are converted, so large payloads are never
+    formatted in full.
+    '''
+    limit = LOG_LIMIT if limit is None else limit
+    
+    if isinstance(value, (list, tuple)) and len(value) > LOG_ITEMS:
+        text = str(list(value[:LOG_ITEMS]))[:-1] + ", ... " + str(len(value)) + " items]"
+    elif isinstance(value, basestring):
+        text = value
+    else:
+        text = str(value)
+        
+    if len(text) > limit:
+        text = text[:limit] + "... " + str(len(text)) + " characters"
+        
+    return text
+    
+class Abbreviated(object):
+    '''
+    Wraps a log message argument, deferring abbreviate until the message is
+    formatted.
+    '''
+    
+    __slots__ = ["value"]
+    
+    def __init__(self, value):
+        self.value = value
+        
+    def __str__(self):
+        return abbreviate(self.value)
+        
+# Frames start with a header containing the payload length (4-byte, unsigned,
+# big-endian) and the payload type, followed by the payload
+FRAME_HEADER = struct.Struct(">Ic")
+FRAME_VECTOR = "d"
+FRAME_RECORD = "m"
+FRAME_JSON = "j"
+FRAME_PICKLE = "p"
+
+def pack_frame(type, value):
+    '''
+    Encodes a length-prefixed binary frame.  Vector frames (FRAME_VECTOR)
+    contain a list of numbers packed as little-endian float64 values.  Record
+    frames (FRAME_RECORD) contain a dict encoded with msgpack, or encoded as
+    JSON (FRAME_JSON) if msgpack is not installed.  Pickle frames
+    (FRAME_PICKLE) contain any picklable object and must only be read from
+    trusted peers.
+    '''
+    if type == FRAME_VECTOR:
+        values = array.array("d", value)
+        
+        if sys.byteorder == "big":
+            values.byteswap()
+            
+        payload = values.tostring()
+    elif type in (FRAME_RECORD, FRAME_JSON):
+        try:
+            if type == FRAME_JSON:
+                raise ImportError()
+            
+            import msgpack
+            payload = msgpack.packb(value)
+        except ImportError:
+            import json
+            payload = json.dumps(value)
+            type = FRAME_JSON
+    elif type == FRAME_PICKLE:
+        import cPickle
+        payload = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    else:
+        raise ValueError("Unknown frame type " + repr(type))
+        
+    return FRAME_HEADER.pack(len(payload), type) + payload
+
+def unpack_frame(type, payload):
+    '''
+    Decodes the payload of a frame created by pack_frame.
+    '''
+    if type == FRAME_VECTOR:
+        values = array.array("d")
+        values.fromstring(payload)
+        
+        if sys.byteorder == "big":
+            values.byteswap()
+            
+        return values.tolist()
+    elif type == FRAME_RECORD:
+        import msgpack
+        return msgpack.unpackb(payload)
+    elif type == FRAME_JSON:
+        import json
+        return json.loads(payload)
+    elif type == FRAME_PICKLE:
+        import cPickle
+        return cPickle.loads(payload)
+    else:
+        raise ValueError("Unknown frame type " + repr(type))
+    
+def read_frame(stream):
+    '''
+    Reads the next frame from the stream, returning the (type, value) tuple.
+    '''
+    header = _read_exactly(stream, FRAME_HEADER.size)
+    (length, type) = FRAME_HEADER.unpack(header)
+    profiling.add_bytes(FRAME_HEADER.size + length)
+    return (type, unpack_frame(type, _read_exactly(stream, length)))
+
+def _read_exactly(stream, length):
+    data = stream.read(length)
+    
+    if len(data) != length:
+        raise IOError("Connection closed while reading frame")
+    
+    return data
         
 # Copied from Lib/string.py
 class _multimap:
@@ -134,60 +810,321 @@ class _multimap:
         except KeyError:
             return self._secondary[key]
         
-class SubstitionEngine(object):
+class LRUCache(object):
+    '''
+    Thread-safe dict that holds at most maxsize entries, evicting the least
+    recently used entry when full.
+    '''
+    
+    def __init__(self, maxsize=1024):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            
+            self.entries[key] = value
+            return value
+        
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+                
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, key):
+        return key in self.entries
+        
+class ResourcePool(object):
+    '''
+    Thread-safe pool of up to size reusable resources, such as connections or
+    engines.  Resources are created on demand by the create function, and
+    acquire blocks while all resources are in use.  Resources released with
+    discard=True are destroyed and replaced by a new resource when needed.
+    A pool copied into a forked process or pickled, such as when sent to a
+    distributed worker, starts empty, since the resources can not be shared.
+    '''
+    
+    def __init__(self, create, size=1, destroy=None):
+        super(ResourcePool, self).__init__()
+        self.create = create
+        self.destroy = destroy
+        self.size = size
+        self._condition = threading.Condition()
+        self._reset()
+        
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._count = 0
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_condition"]
+        del state["_pid"]
+        del state["_idle"]
+        del state["_count"]
+        state["create"] = _method_state(self, self.create)
+        state["destroy"] = _method_state(self, self.destroy)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create = _method_restore(self, self.create)
+        self.destroy = _method_restore(self, self.destroy)
+        self._condition = threading.Condition()
+        self._reset()
+        
+    def acquire(self, timeout=None, args=()):
+        """
+        Returns an idle resource, creating one by calling create(*args) if
+        fewer than size exist.  Raises PoolTimeout if no resource becomes
+        available before the timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        
+        with self._condition:
+            if self._pid != os.getpid():
+                self._reset()
+                
+            while not self._idle and self._count >= self.size:
+                remaining = deadline - time.time() if deadline is not None else None
+                
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout("Timed out waiting for an available resource")
+                
+                self._condition.wait(remaining)
+                
+            if self._idle:
+                return self._idle.pop()
+            
+            self._count += 1
+            
+        try:
+            return self.create(*args)
+        except Exception:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+                
+            raise
+        
+    def fill(self, args=()):
+        """
+        Creates resources until size exist.  The resources are created in
+        parallel threads, since resources such as engines can take seconds
+        to start.  Re-raises the first error if any resource fails.
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                self._reset()
+                
+            count = max(0, self.size - self._count)
+            self._count += count
+            
+        created = []
+        errors = []
+        
+        def create():
+            try:
+                created.append(self.create(*args))
+            except Exception:
+                errors.append(sys.exc_info())
+                
+        threads = [threading.Thread(target=create) for i in range(count)]
+        
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+            
+        for thread in threads:
+            thread.join()
+            
+        with self._condition:
+            self._count -= len(errors)
+            self._idle.extend(created)
+            self._condition.notify_all()
+            
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        
+    def release(self, resource, discard=False):
+        """
+        Returns the resource to the pool, or destroys it if discard is True.
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            
+            if discard:
+                self._count -= 1
+            else:
+                self._idle.append(resource)
+                
+            self._condition.notify()
+            
+        if discard and self.destroy is not None:
+            self.destroy(resource)
+            
+    def close(self):
+        """
+        Destroys the idle resources.
+        """
+        with self._condition:
+            idle = self._idle if self._pid == os.getpid() else []
+            self._count -= len(idle)
+            self._idle = []
+            
+        if self.destroy is not None:
+            for resource in idle:
+                self.destroy(resource)
+        
+def _method_state(owner, function):
+    '''
+    Replaces methods, which can not be pickled, with their name.  Bound
+    methods must belong to the owner.
+    '''
+    if isinstance(function, types.MethodType):
+        if function.im_self is owner:
+            return ("method", None, function.__name__)
+        elif function.im_self is None:
+            return ("method", function.im_class, function.__name__)
+        
+    return ("function", function, None)
+
+def _method_restore(owner, state):
+    (kind, value, name) = state
+    
+    if kind == "method":
+        return getattr(owner if value is None else value, name)
+    else:
+        return value
+        
+DELIMITER = '$'
+IDPATTERN = r'[_a-z][_a-z0-9]*'
+
+_match_regex = re.compile(r"""
+    ^%(delim)s(?:
+    (?P<escaped>%(delim)s)$ |   # Escape sequence of two delimiters
+    (?P<named>%(id)s)$      |   # delimiter and a Python identifier
+    {(?P<braced>%(id)s)}$   |   # delimiter and a braced identifier
+    (?P<invalid>))$             # Other ill-formed delimiter exprs
+    """ % {"delim":re.escape(DELIMITER), "id":IDPATTERN}, re.IGNORECASE | re.VERBOSE)
+
+_sub_regex = re.compile(r"""
+    %(delim)s(?:
+    (?P<escaped>%(delim)s) |   # Escape sequence of two delimiters
+    (?P<named>%(id)s)      |   # delimiter and a Python identifier
+    {(?P<braced>%(id)s)}   |   # delimiter and a braced identifier
+    (?P<invalid>))             # Other ill-formed delimiter exprs
+    """ % {"delim":re.escape(DELIMITER), "id":IDPATTERN}, re.IGNORECASE | re.VERBOSE)
+
+class CompiledTemplate(object):
+    '''
+    A template parsed once into literal pieces and placeholder slots, so
+    substituting values only needs to join strings.
+    '''
     
     def __init__(self, template):
-        super(SubstitionEngine, self).__init__()
+        super(CompiledTemplate, self).__init__()
         self.template = template
+        self.pieces = []
+        self.slots = []
+        self.substitution_name = None
+        
+        mo = _match_regex.match(template)
         
-        self.delimiter = '$'
-        self.idpattern = r'[_a-z][_a-z0-9]*'
+        if mo is not None:
+            self.substitution_name = mo.group('named') or mo.group('braced') or \
+                (DELIMITER if mo.group('escaped') is not None else mo.group())
         
-        match_pattern = r"""
-            ^%(delim)s(?:
-            (?P<escaped>%(delim)s)$ |   # Escape sequence of two delimiters
-            (?P<named>%(id)s)$      |   # delimiter and a Python identifier
-            {(?P<braced>%(id)s)}$   |   # delimiter and a braced identifier
-            (?P<invalid>))$             # Other ill-formed delimiter exprs
-            """
+        position = 0
         
-        sub_pattern = r"""
-            %(delim)s(?:
-            (?P<escaped>%(delim)s) |   # Escape sequence of two delimiters
-            (?P<named>%(id)s)      |   # delimiter and a Python identifier
-            {(?P<braced>%(id)s)}   |   # delimiter and a braced identifier
-            (?P<invalid>))             # Other ill-formed delimiter exprs
-            """
+        for mo in _sub_regex.finditer(template):
+            if mo.start() > position:
+                self.pieces.append(template[position:mo.start()])
             
-        self.match_regex = re.compile(match_pattern % {"delim":re.escape(self.delimiter), "id":self.idpattern},
-                                 re.IGNORECASE | re.VERBOSE)
+            named = mo.group('named') or mo.group('braced')
+            
+            if named is not None:
+                self.slots.append((len(self.pieces), named))
+                self.pieces.append(mo.group())
+            elif mo.group('escaped') is not None:
+                self.pieces.append(DELIMITER)
+            else:
+                self.pieces.append(mo.group())
+                
+            position = mo.end()
+            
+        if position < len(template):
+            self.pieces.append(template[position:])
+            
+        self.has_substitutions = position > 0
+        self.static = None if self.slots else "".join(self.pieces)
+        
+    def substitute(self, mapping):
+        if self.static is not None:
+            return self.static
+        
+        pieces = list(self.pieces)
         
-        self.sub_regex = re.compile(sub_pattern % {"delim":re.escape(self.delimiter), "id":self.idpattern},
-                               re.IGNORECASE | re.VERBOSE)
+        for (index, name) in self.slots:
+            try:
+                # We use this idiom instead of str() because the latter
+                # will fail if val is a Unicode containing non-ASCII
+                pieces[index] = '%s' % (mapping[name],)
+            except KeyError:
+                pass
+            
+        return "".join(pieces)
     
-    def is_substitution_str(self):       
-        return self.match_regex.match(self.template) is not None
+_template_cache = LRUCache(1024)
     
-    def get_substitution_name(self):
-        mo = self.match_regex.match(self.template)
+def compile_template(template):
+    '''
+    Returns the CompiledTemplate for the given template text, reusing
+    previously compiled templates.
+    '''
+    compiled = _template_cache.get(template)
+    
+    if compiled is None:
+        compiled = CompiledTemplate(template)
+        _template_cache.put(template, compiled)
         
-        if mo is None:
-            return None
+    return compiled
         
-        named = mo.group('named') or mo.group('braced')
-
-        if named is not None:
-            return named
-        if mo.group('escaped') is not None:
-            return self.delimiter
-        if mo.group('invalid') is not None:
-            return mo.group()
-
-        raise ValueError('Unrecognized named group in pattern',
-                          self.pattern)
+class SubstitionEngine(object):
+    
+    def __init__(self, template):
+        super(SubstitionEngine, self).__init__()
+        self.template = template
+        self.delimiter = DELIMITER
+        self.idpattern = IDPATTERN
+        self.compiled = compile_template(template)
+    
+    def is_substitution_str(self):       
+        return self.compiled.substitution_name is not None
+    
+    def get_substitution_name(self):
+        return self.compiled.substitution_name
         
     def has_substitutions(self):
-        return self.sub_regex.search(self.template) is not None
+        return self.compiled.has_substitutions
     
     # Derived from safe_substitute in Lib/string.py
     def substitute(self, *args, **kws):
@@ -205,25 +1142,4 @@ class SubstitionEngine(object):
         else:
             mapping = args[0]
 
-        # Helper function for .sub()
-        def convert(mo):
-            named = mo.group('named') or mo.group('braced')
-
-            if named is not None:
-                try:
-                    # We use this idiom instead of str() because the latter
-                    # will fail if val is a Unicode containing non-ASCII
-                    return '%s' % (mapping[named],)
-                except KeyError:
-                    return mo.group()
-
-            if mo.group('escaped') is not None:
-                return self.delimiter
-
-            if mo.group('invalid') is not None:
-                return mo.group()
-
-            raise ValueError('Unrecognized named group in pattern',
-                             self.pattern)
-
-        return self.sub_regex.sub(convert, self.template)
\ No newline at end of file
+        return self.compiled.substitute(mapping)